@@ -1,14 +1,26 @@
+import base64
+import gzip
+import hashlib
 import json
 import logging
 import os
 import shutil
+import tempfile
+from unittest import mock
 
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.files import File
+from django.db import connection
 from django.test import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
 
-from gobotany.core import models
+from gobotany.api import urls, views
+from gobotany.core import catalog, distribution_vectors, models
+from gobotany.dkey import images, models as dkey_models
+from gobotany.mapping import cache as map_cache
+from gobotany.mapping.map import NewEnglandPlantDistributionMap
 
 def _testdata_dir():
     """Return the path to a test data directory relative to this directory."""
@@ -82,19 +94,21 @@ def _setup_sample_data(load_images=False):
     cg1.save()
 
     c1 = models.Character(short_name='c1', name='Character 1',
-                          character_group=cg1)
+                          character_group=cg1, ease_of_observability=1)
     c1.save()
     c2 = models.Character(short_name='c2', name='Character 2',
-                          character_group=cg1)
+                          character_group=cg1, ease_of_observability=2)
     c2.save()
     c3 = models.Character(short_name='c3', name='Character 3',
-                          character_group=cg1, value_type='LENGTH')
+                          character_group=cg1, value_type='LENGTH',
+                          ease_of_observability=3)
     c3.save()
     c4 = models.Character(short_name='c4', name='Character 4',
                           character_group=cg1)
     c4.save()
     char_habitat = models.Character(short_name='habitat', name='Habitat',
-                                    character_group=cg1)
+                                    character_group=cg1,
+                                    ease_of_observability=1)
     char_habitat.save()
 
     cv1_1 = models.CharacterValue(value_str='cv1_1', character=c1)
@@ -105,6 +119,8 @@ def _setup_sample_data(load_images=False):
     cv2.save()
     cv3 = models.CharacterValue(value_min=5, value_max=11, character=c3)
     cv3.save()
+    cv3_2 = models.CharacterValue(value_min=20, value_max=30, character=c3)
+    cv3_2.save()
     cv_habitat1 = models.CharacterValue(value_str='forests',
         character=char_habitat)
     cv_habitat1.save()
@@ -121,6 +137,8 @@ def _setup_sample_data(load_images=False):
     models.TaxonCharacterValue(taxon=foo, character_value=cv1_1).save()
     models.TaxonCharacterValue(taxon=bar, character_value=cv1_2).save()
     models.TaxonCharacterValue(taxon=bar, character_value=cv2).save()
+    models.TaxonCharacterValue(taxon=foo, character_value=cv3).save()
+    models.TaxonCharacterValue(taxon=bar, character_value=cv3_2).save()
     models.TaxonCharacterValue(taxon=bar, character_value=cv_habitat1).save()
     models.TaxonCharacterValue(taxon=bar, character_value=cv_habitat2).save()
 
@@ -204,7 +222,21 @@ class TaxaListTestCase(TestCase):
         expected = {'items': [],
                     'identifier': 'scientific_name',
                     'label': 'scientific_name'}
-        self.assertEqual(expected, json.loads(response.content))
+        self.assertEqual(expected, json.loads(response.getvalue()))
+
+    def test_get_matches_single_taxon_serializer(self):
+        response = self.client.get('/api/taxa/')
+        expected = [views._simple_taxon(taxon)
+                    for taxon in models.Taxon.objects.all()]
+        self.assertEqual(expected, json.loads(response.getvalue())['items'])
+
+    def test_get_uses_same_number_of_queries_for_any_number_of_taxa(self):
+        taxa = models.Taxon.objects.all()
+        with CaptureQueriesContext(connection) as one:
+            views._simple_taxa(taxa.filter(scientific_name='Fooium fooia'))
+        with CaptureQueriesContext(connection) as every:
+            views._simple_taxa(taxa)
+        self.assertEqual(len(one), len(every))
 
 
 class TaxaTestCase(TestCase):
@@ -351,6 +383,15 @@ class TaxonImageTestCase(TestCase):
         response = self.client.get('/api/taxon-image/?species=Fooium%20fooia')
         self.assertEqual(b'[]', response.content)
 
+    def test_species_list_includes_first_image(self):
+        views._species_cache.clear()
+        response = self.client.get('/api/species/pile1/')
+        images = {species['scientific_name']: species['images']
+                  for species in json.loads(response.getvalue())}
+        self.assertEqual([], images['Fooium fooia'])
+        self.assertEqual(['im1 alt'],
+                         [image['title'] for image in images['Fooium barula']])
+
 
 class PileGroupListTestCase(TestCase):
     @classmethod
@@ -367,6 +408,14 @@ class PileGroupListTestCase(TestCase):
         self.assertEqual('application/json; charset=utf-8',
                          response['Content-Type'])
 
+    def test_get_uses_same_number_of_queries_for_any_number_of_groups(self):
+        pilegroups = models.PileGroup.objects.all()
+        with CaptureQueriesContext(connection) as one:
+            views._pilegroup_dicts(pilegroups.filter(name='pilegroup1'))
+        with CaptureQueriesContext(connection) as every:
+            views._pilegroup_dicts(pilegroups)
+        self.assertEqual(len(one), len(every))
+
 
 class PileGroupTestCase(TestCase):
     @classmethod
@@ -409,6 +458,23 @@ class PileListTestCase(TestCase):
         self.assertEqual('application/json; charset=utf-8',
                          response['Content-Type'])
 
+    def test_get_matches_single_pile_documents(self):
+        items = json.loads(self.client.get('/api/piles/').content)['items']
+        pile1 = json.loads(self.client.get('/api/piles/pile1/').content)
+        self.assertIn(pile1, items)
+        self.assertEqual(['c1', 'c2'], [f['short_name'] for f
+                                        in pile1['default_filters']])
+        self.assertEqual([{'name': 'cg1', 'id': 1}],
+                         pile1['character_groups'])
+
+    def test_get_uses_same_number_of_queries_for_any_number_of_piles(self):
+        piles = models.Pile.objects.all()
+        with CaptureQueriesContext(connection) as one:
+            views._pile_dicts(piles.filter(name='pile1'))
+        with CaptureQueriesContext(connection) as every:
+            views._pile_dicts(piles)
+        self.assertEqual(len(one), len(every))
+
 
 class PileTestCase(TestCase):
     @classmethod
@@ -512,6 +578,592 @@ class CharacterValuesTestCase(TestCase):
         self.assertEqual(404, response.status_code)
 
 
+class QuestionsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _setup_sample_data()
+        cls.client = Client()
+
+    def test_get_prefers_questions_with_several_answers(self):
+        species_ids = '_'.join(str(taxon.id) for taxon in
+                               models.Taxon.objects.filter(genus__name='Fooium'))
+        response = self.client.get(
+            '/api/piles/pile1/questions/?choose_best=2&species_ids='
+            + species_ids)
+        self.assertEqual(200, response.status_code)
+        short_names = [question['short_name']
+                       for question in json.loads(response.content)]
+        self.assertEqual({'c1', 'habitat'}, set(short_names))
+
+
+class PileVectorSetTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _setup_sample_data()
+        cls.client = Client()
+
+    def setUp(self):
+        catalog.clear()
+        cache.clear()
+
+    def bump(self):
+        """Bump the version of pile1 as an editor save does, and return
+        the pile's new version."""
+        pile_id = models.Pile.objects.get(slug='pile1').id
+        catalog.bump(catalog.pile_scope(pile_id))
+        return catalog.data_version(catalog.CATALOG,
+                                    catalog.pile_scope(pile_id))
+
+    def test_get_returns_json_list_by_default(self):
+        response = self.client.get('/api/vectors/pile-set/pile1/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/json; charset=utf-8',
+                         response['Content-Type'])
+        self.assertIsInstance(json.loads(response.getvalue()), list)
+
+    def test_bitmap_format_matches_json_format(self):
+        plain = json.loads(self.client.get(
+            '/api/vectors/pile-set/pile1/').getvalue())
+        packed = json.loads(self.client.get(
+            '/api/vectors/pile-set/pile1/?format=bitmap').getvalue())
+        species_ids = packed['species']
+        self.assertEqual(species_ids, sorted(species_ids))
+        for expected, character in zip(plain, packed['characters']):
+            self.assertEqual(expected['slug'], character['slug'])
+            decoded = []
+            for encoded in character['values']:
+                bits = int.from_bytes(base64.b64decode(encoded), 'little')
+                decoded.append([taxon_id for i, taxon_id
+                                in enumerate(species_ids)
+                                if bits & (1 << i)])
+            self.assertEqual([sorted(ids) for ids in expected['values']],
+                             decoded)
+
+    def test_accept_header_selects_bitmap_format(self):
+        response = self.client.get(
+            '/api/vectors/pile-set/pile1/',
+            HTTP_ACCEPT='application/vnd.gobotany.bitmap+json')
+        self.assertTrue(response['Content-Type'].startswith(
+            'application/vnd.gobotany.bitmap+json'))
+        self.assertIn('species', json.loads(response.getvalue()))
+        self.assertIn('Accept', response['Vary'])
+
+    def vector_version(self, query=''):
+        response = self.client.get('/api/vectors/pile-set/pile1/' + query)
+        response.getvalue()
+        return response['X-Vector-Version']
+
+    def test_version_is_same_for_same_data(self):
+        version = self.vector_version()
+        self.bump()
+        cache.clear()
+        self.assertEqual(version, self.vector_version('?format=bitmap'))
+
+    def test_since_unknown_version_returns_full_document(self):
+        response = self.client.get(
+            '/api/vectors/pile-set/pile1/?since=' + '0' * 32)
+        update = json.loads(response.getvalue())
+        self.assertTrue(update['full'])
+        self.assertEqual(response['X-Vector-Version'], update['version'])
+        plain = json.loads(self.client.get(
+            '/api/vectors/pile-set/pile1/').getvalue())
+        self.assertEqual(plain, update['characters'])
+
+    def test_since_returns_changed_values(self):
+        version = self.vector_version()
+        foo = models.Taxon.objects.get(scientific_name='Fooium fooia')
+        cv2 = models.CharacterValue.objects.get(value_str='cv2')
+        models.TaxonCharacterValue(taxon=foo, character_value=cv2).save()
+        self.bump()
+
+        response = self.client.get(
+            '/api/vectors/pile-set/pile1/?since=' + version)
+        update = json.loads(response.getvalue())
+        self.assertFalse(update['full'])
+        self.assertEqual(version, update['since'])
+        self.assertNotEqual(version, update['version'])
+        self.assertEqual(response['X-Vector-Version'], update['version'])
+        self.assertEqual([], update['removed'])
+        self.assertEqual([], update['replaced'])
+        self.assertEqual(
+            [{'slug': 'c2', 'values': [
+                {'index': 0, 'added': [foo.id], 'removed': []}]}],
+            update['changed'])
+
+    def test_since_must_be_a_version(self):
+        response = self.client.get(
+            '/api/vectors/pile-set/pile1/?since=yesterday')
+        self.assertEqual(400, response.status_code)
+
+    def test_since_is_not_offered_as_bitmaps(self):
+        version = self.vector_version()
+        response = self.client.get(
+            '/api/vectors/pile-set/pile1/?format=bitmap&since=' + version)
+        self.assertEqual(400, response.status_code)
+
+
+class SpeciesTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _setup_sample_data()
+        cls.client = Client()
+
+    def get(self, **kw):
+        """Fetch the pile's species, reading the whole streamed response
+        so that it gets cached."""
+        response = self.client.get('/api/species/pile1/', **kw)
+        return response, response.getvalue()
+
+    def test_get_streams_first_response_then_serves_it_from_cache(self):
+        views._species_cache.clear()
+        first, first_content = self.get()
+        self.assertTrue(first.streaming)
+        second, second_content = self.get()
+        self.assertFalse(second.streaming)
+        self.assertEqual(200, second.status_code)
+        self.assertEqual(first_content, second_content)
+        self.assertEqual(str(len(second_content)), second['Content-Length'])
+        self.assertEqual(3, len(json.loads(second_content)))
+
+    def test_get_returns_precompressed_content(self):
+        plain, plain_content = self.get()
+        response, content = self.get(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(plain_content, gzip.decompress(content))
+
+    def test_get_believes_refused_encodings(self):
+        plain, plain_content = self.get()
+        for header in ('gzip;q=0', 'br;q=0, gzip;q=0', 'identity, *;q=0'):
+            response, content = self.get(HTTP_ACCEPT_ENCODING=header)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(plain_content, content)
+        response, content = self.get(HTTP_ACCEPT_ENCODING='br;q=0, *')
+        self.assertEqual('gzip', response['Content-Encoding'])
+
+    def test_get_returns_not_modified_for_matching_etag(self):
+        self.get()
+        etag = self.get()[0]['ETag']
+        response, content = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+    def test_each_encoding_has_its_own_etag(self):
+        self.get()
+        plain = self.get()[0]['ETag']
+        gzipped = self.get(HTTP_ACCEPT_ENCODING='gzip')[0]['ETag']
+        self.assertNotEqual(plain, gzipped)
+        self.assertTrue(gzipped.endswith('-gzip"'))
+        response, content = self.get(HTTP_IF_NONE_MATCH=gzipped)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(plain, response['ETag'])
+        response, content = self.get(HTTP_IF_NONE_MATCH=gzipped,
+                                     HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(304, response.status_code)
+
+    def test_get_follows_species_edits(self):
+        self.get()
+        models.Pile.objects.get(slug='pile1').species.remove(
+            models.Taxon.objects.get(scientific_name='Fooium fooia'))
+        response, content = self.get()
+        self.assertEqual(2, len(json.loads(content)))
+
+
+class PileBundleTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _setup_sample_data()
+        cls.client = Client()
+
+    def test_get_redirects_to_current_version(self):
+        response = self.client.get('/api/piles/pile1/bundle/')
+        self.assertEqual(302, response.status_code)
+        self.assertRegexpMatches(response['Location'],
+                                 r'/api/piles/pile1/bundle/[0-9a-f]{32}/$')
+
+    def test_get_returns_immutable_bundle(self):
+        response = self.client.get('/api/piles/pile1/bundle/', follow=True)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('immutable', response['Cache-Control'])
+        bundle = json.loads(response.content)
+        self.assertEqual(
+            json.loads(self.client.get('/api/piles/pile1/').content),
+            bundle['pile'])
+        self.assertEqual(
+            json.loads(self.client.get('/api/species/pile1/').getvalue()),
+            bundle['species'])
+        self.assertEqual(json.loads(self.client.get(
+            '/api/vectors/pile-set/pile1/').getvalue()), bundle['vectors'])
+        self.assertEqual(json.loads(self.client.get(
+            '/api/piles/pile1/characters/').content), bundle['characters'])
+
+    def test_get_redirects_from_stale_version(self):
+        response = self.client.get('/api/piles/pile1/bundle/', follow=True)
+        location = response.redirect_chain[-1][0]
+        response = self.client.get('/api/piles/pile1/bundle/%s/' % ('0' * 32))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(location, response['Location'])
+
+    def test_url_names_digest_of_content(self):
+        response = self.client.get('/api/piles/pile1/bundle/', follow=True)
+        location = response.redirect_chain[-1][0]
+        self.assertTrue(location.endswith(
+            '/%s/' % hashlib.md5(response.content).hexdigest()))
+
+    def test_get_returns_not_found_when_nonexistent_pile(self):
+        response = self.client.get('/api/piles/nonexistent/bundle/')
+        self.assertEqual(404, response.status_code)
+
+
+class BatchTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _setup_sample_data()
+        cls.client = Client()
+
+    def test_get_returns_bad_request_without_paths(self):
+        response = self.client.get('/api/batch/')
+        self.assertEqual(400, response.status_code)
+
+    def test_get_returns_each_response(self):
+        paths = ['/api/taxa/?c1=cv1_1', '/api/piles/pile1/',
+                 '/api/species/pile1/']
+        response = self.client.get('/api/batch/', {'path': paths})
+        self.assertEqual(200, response.status_code)
+        responses = json.loads(response.content)['responses']
+        self.assertEqual(paths, [r['path'] for r in responses])
+        for path, r in zip(paths, responses):
+            self.assertEqual(200, r['status'])
+            expected = json.loads(self.client.get(path).getvalue())
+            self.assertEqual(expected, r['body'])
+
+    def test_get_reports_missing_and_foreign_paths(self):
+        paths = ['/api/piles/nonexistent/', '/api/no-such-thing/',
+                 '/admin/', '/api/batch/?path=/api/piles/']
+        response = self.client.get('/api/batch/', {'path': paths})
+        statuses = [r['status'] for r in
+                    json.loads(response.content)['responses']]
+        self.assertEqual([404, 404, 400, 400], statuses)
+
+    def test_get_embeds_uncompressed_bodies(self):
+        paths = ['/api/piles/pile1/', '/api/species/pile1/']
+        response = self.client.get('/api/batch/', {'path': paths},
+                                   HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        content = gzip.decompress(response.content)
+        for path, r in zip(paths, json.loads(content)['responses']):
+            self.assertEqual(200, r['status'])
+            expected = json.loads(self.client.get(path).getvalue())
+            self.assertEqual(expected, r['body'])
+
+    def test_get_reports_failing_paths(self):
+        paths = ['/api/piles/pile1/', '/api/taxa/?c1=cv1_1']
+        with mock.patch('gobotany.api.views._pile_dict',
+                        side_effect=RuntimeError), \
+                self.assertLogs('gobotany.api.views', 'ERROR'):
+            response = self.client.get('/api/batch/', {'path': paths})
+        self.assertEqual(200, response.status_code)
+        statuses = [r['status'] for r in
+                    json.loads(response.content)['responses']]
+        self.assertEqual([500, 200], statuses)
+
+
+class PileFilterTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _setup_sample_data()
+        cls.client = Client()
+
+    def get(self, **params):
+        response = self.client.get('/api/piles/pile1/filter/', params)
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.content)
+
+    def names(self, species_ids):
+        return sorted(models.Taxon.objects.filter(id__in=species_ids)
+                      .values_list('scientific_name', flat=True))
+
+    def test_get_without_filters_returns_whole_pile(self):
+        result = self.get()
+        self.assertEqual(3, result['count'])
+        self.assertEqual(result['species'], sorted(result['species']))
+
+    def test_get_keeps_species_without_a_value(self):
+        result = self.get(c1='cv1_1')
+        self.assertEqual(['Bazia americana', 'Fooium fooia'],
+                         self.names(result['species']))
+
+    def test_get_intersects_filters(self):
+        result = self.get(c1='cv1_2', family='Fooaceae')
+        self.assertEqual(['Fooium barula'], self.names(result['species']))
+
+    def test_get_matches_length_ranges(self):
+        result = self.get(c3='7')
+        self.assertEqual(['Bazia americana', 'Fooium fooia'],
+                         self.names(result['species']))
+
+    def test_get_returns_length_ranges(self):
+        self.assertEqual({'c3': [{'min': 5, 'max': 11, 'count': 1},
+                                 {'min': 20, 'max': 30, 'count': 1}]},
+                         self.get()['ranges'])
+
+    def test_length_ranges_follow_other_filters(self):
+        self.assertEqual({'c3': [{'min': 5, 'max': 11, 'count': 1}]},
+                         self.get(c1='cv1_1')['ranges'])
+
+    def test_length_ranges_ignore_their_own_filter(self):
+        self.assertEqual(self.get()['ranges'], self.get(c3='7')['ranges'])
+
+    def test_choice_counts_ignore_their_own_filter(self):
+        choices = self.get(c1='cv1_1', genus='Fooium')['choices']
+        self.assertEqual([{'choice': 'cv1_1', 'count': 1},
+                          {'choice': 'cv1_2', 'count': 1}], choices['c1'])
+        self.assertEqual([{'choice': 'Bazia', 'count': 1},
+                          {'choice': 'Fooium', 'count': 1}],
+                         choices['genus'])
+
+    def test_get_returns_questions_not_yet_answered(self):
+        questions = self.get(c1='cv1_1', choose_best=5)['questions']
+        short_names = [q['short_name'] for q in questions]
+        self.assertTrue(short_names)
+        self.assertNotIn('c1', short_names)
+
+    def test_get_ignores_jquery_cache_buster(self):
+        self.assertEqual(self.get(), self.get(_='1500000000000'))
+
+    def test_get_returns_bad_request_for_unknown_parameter(self):
+        response = self.client.get('/api/piles/pile1/filter/?c9=x')
+        self.assertEqual(400, response.status_code)
+
+    def test_get_returns_bad_request_for_bad_length(self):
+        response = self.client.get('/api/piles/pile1/filter/?c3=tall')
+        self.assertEqual(400, response.status_code)
+
+
+class GlossaryBlobTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        models.GlossaryTerm(term='leaf', lay_definition='A leaf.').save()
+        models.GlossaryTerm(term='leaflet', lay_definition='A little leaf.',
+                            plural='leaflettes').save()
+
+    def setUp(self):
+        views._glossary_cache.clear()
+
+    def get(self):
+        response = self.client.get('/api/glossaryblob/')
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.content)
+
+    def test_save_fills_in_plural(self):
+        term = models.GlossaryTerm.objects.get(term='leaf')
+        self.assertEqual('leaves', term.plural)
+
+    def test_save_recomputes_plural_of_changed_term(self):
+        term = models.GlossaryTerm.objects.get(term='leaf')
+        term.term = 'loaf'
+        term.save()
+        self.assertEqual('loaves', models.GlossaryTerm.objects.get(
+            id=term.id).plural)
+
+    def test_save_keeps_plural_edited_with_term(self):
+        term = models.GlossaryTerm.objects.get(term='leaf')
+        term.term = 'loaf'
+        term.plural = 'loafs'
+        term.save()
+        self.assertEqual('loafs', models.GlossaryTerm.objects.get(
+            id=term.id).plural)
+
+    def test_get_includes_stored_plurals(self):
+        definitions = self.get()['definitions']
+        self.assertEqual('A leaf.', definitions['leaves'])
+        self.assertEqual('A little leaf.', definitions['leaflettes'])
+
+    def test_get_skips_short_terms(self):
+        models.GlossaryTerm(term='ax', lay_definition='An axis.').save()
+        self.assertNotIn('ax', self.get()['definitions'])
+
+    def test_get_includes_trie_of_terms(self):
+        trie = self.get()['trie']
+        node = trie['l']['e']['a']['f']
+        self.assertEqual(1, node[''])
+        self.assertEqual(1, node['l']['e']['t'][''])
+        self.assertNotIn('', trie['l'])
+
+    def test_versioned_url_is_immutable(self):
+        version = self.get()['version']
+        response = self.client.get('/api/glossaryblob/%d/' % version)
+        self.assertIn('immutable', response['Cache-Control'])
+        response = self.client.get('/api/glossaryblob/%d/' % (version + 1))
+        self.assertEqual(302, response.status_code)
+
+
+@override_settings(ALLOWED_HOSTS=['.example.org'])
+class VersionedTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _setup_sample_data()
+        taxa = models.Taxon.objects.order_by('id')
+        for short_name, taxon in zip(('gobotany', 'montshire'), taxa):
+            partner = models.PartnerSite(short_name=short_name)
+            partner.save()
+            models.PartnerSpecies(partner=partner, species=taxon).save()
+
+    def setUp(self):
+        cache.clear()
+        self.view = urls.versioned(views.vectors_key)
+        self.factory = RequestFactory()
+
+    def get(self, host, **kw):
+        request = self.factory.get('/api/vectors/key/simple/',
+                                   HTTP_HOST=host, **kw)
+        return self.view(request, 'simple')
+
+    def test_response_follows_host(self):
+        responses = [self.get(host) for host in
+                     ('gobotany.example.org', 'montshire.example.org',
+                      'gobotany.example.org')]
+        species = [json.loads(r.content)[0]['species'] for r in responses]
+        self.assertNotEqual(species[0], species[1])
+        self.assertEqual(species[0], species[2])
+        self.assertNotEqual(responses[0]['ETag'], responses[1]['ETag'])
+        self.assertEqual(responses[0]['ETag'], responses[2]['ETag'])
+
+    def test_response_keeps_headers(self):
+        first = self.get('gobotany.example.org')
+        second = self.get('gobotany.example.org')
+        self.assertEqual(first['Expires'], second['Expires'])
+        self.assertIn('Host', second['Vary'])
+
+    def test_etag_of_other_host_is_not_honored(self):
+        etag = self.get('gobotany.example.org')['ETag']
+        self.get('montshire.example.org')
+        response = self.get('montshire.example.org', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+
+
+class DkeyImagesTestCase(TestCase):
+    def setUp(self):
+        _setLoggingLevelError(self)
+        catalog.clear()
+
+    def tearDown(self):
+        _restoreLoggingLevel(self)
+
+    def test_get_returns_image_lists_built_by_sync(self):
+        document = {'image_types': ['bark'], 'image_lists': []}
+        dkey_models.Page(title='Group 4', rank='group',
+                         image_cache=json.dumps(document)).save()
+        response = self.client.get('/api/dkey-images/group-4/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(document, json.loads(response.content))
+
+    def test_get_builds_image_lists_for_unsynced_page(self):
+        page = dkey_models.Page(title='Equisetaceae', rank='family')
+        page.save()
+        response = self.client.get('/api/dkey-images/equisetaceae/')
+        self.assertEqual({}, json.loads(response.content))
+        self.assertEqual('{}', dkey_models.Page.objects.get(
+            id=page.id).image_cache)
+
+    def _group_page(self):
+        _setup_sample_data()
+        page = dkey_models.Page(title='Group 1', rank='group')
+        page.save()
+        dkey_models.Lead(page=page, letter='a', text='Fooish',
+                         taxa_cache='family:Fooaceae').save()
+        return page
+
+    def _titles(self):
+        response = self.client.get('/api/dkey-images/group-1/')
+        return [image_list['title'] for image_list
+                in json.loads(response.content)['image_lists']]
+
+    def test_get_shows_illustrative_species_of_group(self):
+        page = self._group_page()
+        dkey_models.IllustrativeSpecies(
+            group_number=1, family_name='Fooaceae',
+            species_name='Fooium barula').save()
+        images.refresh(page)
+        self.assertEqual(['Fooaceae<br><i>(Fooium barula)</i>'],
+                         self._titles())
+
+    def test_get_rebuilds_image_lists_after_catalog_changes(self):
+        page = self._group_page()
+        images.refresh(page)
+        dkey_models.IllustrativeSpecies(
+            group_number=1, family_name='Fooaceae',
+            species_name='Fooium barula').save()
+        self.assertEqual(['Fooaceae<br><i>(Fooium fooia)</i>'],
+                         self._titles())
+        catalog.bump(catalog.CATALOG)
+        self.assertEqual(['Fooaceae<br><i>(Fooium barula)</i>'],
+                         self._titles())
+
+    def test_get_returns_not_found_when_nonexistent_page(self):
+        response = self.client.get('/api/dkey-images/nonexistent/')
+        self.assertEqual(404, response.status_code)
+
+
+class DistributionMapTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _setup_sample_data()
+        models.Distribution(scientific_name='Fooium fooia', state='ME',
+                            county='Piscataquis', present=True,
+                            native=True).save()
+        cls.client = Client()
+
+    URL = '/api/maps/fooium-fooia-ne-distribution-map.svg'
+
+    def setUp(self):
+        distribution_vectors.clear()
+
+    def test_get_returns_map(self):
+        response = self.client.get(self.URL)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/svg+xml', response['Content-Type'])
+        self.assertIn(b'Fooium fooia: New England', response.content)
+
+    def test_get_returns_not_modified_for_matching_etag(self):
+        etag = self.client.get(self.URL)['ETag']
+        response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+    def test_not_modified_does_not_copy_blank_map(self):
+        etag = self.client.get(self.URL)['ETag']
+        with mock.patch('gobotany.mapping.map.MapTemplate.copy') as copy:
+            response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertFalse(copy.called)
+
+    def test_get_serves_prerendered_map(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with self.settings(MEDIA_ROOT=directory):
+                etag = self.client.get(self.URL)['ETag']
+                map_cache.write(etag.strip('"'), b'<svg/>')
+                response = self.client.get(self.URL)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(b'<svg/>', response.content)
+
+    def test_get_computes_digest_once(self):
+        map_class = NewEnglandPlantDistributionMap
+        with mock.patch.object(map_class, 'digest',
+                               wraps=map_class.digest) as digest:
+            self.client.get(self.URL)
+        self.assertEqual(1, digest.call_count)
+
+    def test_etag_follows_distribution_edits(self):
+        etag = self.client.get(self.URL)['ETag']
+        for record in models.Distribution.objects.filter(
+                scientific_name='Fooium fooia'):
+            record.native = False
+            record.save()
+        response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+
 class FamiliesTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -1,10 +1,17 @@
+import hashlib
+from functools import wraps
+
 from django.conf import settings
 from django.conf.urls import url
 from django.contrib import admin
-from django.views.decorators.cache import cache_control, cache_page
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import cc_delim_re
+from django.views.decorators.cache import cache_control
 from django.views.generic import RedirectView
 
 from gobotany.api import views
+from gobotany.core import catalog
 
 admin.autodiscover()
 
@@ -31,6 +38,11 @@ urlpatterns = [
 
     url(r'^taxa-count/$', views.taxa_count, name='api-taxa-count'),
 
+    url(r'^batch/$', views.batch, name='api-batch'),
+
+    url(r'^glossaryblob/(?P<version>\d+)/$', views.glossary_blob,
+        name='api-glossary-blob-version'),
+
     url(r'^taxon-image/$', views.taxon_image, name='api-taxon-image'),
 
     url(r'^characters/$', views.characters, name='api-characters'),
@@ -67,6 +79,14 @@ urlpatterns = [
     url(r'^piles/(?P<pile_slug>[^/]+)/questions/$', views.questions,
         name='api-questions'),
 
+    url(r'^piles/(?P<pile_slug>[^/]+)/filter/$', views.pile_filter,
+        name='api-pile-filter'),
+
+    url(r'^piles/(?P<pile_slug>[^/]+)/bundle/$', views.pile_bundle,
+        name='api-pile-bundle'),
+    url(r'^piles/(?P<pile_slug>[^/]+)/bundle/(?P<digest>[0-9a-f]+)/$',
+        views.pile_bundle, name='api-pile-bundle-version'),
+
     url(r'^piles/(?P<slug>[^/]+)/?$', views.pile, name='api-pile'),
 
     url(r'^piles/(?P<pile_slug>[^/]+)/(?P<character_short_name>[^/]+)/$',
@@ -110,14 +130,78 @@ urlpatterns = [
     url(r'^$', views.nonexistent, name='api-base'),   # helps compute base URL
 ]
 
+def _response_digest(request, vary):
+    """Return a digest of everything in `request` that can change the
+    response: its host, its full path, and each header in `vary`."""
+    values = [request.get_host(), request.get_full_path()]
+    for header in sorted(set(['Accept'] + vary)):
+        meta_key = 'HTTP_' + header.upper().replace('-', '_')
+        values.append('%s=%s' % (header, request.META.get(meta_key, '')))
+    return hashlib.md5('\0'.join(values).encode('utf-8')).hexdigest()
+
+def versioned(view):
+    """Serve `view` with an ETag, and cache its responses in memcached.
+
+    Both the ETag and the cache key include the catalog data version,
+    so a response can be kept indefinitely: the first request after an
+    import or an edit simply finds a new key, and gets a fresh response.
+
+    Like Django's own cache middleware, the key also includes the host
+    and the value of every header that the view's response says it
+    varies on, which is remembered for each URL the first time that
+    the view runs.
+
+    """
+    @wraps(view)
+    def versioned_view(request, *args, **kw):
+        version = catalog.data_version()
+        vary_key = 'api-vary:%s' % hashlib.md5('\0'.join((
+            request.get_host(), request.get_full_path(),
+            )).encode('utf-8')).hexdigest()
+        vary = cache.get(vary_key)
+
+        cached = None
+        if vary is not None:
+            etag = '"%d-%s"' % (version, _response_digest(request, vary))
+            if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+            cached = cache.get('api-response:' + etag.strip('"'))
+
+        if cached is None:
+            response = view(request, *args, **kw)
+            if response.status_code != 200:
+                return response
+            if response.streaming:
+                content = b''.join(response.streaming_content)
+            else:
+                content = response.content
+            headers = [(name, value) for name, value in response.items()
+                       if name not in ('Content-Length', 'ETag')]
+            cached = (content, headers)
+            vary = [header for header in cc_delim_re.split(
+                response.get('Vary', '')) if header]
+            cache.set(vary_key, vary, None)
+            etag = '"%d-%s"' % (version, _response_digest(request, vary))
+            cache.set('api-response:' + etag.strip('"'), cached, None)
+
+        content, headers = cached
+        response = HttpResponse(content)
+        for name, value in headers:
+            response[name] = value
+        response['ETag'] = etag
+        return response
+    return versioned_view
+
 # We only use caching if memcached itself is configured; otherwise, we
 # assume that the developer does not really intend caching to take
-# place.
+# place.  Browsers are asked to check back each time, which costs only
+# a 304 response while the ETag still matches.
 
 if 'memcache' in settings.CACHES['default']['BACKEND']:
-    one_hour = 60 * 60
-    browsercache = cache_control(maxage=one_hour)
-    memcache = cache_page(one_hour)
+    browsercache = cache_control(no_cache=True)
+    memcache = versioned
     both = lambda view: browsercache(memcache(view))
 else:
     browsercache = lambda view: view
@@ -125,7 +209,7 @@ else:
     both = lambda view: view
 
 urlpatterns.extend([
-    url(r'^glossaryblob/$', both(views.glossary_blob)),
+    url(r'^glossaryblob/$', browsercache(views.glossary_blob)),
     url(r'^hierarchy/$', both(views.hierarchy)),
     url(r'^sections/$', both(views.sections)),
     url(r'^dkey-images/([-\w\d]+)/$', both(views.dkey_images)),
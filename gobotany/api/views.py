@@ -1,28 +1,35 @@
+import base64
 import copy
 import csv
+import gzip
 import hashlib
-import inflect
-import json
+import logging
 import os
 import re
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from operator import itemgetter
 from urllib.parse import urlencode
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.core.urlresolvers import Resolver404, resolve, reverse
 from django.db import connection
+from django.db.models.functions import Length
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.forms.models import model_to_dict
-from django.http import HttpResponse, Http404, JsonResponse
+from django.http import (HttpResponse, HttpResponseNotModified,
+    HttpResponseRedirect, Http404, JsonResponse, QueryDict,
+    StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
 from django.views.decorators.cache import cache_page
 from django.views.decorators.http import etag
 from django.views.decorators.vary import vary_on_headers
 
 import gobotany.dkey.models as dkey_models
-from gobotany.core import botany, igdt, models
+from gobotany.core import botany, catalog, encoding, igdt, matrix, models
 from gobotany.core.models import (
     Character, ContentImage,
     GlossaryTerm, PartnerSpecies, Pile,
@@ -30,19 +37,59 @@ from gobotany.core.models import (
     )
 from gobotany.core.partner import which_partner
 from gobotany.core.questions import get_questions
+from gobotany.dkey.images import current_document as dkey_current_images
+from gobotany.mapping import cache as map_cache
 from gobotany.mapping.map import (NewEnglandPlantDiversityMap,
     NewEnglandPlantDistributionMap, NorthAmericanPlantDistributionMap,
-    UnitedStatesPlantDistributionMap)
+    UnitedStatesPlantDistributionMap, plant_name)
+from gobotany.middleware import encoding_qualities
 from gobotany.site.utils import secure_url
 
+log = logging.getLogger(__name__)
 
-inflector = inflect.engine()
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 def jsonify(value, headers=None, indent=1):
     """Convert the value into a JSON HTTP response."""
     response = HttpResponse(
-        json.dumps(value, indent=indent if settings.DEBUG else None),
+        encoding.encode(value, indent=indent if settings.DEBUG else None),
+        content_type='application/json; charset=utf-8',
+        )
+    if headers:
+        for k, v in list(headers.items()):  # set headers
+            response[k] = v
+    return response
+
+STREAM_CHUNK_SIZE = 16 * 1024
+
+def _chunked(pieces, size=STREAM_CHUNK_SIZE):
+    """Gather small strings into chunks of about `size` encoded bytes."""
+    buffer = []
+    length = 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+def jsonify_stream(value, headers=None, indent=1):
+    """Stream the value as a JSON HTTP response, item by item.
+
+    The body is byte-for-byte what jsonify() would have sent, but is
+    never held in memory all at once.
+    """
+    pieces = encoding.iter_json(
+        value, indent=indent if settings.DEBUG else None)
+    response = StreamingHttpResponse(
+        _chunked(pieces),
         content_type='application/json; charset=utf-8',
         )
     if headers:
@@ -66,6 +113,26 @@ def _taxon_image(image):
         }
     return json
 
+# Image descriptions are the same in every response that includes them,
+# so each is encoded only once.  A fragment is stored under every field
+# that goes into it, so an edited image simply gets a new entry.
+
+_image_fragments = {}
+IMAGE_FRAGMENTS_MAX = 50000
+
+def _taxon_image_fragment(image):
+    """Return _taxon_image(image) as a pre-encoded JSON Fragment."""
+    type_name = (image.image_type_name if hasattr(image, 'image_type_name')
+                 else image.image_type.name)
+    key = (image.id, image.image.name, type_name, image.rank, image.alt)
+    fragment = _image_fragments.get(key)
+    if fragment is None:
+        if len(_image_fragments) >= IMAGE_FRAGMENTS_MAX:
+            _image_fragments.clear()
+        fragment = encoding.Fragment.of(_taxon_image(image))
+        _image_fragments[key] = fragment
+    return fragment
+
 def _simple_taxon(taxon, pile_slug=None, include_default_image=False,
     include_factoid=False):
 
@@ -93,6 +160,47 @@ def _simple_taxon(taxon, pile_slug=None, include_default_image=False,
         json['factoid'] = taxon.factoid
     return json
 
+def _simple_taxa(species, max_rank=10):
+    """Batched version of _simple_taxon, for serializing a whole list.
+
+    Instead of three queries per species, the common names, families,
+    and images of every species in `species` are fetched together, so
+    the number of queries stays the same however many species match.
+    The queries run immediately, but the dictionaries are built by the
+    generator that is returned, one at a time, as they are serialized.
+    """
+    taxa = list(species.select_related('family'))
+    taxon_ids = [taxon.id for taxon in taxa]
+
+    common_names = {}
+    for taxon_id, common_name in (models.CommonName.objects
+            .filter(taxon_id__in=taxon_ids)
+            .values_list('taxon_id', 'common_name')):
+        common_names.setdefault(taxon_id, common_name)
+
+    images = defaultdict(list)
+    for image in (ContentImage.objects
+            .filter(content_type=ContentType.objects.get_for_model(Taxon),
+                    object_id__in=taxon_ids, rank__lte=max_rank)
+            .select_related('image_type')
+            .order_by('id')):
+        images[image.object_id].append(_taxon_image_fragment(image))
+
+    def generate():
+        for taxon in taxa:
+            genus_name, epithet = taxon.scientific_name.lower().split(None, 1)
+            yield {
+                'id': taxon.id,
+                'scientific_name': taxon.scientific_name,
+                'common_name': common_names.get(taxon.id, ''),
+                'genus': taxon.scientific_name.split()[0],
+                'family': taxon.family.name,
+                'taxonomic_authority': taxon.taxonomic_authority,
+                'url': reverse('taxa-species', args=(genus_name, epithet)),
+                'images': images[taxon.id],
+                }
+    return generate()
+
 def _species_simple_taxon(taxon, pile_slug):
     """Optimized version of the _simple_taxon helper function, for use with
     the species/ URL, which does custom querying and passes a modified taxon
@@ -147,6 +255,7 @@ class rc_factory(object):
                  NOT_FOUND = ('Not Found', 404),
                  DUPLICATE_ENTRY = ('Conflict/Duplicate', 409),
                  NOT_HERE = ('Gone', 410),
+                 INTERNAL_ERROR = ('Internal Server Error', 500),
                  NOT_IMPLEMENTED = ('Not Implemented', 501),
                  THROTTLED = ('Throttled', 503))
 
@@ -181,9 +290,9 @@ def taxa(request, scientific_name=None):
     if not scientific_name:
         # Only return character values for single item lookup, keep the
         # result list simple
-        listing = [_simple_taxon(s) for s in species.all()]
+        listing = _simple_taxa(species.all())
 
-        return jsonify({'items': listing,
+        return jsonify_stream({'items': listing,
                 'label': 'scientific_name',
                 'identifier': 'scientific_name'})
     elif species.exists():
@@ -253,32 +362,46 @@ def character(request, character_short_name):
             r['list'].append([cv.value_min, cv.value_max])
     return jsonify(r)
 
-def _character_groups(pile=None):
-    groups = models.CharacterGroup.objects.filter(
-        character__pile=pile).distinct()
-    return [dict(name=group.name,
-                 id=group.id) for group in groups]
-
-def _default_filters(pile=None):
-    filters = []
-    default_filters = list(
-        models.DefaultFilter.objects.filter(pile=pile)
-        .select_related('character')
-        )
-    for default_filter in default_filters:
-        filter = _jsonify_character(default_filter.character, pile.slug)
+# Piles and pile groups are serialized in batches: each relation is
+# fetched for every pile in the batch with a single query, so that the
+# listings take the same number of queries however many piles there are.
+
+PILE_FIELDS = ('name', 'friendly_name', 'key_characteristics',
+               'notable_exceptions', 'description')
+PILEGROUP_FIELDS = ('name', 'friendly_name', 'key_characteristics',
+                    'notable_exceptions')
+
+def _character_groups(piles):
+    """Return {pile ID: [character group dict, ...]}."""
+    groups = defaultdict(list)
+    for pile_id, group_id, name in (
+            models.CharacterGroup.objects
+            .filter(character__pile__in=piles)
+            .values_list('character__pile_id', 'id', 'name')
+            .distinct()):
+        groups[pile_id].append(dict(name=name, id=group_id))
+    return groups
+
+def _default_filters(piles):
+    """Return {pile ID: [default filter dict, ...]}."""
+    slugs = {pile.id: pile.slug for pile in piles}
+    filters = defaultdict(list)
+    for default_filter in (models.DefaultFilter.objects
+                           .filter(pile__in=piles)
+                           .select_related('character__character_group')):
+        pile_id = default_filter.pile_id
+        filter = _jsonify_character(default_filter.character, slugs[pile_id])
         filter['key'] = default_filter.key
         filter['order'] = default_filter.order
-        filters.append(filter)
+        filters[pile_id].append(filter)
     return filters
 
-def _plant_preview_characters(pile=None):
-    characters_list = []
-    plant_preview_characters = list(
-        models.PlantPreviewCharacter.objects.filter(pile=pile)
-        .select_related('character', 'partner_site')
-        )
-    for preview_character in plant_preview_characters:
+def _plant_preview_characters(piles):
+    """Return {pile ID: [plant preview character dict, ...]}."""
+    characters = defaultdict(list)
+    for preview_character in (models.PlantPreviewCharacter.objects
+                              .filter(pile__in=piles)
+                              .select_related('character', 'partner_site')):
         character = {}
         character['character_short_name'] = \
             preview_character.character.short_name
@@ -291,34 +414,39 @@ def _plant_preview_characters(pile=None):
         character['partner_site'] = partner_site
         character['unit'] = preview_character.character.unit
         character['value_type'] = preview_character.character.value_type
-        characters_list.append(character)
-    return characters_list
+        characters[preview_character.pile_id].append(character)
+    return characters
 
-def _default_image(pile_or_pilegroup=None):
-    if pile_or_pilegroup is not None:
-        return _taxon_image(pile_or_pilegroup.get_default_image()) or ''
+def _default_images(piles_or_pilegroups, model):
+    """Return {ID: image dict or ''} of each object's default image."""
+    content_type = ContentType.objects.get_for_model(model)
+    images = {}
+    for image in (ContentImage.objects
+                  .filter(content_type=content_type,
+                          object_id__in=[p.id for p in piles_or_pilegroups],
+                          rank=1, image_type__name='pile image')
+                  .select_related('image_type')
+                  .order_by('id')):
+        images.setdefault(image.object_id, _taxon_image(image))
+    return {p.id: images.get(p.id, '') for p in piles_or_pilegroups}
+
+def _pilegroup_dicts(pilegroups):
+    pilegroups = list(pilegroups)
+    default_images = _default_images(pilegroups, models.PileGroup)
+    dicts = []
+    for pilegroup in pilegroups:
+        pilegroup_dict = model_to_dict(pilegroup, fields=PILEGROUP_FIELDS)
+        pilegroup_dict['resource_uri'] = reverse('api-pilegroup',
+            args=(pilegroup.slug,))
+        pilegroup_dict['default_image'] = default_images[pilegroup.id]
+        dicts.append(pilegroup_dict)
+    return dicts
 
 def _pilegroup_dict(pilegroup):
-    pilegroup_dict = model_to_dict(pilegroup)
-
-    pilegroup_dict['resource_uri'] = reverse('api-pilegroup',
-        args=(pilegroup.slug,))
-    pilegroup_dict['default_image'] = _default_image(pilegroup)
-
-    # Delete some items not needed here yet.
-    del pilegroup_dict['friendly_title']
-    del pilegroup_dict['id']
-    del pilegroup_dict['sample_species_images']
-    del pilegroup_dict['slug']
-    del pilegroup_dict['video']
-
-    return pilegroup_dict
+    return _pilegroup_dicts([pilegroup])[0]
 
 def pile_group_listing(request):
-    lst = []
-    for pilegroup in models.PileGroup.objects.all():
-        pilegroup_dict = _pilegroup_dict(pilegroup)
-        lst.append(pilegroup_dict)
+    lst = _pilegroup_dicts(models.PileGroup.objects.all())
     return jsonify({'items': lst})
 
 def pile_group(request, slug):
@@ -329,32 +457,29 @@ def pile_group(request, slug):
     pilegroup_dict = _pilegroup_dict(pilegroup)
     return jsonify(pilegroup_dict)
 
+def _pile_dicts(piles):
+    piles = list(piles)
+    character_groups = _character_groups(piles)
+    default_filters = _default_filters(piles)
+    plant_preview_characters = _plant_preview_characters(piles)
+    default_images = _default_images(piles, Pile)
+    dicts = []
+    for pile in piles:
+        pile_dict = model_to_dict(pile, fields=PILE_FIELDS)
+        pile_dict['plant_preview_characters'] = \
+            plant_preview_characters[pile.id]
+        pile_dict['resource_uri'] = reverse('api-pile', args=(pile.slug,))
+        pile_dict['character_groups'] = character_groups[pile.id]
+        pile_dict['default_filters'] = default_filters[pile.id]
+        pile_dict['default_image'] = default_images[pile.id]
+        dicts.append(pile_dict)
+    return dicts
+
 def _pile_dict(pile):
-    pile_dict = model_to_dict(pile)
-
-    pile_dict['resource_uri'] = reverse('api-pile', args=(pile.slug,))
-    pile_dict['character_groups'] = _character_groups(pile)
-    pile_dict['default_filters'] = _default_filters(pile)
-    pile_dict['plant_preview_characters'] = _plant_preview_characters(
-        pile)
-    pile_dict['default_image'] = _default_image(pile)
-
-    # Delete some items not needed here yet.
-    del pile_dict['friendly_title']
-    del pile_dict['id']
-    del pile_dict['pilegroup']
-    del pile_dict['sample_species_images']
-    del pile_dict['slug']
-    del pile_dict['species']
-    del pile_dict['video']
-
-    return pile_dict
+    return _pile_dicts([pile])[0]
 
 def pile_listing(request):
-    lst = []
-    for pile in models.Pile.objects.all():
-        pile_dict = _pile_dict(pile)
-        lst.append(pile_dict)
+    lst = _pile_dicts(models.Pile.objects.all())
     return jsonify({'items': lst})
 
 def pile(request, slug):
@@ -394,8 +519,22 @@ def nonexistent(request):
     """Dummy view for an URL that is only used to output a base API URL."""
     return rc.NOT_FOUND
 
-def glossary_blob(request):
-    """Return a dictionary of glossary terms and definitions.
+def _term_trie(terms):
+    """Return a prefix trie of `terms`, for glossarizer.js to scan with.
+
+    Each node is a dictionary from a single character to the next node,
+    and a node where a term ends has the key "" as well.
+    """
+    trie = {}
+    for term in terms:
+        node = trie
+        for c in term:
+            node = node.setdefault(c, {})
+        node[''] = 1
+    return trie
+
+def _glossary_blob(version):
+    """Return the glossary blob, ready to encode.
 
     For now we omit glossary terms for which there are duplicates -
     like "Absent", which as of the writing of this comment has six
@@ -415,11 +554,15 @@ def glossary_blob(request):
 
     """
     glossaryterms = list(GlossaryTerm.objects.filter(highlight=True)
-                         .extra(where=['CHAR_LENGTH(term) > 2']))
+                         .annotate(term_length=Length('term'))
+                         .filter(term_length__gt=2))
 
     definitions = {}
     for gt in glossaryterms:
-        gt.plural = inflector.plural(gt.term)
+        # Plurals are computed by the importer; only terms added since
+        # then might need one here.
+        if not gt.plural:
+            gt.plural = GlossaryTerm.plural_of(gt.term)
         definitions[gt.term.lower()] = gt.lay_definition
         definitions[gt.plural.lower()] = gt.lay_definition
 
@@ -446,7 +589,41 @@ def glossary_blob(request):
         images[gt.term.lower()] = prefix + gt.image_path
         images[gt.plural.lower()] = prefix + gt.image_path
 
-    return jsonify({'definitions': definitions, 'images': images})
+    return {
+        'version': version,
+        'definitions': definitions,
+        'images': images,
+        'trie': _term_trie(definitions),
+        }
+
+# The glossary blob changes only with the catalog, so each process
+# builds it once per catalog data version.  Like a pile bundle, it can
+# also be fetched from a URL that names the version, which browsers
+# may cache forever.
+
+_glossary_cache = {}  # catalog data version -> EncodedBody
+
+def glossary_blob(request, version=None):
+    """Return a dictionary of glossary terms and definitions."""
+    current = catalog.data_version(catalog.CATALOG)
+    if version is not None and int(version) != current:
+        response = HttpResponseRedirect(
+            reverse('api-glossary-blob-version', args=(current,)))
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    body = _glossary_cache.get(current)
+    if body is None:
+        _glossary_cache.clear()  # built from an older catalog version
+        content = encoding.encode(_glossary_blob(current),
+                                  indent=1 if settings.DEBUG else None)
+        body = _glossary_cache[current] = EncodedBody(
+            content, 'application/json; charset=utf-8')
+
+    response = body.response(request)
+    if version is not None:
+        response['Cache-Control'] = IMMUTABLE
+    return response
 
 #
 
@@ -469,7 +646,8 @@ def sections(request):
 
 def _get_characters(short_names):
     """Return a list of characters with `short_names`, in that order."""
-    cl = Character.objects.filter(short_name__in=short_names)
+    cl = (Character.objects.filter(short_name__in=short_names)
+          .select_related('character_group'))
     by_short_name = dict((c.short_name, c) for c in cl)
     return [by_short_name[short_name] for short_name in short_names
             if short_name in by_short_name]
@@ -484,9 +662,11 @@ def _choose_best(pile, count, species_ids,
     `exclude_short_names` - characters to exclude from the list.
 
     """
-    result = igdt.rank_characters(pile, species_ids)
-    characters = []
-    for score, entropy, coverage, character in result:
+    pile_matrix = matrix.get_matrix(pile)
+    chosen_ids = []
+    for character_id in igdt.cached_ranking(pile, species_ids):
+        character = pile_matrix.characters[character_id]
+
         # There are several reasons we might disqualify a character.
 
         if character.value_type not in ('TEXT', 'LENGTH'):
@@ -499,11 +679,13 @@ def _choose_best(pile, count, species_ids,
 
         # Otherwise, keep this character!
 
-        characters.append(character)
-        if len(characters) == count:
+        chosen_ids.append(character_id)
+        if len(chosen_ids) == count:
             break
 
-    return characters
+    characters = (Character.objects.select_related('character_group')
+                  .in_bulk(chosen_ids))
+    return [characters[character_id] for character_id in chosen_ids]
 
 def _jsonify_character(character, pile_slug):
     return {
@@ -563,164 +745,27 @@ def questions(request, pile_slug):
     pile = get_object_or_404(Pile, slug=pile_slug)
     questions = get_questions(request, pile)
     # Normal: return JSON
-    questions_list = []
-    for question in questions:
-        character = Character.objects.get(short_name=question)
-        questions_list.append(_jsonify_character(character, pile_slug))
+    questions_list = [_jsonify_character(character, pile_slug)
+                      for character in _get_characters(questions)]
     output = jsonify(questions_list)
     # Alternate: return HTML for browser testing with Django Debug Toolbar
     #output = render(request, 'questions_test.html', {'questions': questions})
     return output
 
-# The images that should be displayed on a particular dkey page.
-
-extra_image_types = {
-    'Group 1': ['leaf'],
-    'Group 2': ['fruits', 'leaves'],
-    'Group 3': ['inflorescences', 'leaves'],
-    'Group 4': ['bark', 'leaves'],
-    'Group 5': ['bark', 'leaves'],
-    'Group 6': ['flowers', 'leaves'],
-    'Group 7': ['flowers', 'leaves'],
-    'Group 8': ['flowers', 'leaves'],
-    'Group 9': ['flowers', 'leaves'],
-    'Group 10': ['flowers', 'leaves'],
-    }
+# The images that should be displayed on a particular dkey page, which
+# gobotany.dkey.sync builds ahead of time, and which are rebuilt here if
+# the catalog has changed since.
 
 def dkey_images(request, slug):
 
     if slug == 'key-to-the-families':
         return jsonify({})
 
-    # Whether a dkey page displays groups of families, genera, or taxa,
-    # we need to pull exactly one species to stand as the representative
-    # for each taxon, and then grab all of the rank=1 content images for
-    # those species.
-
-    title = dkey_models.slug_to_title(slug)
-    page = get_object_or_404(dkey_models.Page, title=title)
-
-    taxa = None
-    rank = None
-    taxa_names = []
-    for lead in page.leads.all():
-        if lead.taxa_cache:
-            rank, comma_list = lead.taxa_cache.split(':')
-            taxa_names.extend(comma_list.split(','))
-    if rank is None:
-        return jsonify({})
-
-    group_title = None
-
-    if page.rank == 'group':
-        group_title = page.title
-    else:
-        for ancestor in page.breadcrumb_cache.all():
-            if ancestor.rank == 'group':
-                group_title = ancestor.title
-
-    image_types_allowed = ['plant form']
-    image_types_allowed.extend(extra_image_types.get(group_title, ()))
-
-    if rank == 'family':
-
-        # See https://github.com/newfs/gobotany-app/issues/302
-        # and https://github.com/newfs/gobotany-app/issues/304
-
-        group_number = title.split()[-1] if page.rank == 'group' else ''
-
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT f.name, t.id,
-              (SELECT id FROM core_taxon WHERE family_id = f.id LIMIT 1)
-              FROM core_family f
-              LEFT JOIN dkey_illustrativespecies i
-                ON (i.group_number = %s AND f.name = i.family_name)
-              LEFT JOIN core_taxon t
-                ON (i.species_name = t.scientific_name)
-              WHERE f.name IN %s""", (group_number, tuple(taxa_names),))
-
-        rows = cursor.fetchall()
-        family_map = {}
-        for family_name, illustrative_taxon_id, random_taxon_id in rows:
-            taxon_id = illustrative_taxon_id
-            if taxon_id is None:
-                taxon_id = random_taxon_id
-            family_map[taxon_id] = family_name
-
-        taxon_ids = list(family_map.keys())
-
-    elif rank == 'genus':
-
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT
-              (SELECT id FROM core_taxon WHERE genus_id = g.id LIMIT 1)
-              FROM core_genus g
-              WHERE g.name IN %s""", (tuple(taxa_names),))
-        taxon_ids = [ id for (id,) in cursor.fetchall() ]
-
-    elif rank == 'species':
-
-        taxa = Taxon.objects.filter(scientific_name__in=taxa_names)
-        taxon_ids = [ taxon.id for taxon in taxa ]
-
-    else:
-        return jsonify({})
-
-    if taxa is None:
-        taxa = Taxon.objects.filter(id__in=taxon_ids)
-
-    ctype = ContentType.objects.get_for_model(Taxon)
-    query = (ContentImage.objects
-             .filter(content_type=ctype, object_id__in=taxon_ids, rank=1)
-             .filter(image_type__name__in=image_types_allowed)
-             .select_related('image_type')
-             )
-
-    image_map = {
-        (image.object_id, image.image_type.name): image.thumb_small()
-        for image in query
-        }
-
-    image_types = sorted(set(key[1] for key in image_map))
-    image_lists = []
-
-    for taxon in taxa:
-
-        if rank == 'family':
-            name = family_map[taxon.id]
-            title = '{}<br><i>({})</i>'.format(name, taxon.scientific_name)
-        else:
-            if rank == 'genus':
-                name = taxon.genus_name()
-            else:
-                name = taxon.scientific_name
-            title = '<i>{}</i>'.format(taxon.scientific_name)
-
-        image_list = []
-        for image_type in image_types:
-            image = image_map.get((taxon.id, image_type))
-            if image is not None:
-                image_list.append({
-                    'image_type': image_type,
-                    'image_url':
-                        secure_url(image_map.get((taxon.id, image_type))),
-                    })
-
-        image_lists.append({
-            'name': name,
-            'scientific_name': taxon.scientific_name,
-            'title': title,
-            'image_list': image_list,
-            })
-
-    image_lists.sort(key=itemgetter('title'))
-
-    return jsonify({
-            'image_types': image_types,
-            'image_lists': image_lists,
-            })
+    document = dkey_current_images(dkey_models.slug_to_title(slug))
+    if document is None:
+        raise Http404
+    return HttpResponse(document,
+                        content_type='application/json; charset=utf-8')
 
 # Higher-order taxa.
 
@@ -785,21 +830,79 @@ def genus(request, genus_slug):
 
 # Lower-order taxa.
 
-_species_cache = {}
+# Each process keeps the JSON for every pile's species list, already
+# encoded to bytes, together with its ETag and compressed variants.
+# Caching whole HttpResponse objects did not work, because middleware
+# like GZipMiddleware rewrites a response's content in place, so every
+# request now gets a fresh HttpResponse built from the cached bytes.
+
+_species_cache = {}  # (pile_slug, catalog data version) -> EncodedBody
+
+
+@receiver(post_save, sender=Taxon, dispatch_uid='species_taxon_saved')
+@receiver(post_delete, sender=Taxon, dispatch_uid='species_taxon_deleted')
+@receiver(post_save, sender=models.CommonName,
+          dispatch_uid='species_common_name_saved')
+@receiver(post_delete, sender=models.CommonName,
+          dispatch_uid='species_common_name_deleted')
+@receiver(post_save, sender=Family, dispatch_uid='species_family_saved')
+@receiver(post_save, sender=ContentImage,
+          dispatch_uid='species_image_saved')
+@receiver(post_delete, sender=ContentImage,
+          dispatch_uid='species_image_deleted')
+@receiver(m2m_changed, sender=Pile.species.through,
+          dispatch_uid='species_pile_species_changed')
+def _species_data_changed(sender, **kw):
+    """Forget species lists as soon as this process edits their data."""
+    _species_cache.clear()
+    _bundle_cache.clear()
+
+
+class EncodedBody(object):
+    """A response body encoded once, and then served many times."""
+
+    def __init__(self, content, content_type):
+        self.content_type = content_type
+        self.digest = hashlib.md5(content).hexdigest()
+        self.encodings = {'identity': content}
+        self.encodings['gzip'] = gzip.compress(content)
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(content)
+
+    def etag(self, encoding):
+        """Return the strong ETag of the body in `encoding`, which must
+        differ between encodings since their bytes do."""
+        if encoding == 'identity':
+            return '"%s"' % self.digest
+        return '"%s-%s"' % (self.digest, encoding)
+
+    def response(self, request):
+        """Return a new HttpResponse for `request` with this body."""
+        quality = encoding_qualities(request)
+        encoding, best = 'identity', 0.0
+        for coding in ('br', 'gzip'):
+            if coding in self.encodings and quality(coding) > best:
+                encoding, best = coding, quality(coding)
+        etag = self.etag(encoding)
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpResponseNotModified()
+        else:
+            content = self.encodings[encoding]
+            response = HttpResponse(content, content_type=self.content_type)
+            response['Content-Length'] = str(len(content))
+            if encoding != 'identity':
+                response['Content-Encoding'] = encoding
+        response['ETag'] = etag
+        response['Vary'] = 'Accept-Encoding'
+        return response
 
-def species(request, pile_slug):
 
-    # Pull the result from our hard cache, if available.
+def _pile_species(pile_slug):
+    """Return a generator of the JSON dictionaries for a pile's species.
 
-    # TODO: fix. Disabled when upgrading to Django 1.5 due to error in
-    # Chrome when pulling from the cache:
-    # Error 354 (net::ERR_CONTENT_LENGTH_MISMATCH): The server unexpectedly
-    # closed the connection.
-    # Somehow the cached response has a much shorter Content-Length than the
-    # original response.
-    # Tried re-enabling after upgrade to Django 1.6, but got same error.
-    #if pile_slug in _species_cache:
-    #    return _species_cache[pile_slug]
+    The queries run immediately, but each dictionary is only built as
+    the generator reaches it.
+    """
 
     # Efficiently fetch the species that belong to this pile.  (Common
     # name is selected nondeterministically because, frankly, the data
@@ -830,11 +933,14 @@ def species(request, pile_slug):
         "  ON (core_contentimage.image_type_id = core_imagetype.id)"
         " JOIN django_content_type"
         "  ON (core_contentimage.content_type_id =django_content_type.id)"
+        " JOIN core_pile_species"
+        "  ON (core_contentimage.object_id = core_pile_species.taxon_id)"
+        " JOIN core_pile ON (core_pile_species.pile_id = core_pile.id)"
         " WHERE core_contentimage.rank <= 1"
-        "  AND core_contentimage.object_id IN %s"
+        "  AND core_pile.slug = %s"
         "  AND django_content_type.app_label = 'core'"
         "  AND django_content_type.model = 'taxon'",
-        (tuple( species.id for species in species_list ),))
+        (pile_slug,))
 
     image_dict = defaultdict(list)  # taxon_id -> [ContentImage, ...]
     for image in image_query:
@@ -843,23 +949,47 @@ def species(request, pile_slug):
     del species_query  # beware of leaving object references around
     del image_query
 
-    # Build and return our response.
+    def generate():
+        while species_list:
+            species = species_list.pop()  # pop() to free memory as we go
+            d = _species_simple_taxon(species, pile_slug)
+            d['images'] = images = []
+            image_list = image_dict.pop(species.id, ())
+            for image in image_list:
+                images.append(_taxon_image_fragment(image))
+            yield d
+
+    return generate()
+
+def species(request, pile_slug):
+
+    # Serve the pile's species from our hard cache, if available.
+
+    key = (pile_slug, catalog.data_version(catalog.CATALOG))
+    body = _species_cache.get(key)
+    if body is not None:
+        return body.response(request)
+
+    # Build and stream our response.
 
-    result = []
-    while species_list:
-        species = species_list.pop()  # pop() to free memory as we go
-        d = _species_simple_taxon(species, pile_slug)
-        d['images'] = images = []
-        image_list = image_dict.pop(species.id, ())
-        for image in image_list:
-            images.append(_taxon_image(image))
-        result.append(d)
+    def stream_and_cache(chunks):
+        content = []
+        for chunk in chunks:
+            content.append(chunk)
+            yield chunk
 
-    # Hard-cache the result, since our species lists do not currently
-    # change during the day in production.
+        # Hard-cache the result, since our species lists do not
+        # currently change during the day in production.
 
-    _species_cache[pile_slug] = jsonify(result)
-    return _species_cache[pile_slug]
+        for old_key in [k for k in _species_cache if k[1] != key[1]]:
+            del _species_cache[old_key]  # from an older catalog version
+        _species_cache[key] = EncodedBody(b''.join(content), content_type)
+
+    content_type = 'application/json; charset=utf-8'
+    pieces = encoding.iter_json(
+        _pile_species(pile_slug), indent=1 if settings.DEBUG else None)
+    return StreamingHttpResponse(stream_and_cache(_chunked(pieces)),
+                                 content_type=content_type)
 
 #
 
@@ -911,10 +1041,31 @@ def vectors_pile(request, slug):
 #   values: [...
 #            [5, 8, 9],  <-- one array of taxon IDs per value
 #            ...
-
-def pile_vector_set(request, slug):
-
-    pile = get_object_or_404(Pile, slug=slug)
+#
+# Clients that would rather not download and parse thousands of JSON
+# integers can instead ask for the "bitmap" encoding, either with the
+# query parameter ?format=bitmap or with an Accept header naming the
+# BITMAP_CONTENT_TYPE.  The pile's species are then listed once, in
+# ascending ID order, and each character value becomes a base64 string
+# whose bit i (least significant bit first) says whether the species at
+# index i of that list has the value.
+
+BITMAP_CONTENT_TYPE = 'application/vnd.gobotany.bitmap+json'
+
+def _wants_bitmap(request):
+    """Decide whether the client asked for the compact bitmap encoding."""
+    if request.GET.get('format') == 'bitmap':
+        return True
+    return BITMAP_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', '')
+
+def _pile_vector_set(pile):
+    """Return the list of characters, with species-ID lists, for a pile."""
+    return _load_pile_vectors(pile)[0]
+
+def _load_pile_vectors(pile):
+    """Return the list of characters with species-ID lists for a pile,
+    and a {slug: [character value ID, ...]} dict saying which value each
+    of those species-ID lists belongs to."""
 
     # These four queries are the barest minimum required to learn how
     # many character values each character has, and what species belong
@@ -935,7 +1086,7 @@ def pile_vector_set(request, slug):
       SELECT cg.id, cg.name
         FROM core_charactergroup cg
 
-      """, [pile.id])
+      """)
 
     character_group_map = {}
     for cgid, name in cursor.fetchall():
@@ -973,14 +1124,17 @@ def pile_vector_set(request, slug):
         FROM core_character c
         JOIN core_charactervalue cv ON (c.id = cv.character_id)
         WHERE c.pile_id = %s
+        ORDER BY cv.id
 
       """, [pile.id])
 
     character_value_map = {}
+    value_ids = defaultdict(list)
     for cid, cvid in cursor.fetchall():
         taxonid_list = []  # to be filled in below!
         character_value_map[cvid] = taxonid_list
         character_map[cid]['values'].append(taxonid_list)
+        value_ids[character_map[cid]['slug']].append(cvid)
 
     # 4.
 
@@ -1001,7 +1155,426 @@ def pile_vector_set(request, slug):
     # from django.http import HttpResponse
     # return HttpResponse('<html><head></head><body>foo</body>')
 
-    return jsonify(list(character_map.values()), indent=False)
+    return list(character_map.values()), value_ids
+
+def _encode_bitmaps(pile, characters):
+    """Replace each taxon-ID list with a base64 bitmap over dense indices.
+
+    Returns the sorted list of species IDs that the bit positions refer
+    to, which covers both the pile's own species and any stray taxon
+    that is attached to one of the pile's character values.
+
+    """
+    species_ids = set(pile.species.values_list('id', flat=True))
+    for character in characters:
+        for taxonid_list in character['values']:
+            species_ids.update(taxonid_list)
+    species_ids = sorted(species_ids)
+    index = {taxonid: i for i, taxonid in enumerate(species_ids)}
+    nbytes = (len(species_ids) + 7) // 8
+
+    for character in characters:
+        bitmaps = []
+        for taxonid_list in character['values']:
+            bits = 0
+            for taxonid in taxonid_list:
+                bits |= 1 << index[taxonid]
+            bitmaps.append(base64.b64encode(
+                bits.to_bytes(nbytes, 'little')).decode('ascii'))
+        character['values'] = bitmaps
+
+    return species_ids
+
+# Delta updates
+#
+# Every vector set response names the version of the data it carries in
+# an X-Vector-Version header: a digest of the vector set itself, so that
+# every process serving the same data gives it the same name.  A client
+# that already holds an earlier version can ask for ?since=<version>.
+# If a snapshot of that version is still in the cache, the response
+# lists only what changed:
+#
+# {version: 'c0ffee...', since: 'f00d...', full: false,
+#  removed: ['old_character_slug', ...],
+#  replaced: [{...a whole character, as in the full document...}, ...],
+#  changed: [{slug: 'habitat',
+#             values: [{index: 2, added: [5, 9], removed: [8]}, ...]},
+#            ...]}
+#
+# where a character is "replaced" if it is new, or if its description or
+# its list of values has changed.  Otherwise, or for an unknown version,
+# the response is {version: 'c0ffee...', full: true, characters: [...]}.
+# Updates list species IDs, so they cannot be asked for in the bitmap
+# format, whose bit positions shift whenever the species list does.
+
+VECTOR_VERSION_RE = re.compile(r'^[0-9a-f]{32}$')
+
+def _vector_snapshot_key(pile, vector_version):
+    return 'vector-snapshot:%d:%s' % (pile.id, vector_version)
+
+def _remember_vectors(pile, characters, value_ids):
+    """Return the version of a pile's vector set and a snapshot of it,
+    keeping the snapshot in the cache for later updates to start from."""
+    snapshot = {
+        c['slug']: (dict(c), value_ids[c['slug']]) for c in characters}
+    canonical = []
+    for slug in sorted(snapshot):
+        character, ids = snapshot[slug]
+        canonical.append([
+            sorted((k, v) for k, v in character.items() if k != 'values'),
+            [sorted(taxon_ids) for taxon_ids in character['values']],
+            ids,
+            ])
+    vector_version = hashlib.md5(
+        encoding.dumps(canonical).encode('utf-8')).hexdigest()
+    cache.set(_vector_snapshot_key(pile, vector_version), snapshot, None)
+    return vector_version, snapshot
+
+def _vector_delta(old, new):
+    removed = [slug for slug in old if slug not in new]
+    replaced = []
+    changed = []
+    for slug, (character, value_ids) in new.items():
+        previous = old.get(slug)
+        if previous is None:
+            replaced.append(character)
+            continue
+        old_character, old_value_ids = previous
+        if value_ids != old_value_ids or any(
+                old_character[k] != v for k, v in character.items()
+                if k != 'values'):
+            replaced.append(character)
+            continue
+        values = []
+        for i, (before, after) in enumerate(
+                zip(old_character['values'], character['values'])):
+            before = set(before)
+            after = set(after)
+            if before != after:
+                values.append({'index': i,
+                               'added': sorted(after - before),
+                               'removed': sorted(before - after)})
+        if values:
+            changed.append({'slug': slug, 'values': values})
+    return {'removed': removed, 'replaced': replaced, 'changed': changed}
+
+def _vector_update(pile, since, vector_version, snapshot):
+    old = cache.get(_vector_snapshot_key(pile, since))
+    if old is None:
+        return {'version': vector_version, 'full': True,
+                'characters': [character for character, value_ids
+                               in snapshot.values()]}
+    update = {'version': vector_version, 'since': since, 'full': False}
+    update.update(_vector_delta(old, snapshot))
+    return update
+
+@vary_on_headers('Accept')
+def pile_vector_set(request, slug):
+    pile = get_object_or_404(Pile, slug=slug)
+    characters, value_ids = _load_pile_vectors(pile)
+    vector_version, snapshot = _remember_vectors(pile, characters, value_ids)
+
+    since = request.GET.get('since')
+    if since is not None:
+        if not VECTOR_VERSION_RE.match(since) or _wants_bitmap(request):
+            return rc.BAD_REQUEST
+        response = jsonify(_vector_update(pile, since, vector_version,
+                                          snapshot), indent=False)
+    elif _wants_bitmap(request):
+        species_ids = _encode_bitmaps(pile, characters)
+        response = jsonify_stream({'species': species_ids,
+                                   'characters': characters}, indent=False)
+        response['Content-Type'] = BITMAP_CONTENT_TYPE + '; charset=utf-8'
+    else:
+        response = jsonify_stream(characters, indent=False)
+
+    response['X-Vector-Version'] = vector_version
+    return response
+
+
+# Pile bundles
+#
+# The Simple Key results page needs a pile's description, species list,
+# vector set, and characters before it can show anything.  The bundle
+# delivers all of them in a single document, whose URL names a digest of
+# its content, so browsers may cache it forever: /api/piles/<slug>/bundle/
+# redirects to the current digest.  Unlike the catalog version, which
+# starts over with a fresh database, a digest never names two different
+# documents.
+
+_bundle_cache = {}  # (pile_slug, catalog data version) -> EncodedBody
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+def _pile_bundle(pile, version):
+    characters = (Character.objects.filter(pile=pile)
+                  .select_related('character_group'))
+    return {
+        'version': version,
+        'pile': _pile_dict(pile),
+        'species': list(_pile_species(pile.slug)),
+        'vectors': _pile_vector_set(pile),
+        'characters': [_jsonify_character(c, pile.slug) for c in characters],
+        }
+
+def pile_bundle(request, pile_slug, digest=None):
+    pile = get_object_or_404(Pile, slug=pile_slug)
+    current = catalog.data_version(catalog.CATALOG,
+                                   catalog.pile_scope(pile.id))
+
+    key = (pile_slug, current)
+    body = _bundle_cache.get(key)
+    if body is None:
+        for old_key in [k for k in _bundle_cache
+                        if k[0] == pile_slug and k[1] != current]:
+            del _bundle_cache[old_key]  # from an older catalog version
+        value = _pile_bundle(pile, current)
+        content = encoding.encode(
+            value, indent=1 if settings.DEBUG else None)
+        body = _bundle_cache[key] = EncodedBody(
+            content, 'application/json; charset=utf-8')
+
+    if digest != body.digest:
+        response = HttpResponseRedirect(reverse(
+            'api-pile-bundle-version', args=(pile_slug, body.digest)))
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    response = body.response(request)
+    response['Cache-Control'] = IMMUTABLE
+    return response
+
+
+# Batches of API calls
+#
+# A page that needs several API documents can ask for all of them in a
+# single round trip, by naming each one with a "path" parameter:
+#
+# /api/batch/?path=/api/piles/lycophytes/&path=/api/species/lycophytes/
+#
+# Each path is resolved and its view called directly, without another
+# trip through the network and the middleware, so the views' own caches
+# still apply.  The JSON documents that the views return are copied into
+# the envelope verbatim, without being decoded and encoded again.
+
+BATCH_MAX_REQUESTS = 20
+
+def _batch_call(request, full_path):
+    """Call the API view for `full_path`, as though `request` asked for it.
+
+    Returns the sub-response's status code, content type, and content.
+    """
+    path, _, query = full_path.partition('?')
+    if not path.startswith('/api/') or path.startswith('/api/batch/'):
+        return 400, 'text/plain', b'Bad Request'
+    try:
+        match = resolve(path[len('/api'):], urlconf='gobotany.api.urls')
+    except Resolver404:
+        return 404, 'text/plain', b'Not Found'
+
+    subrequest = copy.copy(request)
+    subrequest.path = subrequest.path_info = path
+    subrequest.META = dict(request.META, PATH_INFO=path, QUERY_STRING=query)
+    # Each body is embedded in the batch response, so it must come back
+    # whole and uncompressed.
+    subrequest.META.pop('HTTP_IF_NONE_MATCH', None)
+    subrequest.META.pop('HTTP_ACCEPT_ENCODING', None)
+    subrequest.GET = QueryDict(query)
+    subrequest.resolver_match = match
+
+    try:
+        response = match.func(subrequest, *match.args, **match.kwargs)
+    except Http404:
+        response = rc.NOT_FOUND
+    except Exception:
+        log.exception('batch request for %s failed', full_path)
+        response = rc.INTERNAL_ERROR
+
+    if response.streaming:
+        content = b''.join(response.streaming_content)
+    else:
+        content = response.content
+    return (response.status_code,
+            response.get('Content-Type', 'text/plain'), content)
+
+def batch(request):
+    full_paths = request.GET.getlist('path')
+    if not full_paths or len(full_paths) > BATCH_MAX_REQUESTS:
+        return rc.BAD_REQUEST
+
+    responses = []
+    for full_path in full_paths:
+        status, content_type, content = _batch_call(request, full_path)
+        text = content.decode('utf-8', 'replace')
+        is_json = content_type.split(';')[0].endswith('json')
+        responses.append({
+            'path': full_path,
+            'status': status,
+            'body': encoding.Fragment(text) if is_json and text else text,
+            })
+
+    return jsonify({'responses': responses})
+
+
+# Server-side filtering
+#
+# Rather than downloading a pile's whole vector set and intersecting it
+# in the browser, a slow client can send its filter selections:
+#
+# /api/piles/lycophytes/filter/?horizontal_shoot_position_lp=on%20surface
+#
+# and receive the matching species IDs, how many species each answer to
+# each question would leave, the stretches of length that each LENGTH
+# question can still be answered with, and the next best questions.  The
+# filters follow the same rules as the Simple Key's own: a species that
+# has no value at all for a character is never excluded by it, and a
+# LENGTH filter matches every range that includes the number given.
+# Any other parameter, besides the "_" that jQuery adds to defeat
+# caching, is a mistake that gets a 400 rather than being ignored.
+
+FILTER_PARAMETERS = ('_', 'choose_best', 'character_group_id', 'exclude')
+CLASSIFICATIONS = ('family', 'genus')
+
+def _pile_filter_index(pile_matrix):
+    """Return (pile_bits, {'family': {name: bits}, 'genus': {...}})."""
+    index = pile_matrix.derived.get('filter')
+    if index is not None:
+        return index
+
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT t.id, f.name, g.name
+          FROM core_pile_species ps
+          JOIN core_taxon t ON (t.id = ps.taxon_id)
+          JOIN core_family f ON (f.id = t.family_id)
+          JOIN core_genus g ON (g.id = t.genus_id)
+          WHERE ps.pile_id = %s
+        """, [pile_matrix.pile_id])
+
+    pile_bits = 0
+    classifications = {name: defaultdict(int) for name in CLASSIFICATIONS}
+    for taxon_id, family_name, genus_name in cursor.fetchall():
+        bit = 1 << pile_matrix.index[taxon_id]
+        pile_bits |= bit
+        classifications['family'][family_name] |= bit
+        classifications['genus'][genus_name] |= bit
+
+    index = pile_bits, {name: dict(bits) for name, bits
+                        in classifications.items()}
+    pile_matrix.derived['filter'] = index
+    return index
+
+def _filter_bits(pile_matrix, pile_bits, classifications, name, value):
+    """Return the bitset of pile species that the filter `name` allows."""
+    if name in classifications:
+        return classifications[name].get(value, 0)
+    character = pile_matrix.character(name)
+    has_value = 0
+    for cv_id in character.value_ids:
+        has_value |= pile_matrix.bits[cv_id]
+    valueless = pile_bits & ~has_value
+    return (pile_matrix.matching(name, value) | valueless) & pile_bits
+
+def _filter_choices(pile_matrix, pile_bits, classifications, others):
+    """Return how many species each answer would leave, by filter name.
+
+    `others(name)` returns the species allowed by every filter except
+    the one named, which is what each of that filter's answers would
+    be combined with.
+    """
+    choices = {}
+    values = pile_matrix.values
+    for character in pile_matrix.characters.values():
+        remaining = others(character.short_name)
+        character_choices = []
+        for cv_id in character.value_ids:
+            bits = pile_matrix.bits[cv_id]
+            if not bits & pile_bits:
+                continue  # no species in this pile has this value
+            cv = values[cv_id]
+            choice = {'choice': cv.value_str,
+                      'count': matrix.popcount(bits & remaining)}
+            if character.value_type == 'LENGTH':
+                choice['min'] = cv.value_min
+                choice['max'] = cv.value_max
+            character_choices.append(choice)
+        choices[character.short_name] = character_choices
+
+    for name, bitsets in classifications.items():
+        remaining = others(name)
+        choices[name] = [
+            {'choice': choice, 'count': matrix.popcount(bits & remaining)}
+            for choice, bits in sorted(bitsets.items())
+            ]
+    return choices
+
+def _length_ranges(pile_matrix, others):
+    """Return the lengths that each LENGTH filter can still be set to."""
+    ranges = {}
+    for character in pile_matrix.characters.values():
+        if character.value_type != 'LENGTH':
+            continue
+        index = pile_matrix.length_index(character)
+        ranges[character.short_name] = [
+            {'min': low, 'max': high, 'count': count} for low, high, count
+            in index.ranges(others(character.short_name))
+            ]
+    return ranges
+
+def pile_filter(request, pile_slug):
+    pile = get_object_or_404(Pile, slug=pile_slug)
+    pile_matrix = matrix.get_matrix(pile)
+    pile_bits, classifications = _pile_filter_index(pile_matrix)
+
+    try:
+        choose_best = int(request.GET.get('choose_best', 3))
+        character_group_ids = set(
+            int(n) for n in request.GET.getlist('character_group_id'))
+    except ValueError:
+        return rc.BAD_REQUEST
+
+    allowed = OrderedDict()
+    for name, value in request.GET.items():
+        if name in FILTER_PARAMETERS or value == '':
+            continue
+        try:
+            allowed[name] = _filter_bits(
+                pile_matrix, pile_bits, classifications, name, value)
+        except models.Character.DoesNotExist:
+            return rc.BAD_REQUEST  # neither a filter nor a parameter
+        except ValueError:
+            return rc.BAD_REQUEST  # a LENGTH that is not a number
+
+    def others(skip_name):
+        bits = pile_bits
+        for name, filter_bits in allowed.items():
+            if name != skip_name:
+                bits &= filter_bits
+        return bits
+
+    species_bits = others(None)
+    species_ids = pile_matrix.species(species_bits)
+
+    questions = []
+    if choose_best > 0 and species_ids:
+        exclude_short_names = set(request.GET.getlist('exclude'))
+        exclude_short_names.update(allowed)
+        questions = [_jsonify_character(character, pile_slug)
+                     for character in _choose_best(
+                         pile=pile,
+                         count=choose_best,
+                         species_ids=species_ids,
+                         character_group_ids=character_group_ids,
+                         exclude_short_names=exclude_short_names,
+                         )]
+
+    return jsonify({
+        'species': species_ids,
+        'count': len(species_ids),
+        'choices': _filter_choices(
+            pile_matrix, pile_bits, classifications, others),
+        'ranges': _length_ranges(pile_matrix, others),
+        'questions': questions,
+        }, indent=False)
 
 
 # Plant diversity maps
@@ -1195,49 +1768,36 @@ def new_england_all_diversity_csv(request):
 
 # Plant distribution maps
 
-def _shade_map(distribution_map, genus, epithet):
-    scientific_name = ' '.join([genus.title(), epithet.lower()])
-    distribution_map.set_plant(scientific_name)
-    return distribution_map.shade()
-
-def _compute_map_etag(request, distribution_map, genus, epithet):
-    """Generate an ETag for allowing caching of maps. This requires
-    shading a map upon every request, but saves much bandwidth.
+def _compute_map_etag(request, map_class, genus, epithet):
+    """Generate an ETag for allowing caching of maps from a digest of
+    the data they are drawn from, so that answering a conditional
+    request does not require shading the map.  The digest is kept on
+    the request for the view to look up its pre-rendered map with.
     """
-    map = copy.deepcopy(distribution_map)
-    shaded_map = _shade_map(map, genus, epithet)
-    h = hashlib.md5()
-    h.update(shaded_map.tostring())
-    return h.hexdigest()
-
-# Disable ETag calculation for now, as it is no longer working in
-# Production, and enabling it with the latest code results in an error.
-@etag(_compute_map_etag)
-def _distribution_map(request, distribution_map, genus, epithet):
+    request.map_digest = map_class.digest(plant_name(genus, epithet))
+    return request.map_digest
 
-    # BONAP gives one species a different name than FNA; as a temporary
-    # measure, we rename the species here.  A more permament solution
-    # (whether a data fix, or a table to drive renaming) will be
-    # discussed here:
-    #
-    # https://github.com/newfs/gobotany-app/issues/277
-
-    if (genus, epithet) == ('berberis', 'aquifolium'):
-        genus, epithet = 'mahonia', 'aquifolium'
-
-    shaded_map = _shade_map(distribution_map, genus, epithet)
-    return HttpResponse(shaded_map.tostring(), content_type='image/svg+xml')
+@etag(_compute_map_etag)
+def _distribution_map(request, map_class, genus, epithet):
+    scientific_name = plant_name(genus, epithet)
+    content = map_cache.read(request.map_digest)
+    if content is None:
+        # Not rendered ahead of time by the prerender_maps command.
+        distribution_map = map_class()
+        distribution_map.set_plant(scientific_name)
+        content = distribution_map.shade().tostring()
+    return HttpResponse(content, content_type='image/svg+xml')
 
 def new_england_distribution_map(request, genus, epithet):
     """Return a vector map of New England showing county-level
     distribution data for a plant.
     """
-    distribution_map = NewEnglandPlantDistributionMap()
-    return _distribution_map(request, distribution_map, genus, epithet)
+    return _distribution_map(request, NewEnglandPlantDistributionMap,
+                             genus, epithet)
 
 def north_american_distribution_map(request, genus, epithet):
     """Return a vector map of North America showing county-level
     distribution data for a plant.
     """
-    distribution_map = NorthAmericanPlantDistributionMap()
-    return _distribution_map(request, distribution_map, genus, epithet)
+    return _distribution_map(request, NorthAmericanPlantDistributionMap,
+                             genus, epithet)
@@ -13,7 +13,7 @@ from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
 from gobotany.admin import GoBotanyModelAdmin
-from gobotany.core import models
+from gobotany.core import catalog, models
 from gobotany.core.distribution_places import DISTRIBUTION_PLACES
 
 # View classes
@@ -44,6 +44,19 @@ class _Base(GoBotanyModelAdmin):
 
         return fieldsets
 
+    # Saving the object and its inlines, or deleting it, changes the
+    # catalog that the API caches are built from.
+
+    catalog_scope = catalog.CATALOG
+
+    def save_related(self, request, form, formsets, change):
+        super(_Base, self).save_related(request, form, formsets, change)
+        catalog.bump(self.catalog_scope)
+
+    def delete_model(self, request, obj):
+        super(_Base, self).delete_model(request, obj)
+        catalog.bump(self.catalog_scope)
+
 
 class TaxonSynonymInline(admin.TabularInline):
     model = models.Synonym
@@ -584,6 +597,7 @@ class RankFilter(admin.SimpleListFilter):
 
 
 class DistributionAdmin(_Base):
+    catalog_scope = catalog.DISTRIBUTION
     list_display = ('scientific_name', 'state', 'county', 'present',
         'native', 'map_link',)
     list_editable = ('present', 'native',)
@@ -668,6 +682,7 @@ class DistributionAdmin(_Base):
                         county=county, present=present, native=native)
                     record.save()
                     records_created += 1
+            catalog.bump(catalog.DISTRIBUTION)
             # Return to the list page with a message to display.
             message = ('Added %d Distribution records for %s.' %
                 (records_created, scientific_name))
@@ -697,6 +712,7 @@ class DistributionAdmin(_Base):
                 for record in queryset:
                     record.scientific_name = new_scientific_name
                     record.save()
+                catalog.bump(catalog.DISTRIBUTION)
 
                 message = ('Successfully renamed %d records to %s.' % (
                     number_of_records, new_scientific_name))
@@ -752,10 +768,10 @@ class HighlightAdmin(_Base):
 
 # Registrations
 
-admin.site.register(models.Parameter)
-admin.site.register(models.ImageType)
-admin.site.register(models.CharacterGroup)
-admin.site.register(models.SourceCitation)
+admin.site.register(models.Parameter, _Base)
+admin.site.register(models.ImageType, _Base)
+admin.site.register(models.CharacterGroup, _Base)
+admin.site.register(models.SourceCitation, _Base)
 admin.site.register(models.Update, UpdateAdmin)
 admin.site.register(models.Highlight, HighlightAdmin)
 
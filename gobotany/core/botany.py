@@ -1,6 +1,6 @@
 """A Python API for complex operations designed for exposure through REST."""
 
-from gobotany.core import models
+from gobotany.core import matrix, models
 
 
 CHAR_MAP = {
@@ -46,6 +46,7 @@ class SpeciesReader(object):
                 scientific_name__iexact=scientific_name)
         else:
             base_query = models.Taxon.objects
+            character_predicates = []
             for k, v in list(kw.items()):
                 if k == 'pilegroup':
                     base_query = base_query.filter(piles__pilegroup__slug=v)
@@ -56,20 +57,18 @@ class SpeciesReader(object):
                 elif k == 'genus':
                     base_query = base_query.filter(genus__name=v)
                 else:
-                    character = models.Character.objects.get(short_name=k)
-
-                    if character.value_type == 'LENGTH':
-                        base_query = base_query.filter(
-                            character_values__character=character,
-                            character_values__value_min__lte=float(v),
-                            character_values__value_max__gte=float(v),
-                            )
-
-                    else: # assume type 'TEXT'
-                        base_query = base_query.filter(
-                            character_values__character=character,
-                            character_values__value_str=v)
-
+                    character_predicates.append((k, v))
+
+            # Character filters are answered all together from the
+            # in-memory matrices, so that the database only has to
+            # fetch the final matching species instead of self-joining
+            # the taxon character value table once per filter.
+
+            if character_predicates:
+                species_ids = matrix.species_matching(character_predicates)
+                if not species_ids:
+                    return base_query.none()
+                base_query = base_query.filter(id__in=species_ids)
 
             return base_query
 
@@ -0,0 +1,176 @@
+"""The version of the plant catalog, for cache keys and ETags.
+
+Most of what the API serves only changes when somebody runs an import
+or a rebuild, or saves a change in the editor or the admin.  Each of
+those calls `bump()` once it has finished, and anything that caches
+catalog data can include `data_version()` in its cache key or ETag and
+keep its entry until precisely the moment that the data changes.
+
+Since an edit to one pile's character values, or to one plant's
+distribution records, should not throw away every cache in every
+process, the version is kept as several counters, one per scope:
+
+''             bumped by imports and rebuilds, which can change anything
+CATALOG        bumped by admin saves, except of distribution records
+DISTRIBUTION   bumped by admin saves of distribution records
+pile:<id>      bumped by editor saves of a pile's character values
+
+`data_version(*scopes)` is the sum of the '' counter and the counters
+of the scopes named, so a cache that depends on only some of the data
+can ignore bumps to the rest.  With no scopes it is the sum of every
+counter, which changes whenever anything at all does.
+
+Reading the version has to be cheap, since it happens on nearly every
+API request: each process remembers the counters for a few seconds, and
+then asks memcache (if configured) or the database for them again.
+
+A cache that is expensive to rebuild can instead be brought up to date
+piece by piece.  Whoever changes a piece of a scope names it with
+`note_change()`, which memcache remembers under the generation that the
+scope's next bump will produce, and `changes()` later returns every
+piece named between two generations, or None if it cannot be sure that
+it knows them all, in which case the cache must be rebuilt.
+
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.utils import timezone
+
+from gobotany.core import models
+
+CACHE_KEY = 'catalog-versions'
+CHECK_INTERVAL = 5  # seconds that a process trusts its remembered version
+CHANGES_KEPT = 24 * 60 * 60  # seconds that memcache keeps noted changes
+
+CATALOG = 'catalog'
+DISTRIBUTION = 'distribution'
+
+_version = {'generations': None, 'checked': 0.0}
+
+
+def pile_scope(pile_id):
+    """Return the scope of the character values of a pile, by ID."""
+    return 'pile:%s' % pile_id
+
+
+def _shared_cache():
+    if 'memcache' in settings.CACHES['default']['BACKEND']:
+        return caches['default']
+    return None
+
+
+def _read_generations():
+    return dict(models.CatalogVersion.objects
+                .values_list('scope', 'generation'))
+
+
+def _remember(generations):
+    _version['generations'] = generations
+    _version['checked'] = time.time()
+
+
+def _sum(generations, scopes):
+    if not scopes:
+        return sum(generations.values())
+    return generations.get('', 0) + sum(
+        generations.get(scope, 0) for scope in scopes)
+
+
+def generations():
+    """Return the current generation of each scope, as a {scope:
+    integer} dictionary that the caller must not change."""
+    generations = _version['generations']
+    if generations is not None and (
+            time.time() - _version['checked'] < CHECK_INTERVAL):
+        return generations
+
+    cache = _shared_cache()
+    generations = None if cache is None else cache.get(CACHE_KEY)
+    if generations is None:
+        generations = _read_generations()
+        if cache is not None:
+            cache.set(CACHE_KEY, generations, None)
+    _remember(generations)
+    return generations
+
+
+def data_version(*scopes):
+    """Return the current catalog generation of `scopes` (or of the
+    whole catalog, if none are named), as an integer."""
+    return _sum(generations(), scopes)
+
+
+def clear():
+    """Forget the remembered version, so the next call reads it again."""
+    _version['generations'] = None
+
+
+def read_version(*scopes):
+    """Return the catalog generation of `scopes` as the database has it
+    right now, for a caller that is about to read catalog data which
+    must match the version it reports."""
+    generations = _read_generations()
+    _remember(generations)
+    return _sum(generations, scopes)
+
+
+def bump(*scopes):
+    """Record that the catalog data in `scopes` has changed (or, if no
+    scopes are named, that anything might have), and return the new
+    version of those scopes."""
+    for scope in scopes or ('',):
+        updated = models.CatalogVersion.objects.filter(scope=scope).update(
+            generation=F('generation') + 1, updated=timezone.now())
+        if not updated:
+            models.CatalogVersion(scope=scope, generation=1).save()
+    generations = _read_generations()
+
+    cache = _shared_cache()
+    if cache is not None:
+        cache.set(CACHE_KEY, generations, None)
+    _remember(generations)
+    return _sum(generations, scopes)
+
+
+def _changes_key(scope, generation):
+    return 'catalog-changes:%s:%d' % (scope, generation)
+
+
+def note_change(scope, name):
+    """Record that the piece `name` of `scope` has changed, so that the
+    next bump of `scope` can be caught up with through `changes()`."""
+    cache = _shared_cache()
+    if cache is None:
+        return
+    generation = _read_generations().get(scope, 0) + 1
+    key = _changes_key(scope, generation)
+    cache.add(key, 0, CHANGES_KEPT)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        return  # evicted already; changes() will report None
+    cache.set('%s:%d' % (key, count), name, CHANGES_KEPT)
+
+
+def changes(scope, old, new):
+    """Return the set of names noted as changed in `scope` between the
+    generations {scope: generation} dictionaries `old` and `new`, or
+    None if anything else might have changed too."""
+    cache = _shared_cache()
+    if cache is None or old.get('', 0) != new.get('', 0):
+        return None
+    names = set()
+    for generation in range(old.get(scope, 0) + 1, new.get(scope, 0) + 1):
+        key = _changes_key(scope, generation)
+        count = cache.get(key)
+        if count is None:
+            return None
+        keys = ['%s:%d' % (key, n) for n in range(1, count + 1)]
+        noted = cache.get_many(keys)
+        if len(noted) < count:
+            return None  # evicted, or still being written
+        names.update(noted.values())
+    return names
@@ -1,8 +1,11 @@
 from gobotany import settings
+from gobotany.core import catalog
 
 def gobotany_specific_context(request):
     context_extras = {
         'in_production': settings.IN_PRODUCTION,
         'dev_features': settings.DEV_FEATURES,
+        # Lets pages fetch the glossary from its immutable URL.
+        'glossary_version': catalog.data_version(catalog.CATALOG),
         }
     return context_extras
@@ -0,0 +1,172 @@
+"""Each plant's distribution, kept in memory as a compact vector.
+
+Maps, species pages, and the species list all need to know where a
+plant has been recorded, and asking the database means an OR query with
+a LIKE clause against a table that has a row for nearly every state and
+county for every plant.  Instead, each process reads the whole table
+once per version of the distribution data, and keeps for each binomial
+a byte string with one code for each place in `DISTRIBUTION_PLACES`.
+A code is the OR of the kinds of record found for that place, among
+those for the species itself and those for its subspecies and
+varieties:
+
+ABSENT       a record says that the plant is absent
+NON_NATIVE   a record says that the plant is present but not native
+NATIVE       a record says that the plant is present and native
+
+Saving or deleting a Distribution record rebuilds its plant's vector in
+the process that saved it, and notes the plant's name as a change to the
+DISTRIBUTION scope (see catalog.py).  Once that scope is bumped, other
+processes rebuild the vectors of just the plants noted since they last
+looked, or the whole store if the notes are incomplete or anything else
+has been bumped, like after an import.  A plant
+with a record for a place that is missing from `DISTRIBUTION_PLACES`
+has no vector, and neither does a name that is not a binomial: callers
+must then ask the database.
+
+"""
+from collections import namedtuple
+
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from gobotany.core import catalog
+from gobotany.core.distribution_places import DISTRIBUTION_PLACES
+from gobotany.core.models import Distribution
+
+ABSENT, NON_NATIVE, NATIVE = 1, 2, 4
+
+# How each code bit is turned back into a record: (bit, present, native).
+_RECORDS = ((ABSENT, False, False), (NON_NATIVE, True, False),
+            (NATIVE, True, True))
+
+FIELDS = ('scientific_name', 'state', 'county', 'present', 'native')
+PLACE_INDEX = {place: i for i, place in enumerate(DISTRIBUTION_PLACES)}
+EMPTY = bytes(len(DISTRIBUTION_PLACES))
+
+Record = namedtuple('Record', 'state county present native')
+
+_store = {
+    'generations': None,  # catalog generations the store was built from
+    'vectors': {},        # binomial -> bytes
+    'irregular': set(),   # binomials with records outside the places
+    }
+
+
+HYBRID_SIGNS = ('x', 'X', '×')
+
+
+def binomial(scientific_name):
+    """Return the binomial under which a record's plant is stored: its
+    first two words, or three for a hybrid like "Genus x epithet"."""
+    words = scientific_name.split(' ')
+    if len(words) > 2 and words[1] in HYBRID_SIGNS:
+        return ' '.join(words[:3])
+    return ' '.join(words[:2])
+
+
+def _add(vectors, irregular, scientific_name, state, county, present,
+         native):
+    """Add one record's code to the bytearray vectors in `vectors`."""
+    name = binomial(scientific_name)
+    i = PLACE_INDEX.get((state, county))
+    if i is None:
+        irregular.add(name)
+        return
+    vector = vectors.get(name)
+    if vector is None:
+        vector = vectors[name] = bytearray(EMPTY)
+    vector[i] |= (NATIVE if native else NON_NATIVE) if present else ABSENT
+
+
+def _build(rows):
+    vectors, irregular = {}, set()
+    for row in rows:
+        _add(vectors, irregular, *row)
+    return {name: bytes(v) for name, v in vectors.items()}, irregular
+
+
+def _current_store():
+    old = _store['generations']
+    new = catalog.generations()
+    if old is None or any(old.get(scope, 0) != new.get(scope, 0)
+                          for scope in ('', catalog.DISTRIBUTION)):
+        names = None if old is None else catalog.changes(
+            catalog.DISTRIBUTION, old, new)
+        if names is None:
+            rows = Distribution.objects.order_by().values_list(*FIELDS)
+            _store['vectors'], _store['irregular'] = _build(rows.iterator())
+        else:
+            for name in names:
+                refresh(name)
+        _store['generations'] = new
+    return _store
+
+
+def clear():
+    """Forget every vector, so the next lookup reads the whole table."""
+    _store['generations'] = None
+
+
+def refresh(name):
+    """Rebuild the vector of the binomial `name` from the database."""
+    if _store['generations'] is None:
+        return
+    rows = (Distribution.objects.all_records_for_plant(name)
+            .order_by().values_list(*FIELDS))
+    vectors, irregular = _build(
+        row for row in rows if binomial(row[0]) == name)
+    _store['vectors'].pop(name, None)
+    _store['vectors'].update(vectors)
+    _store['irregular'].discard(name)
+    _store['irregular'].update(irregular)
+
+
+def vector(scientific_name):
+    """Return the distribution vector of a plant, or None if the plant
+    does not have one and the database must be asked instead."""
+    if (binomial(scientific_name) != scientific_name
+            or scientific_name.split(' ')[-1] in HYBRID_SIGNS):
+        return None  # "Genus x" would also match every hybrid
+    store = _current_store()
+    if scientific_name in store['irregular']:
+        return None
+    return store['vectors'].get(scientific_name, EMPTY)
+
+
+def records(scientific_name):
+    """Return the plant's distribution as a list of Records, with one
+    record for each kind of record found for each place, or None if the
+    plant has no vector."""
+    codes = vector(scientific_name)
+    if codes is None:
+        return None
+    return [Record(state, county, present, native)
+            for (state, county), code in zip(DISTRIBUTION_PLACES, codes)
+            if code
+            for bit, present, native in _RECORDS
+            if code & bit]
+
+
+@receiver(post_init, sender=Distribution,
+          dispatch_uid='distribution_vector_loaded')
+def _distribution_loaded(sender, instance, **kw):
+    """Remember the plant that a record belonged to when it was loaded,
+    since renaming the record changes that plant's vector too."""
+    name = instance.__dict__.get('scientific_name')
+    instance._loaded_binomial = None if name is None else binomial(name)
+
+
+@receiver(post_save, sender=Distribution,
+          dispatch_uid='distribution_vector_saved')
+@receiver(post_delete, sender=Distribution,
+          dispatch_uid='distribution_vector_deleted')
+def _distribution_changed(sender, instance, **kw):
+    """Rebuild the vector of a plant as soon as this process edits it,
+    and note the change for the other processes."""
+    name = binomial(instance.scientific_name)
+    for changed in {name, getattr(instance, '_loaded_binomial', None)}:
+        if changed is not None:
+            refresh(changed)
+            catalog.note_change(catalog.DISTRIBUTION, changed)
+    instance._loaded_binomial = name
@@ -0,0 +1,159 @@
+"""JSON encoding for every response that Go Botany sends.
+
+All of our JSON goes through `dumps()`, `encode()`, or `iter_json()`,
+which use the native ``orjson`` encoder when it is installed and fall
+back to the standard library's ``json`` module otherwise.  Both encoders
+write the same compact layout, with no spaces and with non-ASCII text
+left unescaped, so a document comes out byte for byte the same whether
+or not a process has orjson, and its ETag does too.  The three
+functions also agree on every byte, so that a streamed response matches
+the same document encoded all at once.
+
+Output that asks for indentation, as the API does when DEBUG is set, is
+always produced by the standard library, since orjson cannot indent by
+anything other than two spaces.
+
+A `Fragment` holds JSON that has already been encoded, and is copied
+verbatim into any document that contains it.  Sub-objects that stay the
+same from one response to the next, like the description of an image,
+can thus be built and encoded only once.
+
+"""
+import json
+import re
+import uuid
+from types import GeneratorType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ITEM_SEPARATOR, KEY_SEPARATOR = ',', ':'
+
+if orjson is None:
+    NATIVE = None
+else:
+    NATIVE = 'orjson'
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+class Fragment(object):
+    """A piece of JSON text, to be copied verbatim into a document."""
+
+    __slots__ = ('json',)
+
+    def __init__(self, json):
+        self.json = json
+
+    @classmethod
+    def of(cls, value):
+        """Return a Fragment holding the JSON encoding of `value`."""
+        return cls(dumps(value))
+
+
+# While a document is encoded, each Fragment is swapped for a string
+# that cannot occur in real data, and that is then replaced with the
+# fragment's own text.
+
+_PLACEHOLDER_PREFIX = 'gobotany-fragment-%s-' % uuid.uuid4().hex
+_PLACEHOLDER = _PLACEHOLDER_PREFIX + '%d'
+_PLACEHOLDER_RE = re.compile(r'"%s(\d+)"' % _PLACEHOLDER_PREFIX)
+
+
+def _dumps(value, indent, default):
+    if indent is None:
+        if orjson is not None:
+            try:
+                return orjson.dumps(value, default=default,
+                                    option=_ORJSON_OPTIONS).decode('utf-8')
+            except orjson.JSONEncodeError:
+                pass  # like integers wider than 64 bits
+        return json.dumps(value, default=default, ensure_ascii=False,
+                          separators=(ITEM_SEPARATOR, KEY_SEPARATOR))
+    return json.dumps(value, indent=indent, default=default)
+
+
+def dumps(value, indent=None):
+    """Return the JSON encoding of `value`, as a string."""
+    fragments = []
+
+    def default(obj):
+        if isinstance(obj, Fragment):
+            fragments.append(obj.json)
+            return _PLACEHOLDER % (len(fragments) - 1)
+        raise TypeError('%r is not JSON serializable' % (obj,))
+
+    text = _dumps(value, indent, default)
+    if fragments:
+        text = _PLACEHOLDER_RE.sub(
+            lambda match: fragments[int(match.group(1))], text)
+    return text
+
+
+def encode(value, indent=None):
+    """Return the JSON encoding of `value`, as UTF-8 bytes."""
+    return dumps(value, indent).encode('utf-8')
+
+
+def _json_key(key):
+    """Convert a dictionary key to a string the way json.dumps() does."""
+    if isinstance(key, str):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, (int, float)):
+        return dumps(key)
+    raise TypeError('keys must be a string, not %r' % (key,))
+
+
+def iter_json(value, indent=None, level=0):
+    """Yield the JSON for `value` in pieces, exactly as dumps() formats it.
+
+    Dictionaries and lists are written out one item at a time, and any
+    generator is written out as a list, so that a large listing can be
+    serialized while its items are still being produced.
+    """
+    if isinstance(value, dict):
+        items = iter(value.items())
+        opener, closer = '{', '}'
+    elif isinstance(value, (list, tuple, GeneratorType)):
+        items = iter(value)
+        opener, closer = '[', ']'
+    elif isinstance(value, Fragment):
+        yield value.json
+        return
+    else:
+        yield dumps(value, indent)
+        return
+
+    if indent is None:
+        separator = ITEM_SEPARATOR
+        key_separator = KEY_SEPARATOR
+        newline = closing = ''
+    else:
+        if not isinstance(indent, str):
+            indent = ' ' * indent
+        newline = '\n' + indent * (level + 1)
+        closing = '\n' + indent * level
+        separator = ',' + newline
+        key_separator = ': '
+
+    prefix = opener + newline
+    empty = True
+    for item in items:
+        if opener == '{':
+            key, item = item
+            yield prefix + dumps(_json_key(key), indent) + key_separator
+        else:
+            yield prefix
+        for piece in iter_json(item, indent, level + 1):
+            yield piece
+        prefix = separator
+        empty = False
+
+    yield opener + closer if empty else closing + closer
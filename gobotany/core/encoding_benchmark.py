@@ -0,0 +1,118 @@
+"""Time how long each API endpoint's JSON takes to encode.
+
+Run this with ``python -m gobotany.core.encoding_benchmark``.  It needs
+neither Django nor a database: each payload is synthetic, but has the
+shape and roughly the size of what the named endpoint returns for one
+of our larger piles.  Three encoders are compared:
+
+stdlib       json.dumps(), which is what every endpoint used to call
+native       encoding.dumps(), with orjson if it is installed
+fragments    encoding.dumps(), with each image already a Fragment
+
+Each timing includes building the payload, as the view would.
+
+"""
+import json
+import random
+import sys
+import timeit
+
+from gobotany.core import encoding
+
+SPECIES = 600
+IMAGES_PER_SPECIES = 4
+CHARACTERS = 120
+VALUES_PER_CHARACTER = 6
+
+
+def _image(i):
+    path = 'taxon-images/Genus/genus-epithet-ha-photographer-%d.jpg' % i
+    return {
+        'url': 'https://example.org/' + path,
+        'type': 'habit',
+        'rank': i % 10 + 1,
+        'title': 'Genus epithet: habit %d' % i,
+        'thumb_url': 'https://example.org/160x149/' + path,
+        'large_thumb_url': 'https://example.org/239x239/' + path,
+        }
+
+
+def _species(n, image):
+    return [{
+        'id': i,
+        'scientific_name': 'Genus epithet%d' % i,
+        'common_name': 'common plant %d' % i,
+        'genus': 'Genus',
+        'family': 'Familiaceae',
+        'taxonomic_authority': 'L.',
+        'url': '/species/genus/epithet%d/?pile=some-pile' % i,
+        'images': [image(i * IMAGES_PER_SPECIES + j)
+                   for j in range(IMAGES_PER_SPECIES)],
+        } for i in range(n)]
+
+
+def _pile_vector_set():
+    rng = random.Random(0)
+    return [{
+        'name': 'Character %d' % i,
+        'slug': 'character_%d' % i,
+        'group_name': 'Group %d' % (i % 12),
+        'values': [sorted(rng.sample(range(SPECIES), SPECIES // 5))
+                   for j in range(VALUES_PER_CHARACTER)],
+        } for i in range(CHARACTERS)]
+
+
+def payloads():
+    """Return (endpoint, build, build_with_fragments) tuples.
+
+    Both functions build the endpoint's payload the way its view does,
+    so the timings include making each image's dictionary, which only
+    has to be done once when the image is kept as a Fragment.
+
+    """
+    fragments = {}
+
+    def image_fragment(i):
+        fragment = fragments.get(i)
+        if fragment is None:
+            fragment = fragments[i] = encoding.Fragment.of(_image(i))
+        return fragment
+
+    def taxa(image):
+        return {'items': _species(SPECIES, image),
+                'label': 'scientific_name',
+                'identifier': 'scientific_name'}
+
+    vector_set = _pile_vector_set()
+    return [
+        ('/api/species/<pile>/', lambda: _species(SPECIES, _image),
+         lambda: _species(SPECIES, image_fragment)),
+        ('/api/taxa/', lambda: taxa(_image), lambda: taxa(image_fragment)),
+        ('/api/vectors/pile-set/<pile>/', lambda: vector_set,
+         lambda: vector_set),
+        ]
+
+
+def best_time(function, number=20, repeat=5):
+    """Return the best time, in milliseconds, for one call of function."""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) \
+        / number * 1000.0
+
+
+def main():
+    print('Native encoder: %s' % (encoding.NATIVE or 'none installed'))
+    print()
+    print('%-32s %10s %10s %10s %8s' % (
+        'endpoint', 'stdlib ms', 'native ms', 'fragments', 'speedup'))
+    for endpoint, build, build_with_fragments in payloads():
+        stdlib = best_time(lambda: json.dumps(build()))
+        native = best_time(lambda: encoding.dumps(build()))
+        fragments = best_time(
+            lambda: encoding.dumps(build_with_fragments()))
+        print('%-32s %10.2f %10.2f %10.2f %7.1fx' % (
+            endpoint, stdlib, native, fragments,
+            stdlib / min(native, fragments)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
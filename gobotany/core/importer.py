@@ -27,7 +27,7 @@ from django.template.defaultfilters import slugify
 
 import bulkup
 import gobotany.dkey.import_csv
-from gobotany.core import models
+from gobotany.core import catalog, distribution_vectors, models
 from gobotany.core.pile_suffixes import pile_suffixes
 from gobotany.search.models import (GroupsListPage, PlainPage,
                                     SubgroupResultsPage, SubgroupsListPage)
@@ -1107,6 +1107,7 @@ class Importer(object):
                 lay_definition=row['definition'],
                 visible=True,
                 highlight=row['is_highlighted'],
+                plural=models.GlossaryTerm.plural_of(row['term']),
                 )
 
         glossaryterm_table.save()
@@ -1703,6 +1704,7 @@ class Importer(object):
                                           status_column_name)
 
         distribution.save()
+        distribution_vectors.clear()  # bulk saves send no signals
 
 
     def import_videos(self, db, videofilename):
@@ -2193,6 +2195,7 @@ full_import_steps = (
     (import_partner_species, '!partner', 'partersite-sample-species-lists.xls'),
     (rebuild.rebuild_default_filters, 'characters.csv'),
     (rebuild.rebuild_plant_of_the_day, '!SIMPLEKEY'),
+    (rebuild.rebuild_question_trees,),
 
     (gobotany.dkey.import_csv.import_illustrative_species,
      'dkey_illustrative_species.csv'),
@@ -2369,6 +2372,7 @@ def zipimport(name):
             for arg in args:
                 if hasattr(arg, 'close'):
                     arg.close()
+        catalog.bump()
 
 # Utilities.
 
@@ -2495,6 +2499,7 @@ def main():
 
     wrapped_function = transaction.atomic(function)
     wrapped_function(*function_args)
+    catalog.bump()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,379 @@
+"""An in-memory index of which species have which character values.
+
+Every Simple Key query - which species match these filters, how many
+answers are still available for a question, which character would best
+split the remaining species - boils down to the same relationship
+between a pile's species and its character values.  Rather than
+rebuilding that relationship from ``core_taxoncharactervalue`` joins on
+every request, each process loads one `PileMatrix` per pile the first
+time it is needed, and answers later questions from memory.
+
+Each character value is stored as a bitset: a plain Python integer
+whose bit i is set if the species at position i of the matrix's sorted
+``species_ids`` list has that value.  Sets of species can then be
+intersected and counted with ordinary integer operations.
+
+Characters that belong to no pile (like "habitat") live together in the
+matrix whose pile ID is None.
+
+"""
+import hashlib
+import math
+from bisect import bisect_left
+from collections import namedtuple
+
+from django.db import connection
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from gobotany.core import catalog, models
+
+CharacterInfo = namedtuple('CharacterInfo', [
+    'id', 'short_name', 'value_type', 'character_group_id',
+    'ease_of_observability', 'value_ids',
+    ])
+
+ValueInfo = namedtuple('ValueInfo', [
+    'id', 'character_id', 'value_str', 'value_min', 'value_max',
+    ])
+
+
+def popcount(bits):
+    """Return the number of species in the bitset `bits`."""
+    return bin(bits).count('1')
+
+
+class LengthIndex(object):
+    """A sorted-endpoint index over the ranges of a LENGTH character.
+
+    The distinct endpoints of the character's ranges cut the number line
+    into elementary segments: each endpoint is a segment of its own, as
+    is each open gap between neighbouring endpoints, and the two gaps
+    beyond the smallest and largest endpoints.  Every segment is covered
+    by the same set of ranges all the way across, so the species that
+    accept a length - or that lie in a stretch of the line - can be
+    precomputed once per segment, and then found with a binary search.
+
+    `values` are objects with `value_min` and `value_max` attributes,
+    and `bits` maps each value's ID to its bitset of species; without
+    `bits`, the index only knows how many ranges cover each segment.
+
+    """
+    def __init__(self, values, bits=None):
+        ranges = [cv for cv in values
+                  if cv.value_min is not None and cv.value_max is not None
+                  and cv.value_min <= cv.value_max]
+        points = sorted(set(cv.value_min for cv in ranges)
+                        | set(cv.value_max for cv in ranges))
+        self.points = points
+        self.bits = [0] * (2 * len(points) + 1)     # segment -> species
+        self.weights = [0] * (2 * len(points) + 1)  # segment -> ranges
+
+        for cv in ranges:
+            first = self.segment(cv.value_min)
+            last = self.segment(cv.value_max)
+            value_bits = 0 if bits is None else bits[cv.id]
+            for i in range(first, last + 1):
+                self.bits[i] |= value_bits
+                self.weights[i] += 1
+
+    def segment(self, v):
+        """Return the number of the segment holding the length `v`."""
+        i = bisect_left(self.points, v)
+        if i < len(self.points) and self.points[i] == v:
+            return 2 * i + 1
+        return 2 * i
+
+    def matching(self, v):
+        """Return the bitset of species with a range that includes `v`."""
+        return self.bits[self.segment(v)]
+
+    def ranges(self, species_bits):
+        """Return the (min, max, count) stretches of the line that some
+        of the species in `species_bits` accept, smallest first.
+
+        Each stretch begins and ends at an endpoint, since a species in
+        a gap has a range that covers the endpoints on either side.
+        """
+        points = self.points
+        result = []
+        start = union = None
+        for i, bits in enumerate(self.bits):
+            bits &= species_bits
+            if bits:
+                if start is None:
+                    start, union = i, 0
+                union |= bits
+            elif start is not None:
+                result.append((points[start // 2], points[(i - 2) // 2],
+                               popcount(union)))
+                start = None
+        return result
+
+    def entropy(self):
+        """Return the tally that treats each length as its own value.
+
+        Each gap between endpoints is weighted by its width and by the
+        number of ranges that cover it; see igdt._length_entropy().
+        """
+        points = self.points
+        if len(points) < 2:
+            return 0.0
+        tally = 0.0
+        for i in range(1, len(points)):
+            weight = self.weights[2 * i]  # the gap left of points[i]
+            if weight:
+                tally += ((points[i] - points[i - 1])
+                          * weight * math.log(weight, 2.))
+        return tally / (points[-1] - points[0])
+
+
+class PileMatrix(object):
+    """A species-by-character-value bitset matrix for a single pile."""
+
+    def __init__(self, pile_id):
+        self.pile_id = pile_id
+        self.species_ids = []  # sorted; position = bit number
+        self.index = {}        # species ID -> bit number
+        self.characters = {}   # character ID -> CharacterInfo
+        self.short_names = {}  # short name -> CharacterInfo
+        self.values = {}       # character value ID -> ValueInfo
+        self.bits = {}         # character value ID -> bitset of species
+        self.all = 0           # bitset with every species in the matrix
+        self.lengths = {}      # character ID -> LengthIndex
+        self.derived = {}      # structures that other modules precompute
+        self.digest = ''       # fingerprint of everything loaded
+
+    def load(self):
+        """Fill the matrix with four queries against the database."""
+        cursor = connection.cursor()
+        if self.pile_id is None:
+            where, params = 'c.pile_id IS NULL', []
+        else:
+            where, params = 'c.pile_id = %s', [self.pile_id]
+
+        cursor.execute("""
+            SELECT c.id, c.short_name, c.value_type, c.character_group_id,
+                c.ease_of_observability
+              FROM core_character c
+              WHERE """ + where, params)
+        for row in cursor.fetchall():
+            character = CharacterInfo(*row, value_ids=[])
+            self.characters[character.id] = character
+            self.short_names[character.short_name] = character
+
+        cursor.execute("""
+            SELECT cv.id, cv.character_id, cv.value_str,
+                cv.value_min, cv.value_max
+              FROM core_charactervalue cv
+              JOIN core_character c ON (c.id = cv.character_id)
+              WHERE """ + where + """
+              ORDER BY cv.id""", params)
+        for row in cursor.fetchall():
+            value = ValueInfo(*row)
+            self.values[value.id] = value
+            self.characters[value.character_id].value_ids.append(value.id)
+
+        cursor.execute("""
+            SELECT tcv.character_value_id, tcv.taxon_id
+              FROM core_taxoncharactervalue tcv
+              JOIN core_charactervalue cv ON (cv.id = tcv.character_value_id)
+              JOIN core_character c ON (c.id = cv.character_id)
+              WHERE """ + where, params)
+        pairs = cursor.fetchall()
+
+        species_ids = set(taxon_id for cv_id, taxon_id in pairs)
+        if self.pile_id is not None:
+            cursor.execute("""
+                SELECT taxon_id FROM core_pile_species WHERE pile_id = %s
+                """, [self.pile_id])
+            species_ids.update(taxon_id for (taxon_id,) in cursor.fetchall())
+
+        self.species_ids = sorted(species_ids)
+        self.index = {taxon_id: i for i, taxon_id
+                      in enumerate(self.species_ids)}
+        self.all = (1 << len(self.species_ids)) - 1
+
+        bits = dict.fromkeys(self.values, 0)
+        index = self.index
+        for cv_id, taxon_id in pairs:
+            bits[cv_id] |= 1 << index[taxon_id]
+        self.bits = bits
+
+        # A digest of the data lets caches that are shared between
+        # processes tell whether they were computed from this data.
+        h = hashlib.md5()
+        h.update(repr(sorted(self.characters.items())).encode('utf-8'))
+        h.update(repr(sorted(self.values.items())).encode('utf-8'))
+        h.update(repr(self.species_ids).encode('utf-8'))
+        for cv_id in sorted(bits):
+            h.update(('%d:%x;' % (cv_id, bits[cv_id])).encode('ascii'))
+        self.digest = h.hexdigest()
+        return self
+
+    # Converting between species and bitsets.
+
+    def mask(self, species):
+        """Return the bitset for `species`, given as IDs or Taxon objects.
+
+        Species that the matrix does not know about are ignored, since
+        they have none of the pile's character values anyway.
+
+        """
+        index = self.index
+        bits = 0
+        for taxon in species:
+            i = index.get(int(getattr(taxon, 'id', taxon)))
+            if i is not None:
+                bits |= 1 << i
+        return bits
+
+    def species(self, bits):
+        """Return the sorted list of species IDs in the bitset `bits`."""
+        species_ids = self.species_ids
+        digits = bin(bits)[:1:-1]  # least significant bit first
+        return [species_ids[i] for i, digit in enumerate(digits)
+                if digit == '1']
+
+    # Questions about characters.
+
+    def character(self, short_name):
+        """Return the CharacterInfo for `short_name`."""
+        character = self.short_names.get(short_name)
+        if character is None:
+            raise models.Character.DoesNotExist(
+                'Character %r is not in this matrix' % (short_name,))
+        return character
+
+    def matching(self, short_name, value):
+        """Return the species with a character value matching `value`.
+
+        A LENGTH character matches every range that includes `value`,
+        while any other character must match the string exactly.
+
+        """
+        character = self.character(short_name)
+        if character.value_type == 'LENGTH':
+            return self.length_index(character).matching(float(value))
+        values = self.values
+        bits = 0
+        for cv_id in character.value_ids:
+            if values[cv_id].value_str == value:
+                bits |= self.bits[cv_id]
+        return bits
+
+    def length_index(self, character):
+        """Return the LengthIndex for a LENGTH character's ranges."""
+        index = self.lengths.get(character.id)
+        if index is None:
+            index = self.lengths[character.id] = LengthIndex(
+                [self.values[cv_id] for cv_id in character.value_ids],
+                self.bits)
+        return index
+
+    def answer_counts(self, bits):
+        """Return a {short_name: count} dict of how many distinct answers
+        each character still offers for the species in `bits`."""
+        values = self.values
+        value_bits = self.bits
+        counts = {}
+        for character in self.characters.values():
+            counts[character.short_name] = len(set(
+                values[cv_id].value_str for cv_id in character.value_ids
+                if value_bits[cv_id] & bits))
+        return counts
+
+    def value_counts(self, character, bits):
+        """Return a {value_id: count} dict of how many of `bits` have each
+        of the character's values."""
+        return {cv_id: popcount(self.bits[cv_id] & bits)
+                for cv_id in character.value_ids}
+
+
+# A process-wide cache of matrices, keyed by pile ID, where each matrix
+# is thrown away once the catalog data version of its pile changes.
+
+_matrices = {}  # pile ID -> (catalog data version, PileMatrix)
+_character_piles = {}  # short name -> pile ID
+_loaded_version = [None]  # catalog data version of _character_piles
+
+
+def get_matrix(pile):
+    """Return the PileMatrix for `pile`, which may be a Pile, ID, or None."""
+    pile_id = getattr(pile, 'id', pile)
+    version = catalog.data_version(catalog.CATALOG,
+                                   catalog.pile_scope(pile_id))
+    entry = _matrices.get(pile_id)
+    if entry is None or entry[0] != version:
+        entry = _matrices[pile_id] = (version, PileMatrix(pile_id).load())
+    return entry[1]
+
+
+def matrix_for_character(short_name):
+    """Return the PileMatrix holding the character named `short_name`."""
+    version = catalog.data_version(catalog.CATALOG)
+    if _loaded_version[0] != version:
+        _character_piles.clear()
+        _loaded_version[0] = version
+    if not _character_piles:
+        _character_piles.update(
+            models.Character.objects.values_list('short_name', 'pile_id'))
+    try:
+        pile_id = _character_piles[short_name]
+    except KeyError:
+        raise models.Character.DoesNotExist(
+            'Character matching query does not exist: %r' % (short_name,))
+    return get_matrix(pile_id)
+
+
+def species_matching(predicates):
+    """Return the sorted IDs of species matching every predicate.
+
+    Each predicate is a (short_name, value) pair.  Predicates on the
+    same pile are intersected as bitsets within that pile's matrix, and
+    only then are the per-matrix results turned into sets of species
+    IDs and intersected, smallest first.
+
+    """
+    matrices = {}
+    bitsets = {}
+    for short_name, value in predicates:
+        pile_matrix = matrix_for_character(short_name)
+        pile_id = pile_matrix.pile_id
+        matrices[pile_id] = pile_matrix
+        bits = bitsets.get(pile_id, pile_matrix.all)
+        bitsets[pile_id] = bits & pile_matrix.matching(short_name, value)
+
+    if not bitsets or not all(bitsets.values()):
+        return []
+    id_sets = sorted((matrices[pile_id].species(bits)
+                      for pile_id, bits in bitsets.items()), key=len)
+    species_ids = set(id_sets[0])
+    for other_ids in id_sets[1:]:
+        species_ids.intersection_update(other_ids)
+    return sorted(species_ids)
+
+
+def clear():
+    """Forget every matrix, so that each gets reloaded when next needed."""
+    _matrices.clear()
+    _character_piles.clear()
+
+
+@receiver(post_save, sender=models.Character,
+          dispatch_uid='matrix_character_saved')
+@receiver(post_delete, sender=models.Character,
+          dispatch_uid='matrix_character_deleted')
+@receiver(post_save, sender=models.CharacterValue,
+          dispatch_uid='matrix_value_saved')
+@receiver(post_delete, sender=models.CharacterValue,
+          dispatch_uid='matrix_value_deleted')
+@receiver(post_save, sender=models.TaxonCharacterValue,
+          dispatch_uid='matrix_tcv_saved')
+@receiver(post_delete, sender=models.TaxonCharacterValue,
+          dispatch_uid='matrix_tcv_deleted')
+@receiver(m2m_changed, sender=models.Pile.species.through,
+          dispatch_uid='matrix_pile_species_changed')
+def _data_changed(sender, **kw):
+    """Editor and admin saves invalidate this process's matrices."""
+    clear()
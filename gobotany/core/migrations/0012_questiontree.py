@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_auto_20190816_1432'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionTree',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_digest', models.CharField(max_length=32)),
+                ('weights', models.CharField(max_length=100)),
+                ('rankings', models.TextField()),
+                ('pile', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='question_tree', to='core.Pile')),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_catalogversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='glossaryterm',
+            name='plural',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
@@ -5,6 +5,7 @@ from collections import defaultdict, OrderedDict
 from datetime import datetime
 
 import bleach
+import inflect
 
 from django.conf import settings
 from django.db import models
@@ -19,6 +20,8 @@ from django.template.defaultfilters import slugify
 
 from tinymce import models as tinymce_models
 
+inflector = inflect.engine()
+
 # Character short names common to all piles (no suffix)
 COMMON_CHARACTERS = ['habitat', 'habitat_general', 'state_distribution']
 
@@ -99,6 +102,9 @@ class GlossaryTerm(models.Model):
     image = models.ImageField(upload_to='glossary-images',
                               blank=True,
                               null=True)
+    # Highlighted in page text as well as the term itself; computed
+    # from the term when left blank.
+    plural = models.CharField(max_length=100, blank=True)
 
     class Meta:
         verbose_name = 'glossary term'
@@ -109,6 +115,25 @@ class GlossaryTerm(models.Model):
     def __str__(self):
         return '%s: %s' % (self.term, self.lay_definition)
 
+    @staticmethod
+    def plural_of(term):
+        """Return the English plural of `term`."""
+        return inflector.plural(term)
+
+    def save(self, *args, **kw):
+        """Set the plural if it isn't already set, or if the term has
+        changed but its plural has not been edited along with it"""
+        if self.pk is not None and self.plural:
+            old = (GlossaryTerm.objects.filter(pk=self.pk)
+                   .values_list('term', 'plural').first())
+            if old is not None:
+                old_term, old_plural = old
+                if old_term != self.term and old_plural == self.plural:
+                    self.plural = ''
+        if not self.plural:
+            self.plural = self.plural_of(self.term)
+        super(GlossaryTerm, self).save(*args, **kw)
+
 
 class Character(models.Model):
     """An object representing a botanic character.  A character is
@@ -715,10 +740,18 @@ class Taxon(models.Model):
         the presence or absence of the species, and, where applicable,
         any invasive status.
         """
+        # Imported here, because the store imports this module.
+        from gobotany.core import distribution_vectors
+
         states = [key.upper() for key in list(settings.STATE_NAMES.keys())]
-        distributions = Distribution.objects.all_records_for_plant(
-            self.scientific_name).filter(state__in=states).values_list(
-            'state', 'present')
+        records = distribution_vectors.records(self.scientific_name)
+        if records is None:
+            distributions = Distribution.objects.all_records_for_plant(
+                self.scientific_name).filter(state__in=states).values_list(
+                'state', 'present')
+        else:
+            distributions = [(record.state, record.present)
+                             for record in records if record.state in states]
         invasive_statuses = InvasiveStatus.objects.filter(
             taxon=self).values_list('region', 'invasive_in_region',
             'prohibited_from_sale')
@@ -923,6 +956,45 @@ class DefaultFilter(models.Model):
                                        self.character.friendly_name)
 
 
+class QuestionTree(models.Model):
+    """Best-question rankings compiled ahead of time for a pile.
+
+    The `rankings` field holds JSON, written by the "question_trees"
+    rebuild target, that maps the fingerprints of the species sets a
+    user is likely to reach in the Simple Key to the order in which the
+    pile's characters should be suggested as questions.  The tree is
+    only used while `data_digest` and `weights` still match the live
+    pile data and scoring parameters; see igdt.py.
+
+    """
+    pile = models.OneToOneField(Pile, related_name='question_tree')
+    data_digest = models.CharField(max_length=32)
+    weights = models.CharField(max_length=100)
+    rankings = models.TextField()
+
+    def __str__(self):
+        return 'Question tree for %s' % self.pile.name
+
+
+class CatalogVersion(models.Model):
+    """A counter that goes up every time the plant catalog is changed.
+
+    There is one row for each scope of the catalog (see catalog.py).
+    Imports, rebuilds, and saves in the editor and the admin bump its
+    `generation` through catalog.bump(), so that caches and ETags built
+    on catalog.data_version() can be kept until exactly the moment that
+    the data changes.
+
+    """
+    scope = models.CharField(max_length=40, unique=True, default='')
+    generation = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return 'Catalog generation %d%s' % (
+            self.generation, ' of %s' % self.scope if self.scope else '')
+
+
 # Call this PartnerSite instead of just Site in order to avoid confusion
 # with the Django "sites" framework.
 class PartnerSite(models.Model):
@@ -1,4 +1,5 @@
-from gobotany.core.models import (Character, Taxon, TaxonCharacterValue)
+from gobotany.core import matrix
+from gobotany.core.models import Character
 
 def _is_length(short_name):
     """Detect whether a filter is a numeric length filter."""
@@ -8,23 +9,6 @@ def _is_length(short_name):
             short_name.find('thickness') > -1 or
             short_name.find('diameter') > -1)
 
-def _number_of_answers(species_query_set, question_short_name):
-    """Return the number of answers for a question for the given species.
-    This has the effect of excluding answers that are no longer available
-    to the user, i.e. are disabled and grayed out.
-    """
-    species_ids = species_query_set.values_list('id', flat=True)
-    number_of_answers = 0
-    if not _is_length(question_short_name):
-        number_of_answers = TaxonCharacterValue.objects.filter(
-            character_value__character__short_name=question_short_name,
-            taxon__in=species_ids
-        ).values_list(
-            'character_value__value_str', flat=True
-        ).distinct().count()
-    return number_of_answers
-
-
 def get_questions(request, pile):
     """Returns a list of questions for a plant subgroup (pile).
     A possible replacement for using piles_characters for choosing
@@ -56,13 +40,20 @@ def get_questions(request, pile):
         )
 
     # Build a list of candidate questions to be checked in order.
-    candidate_questions = characters.values('character_group__id',
-        'short_name', 'friendly_name', 'ease_of_observability')
+    candidate_questions = list(characters.values('character_group__id',
+        'short_name', 'friendly_name', 'ease_of_observability'))
 
     # Get the species that represent the current filtering state.
     species_ids = request.GET.get('species_ids', '')
     species_ids = species_ids.split('_') if species_ids.strip() else ()
-    filtered_species = Taxon.objects.filter(id__in=species_ids)
+    pile_matrix = matrix.get_matrix(pile)
+    filtered_species = pile_matrix.mask(species_ids)
+
+    # Count the currently available answers of every character in one
+    # pass over the pile's matrix.  These are answers that appear on
+    # the page as enabled and selectable, with a non-zero count in
+    # parentheses.
+    answer_counts = pile_matrix.answer_counts(filtered_species)
 
     # Build a list of the specified number of best questions (or a default
     # number), in order of ease of observability.
@@ -74,12 +65,9 @@ def get_questions(request, pile):
             # Allow a length-filter question to go on as a "best" question.
             question['best'] = True
         else:
-            # For text-filter questions, get the number of currently
-            # available answers. These are answers that appear on the
-            # page as enabled and selectable, with a non-zero count in
-            # parentheses.
-            number_of_answers = _number_of_answers(filtered_species,
-                                                   short_name)
+            # For text-filter questions, look up the number of currently
+            # available answers.
+            number_of_answers = answer_counts.get(short_name, 0)
             # The question is marked "best" if it has more than one
             # currently available answer.
             question['best'] = (number_of_answers > 1)
@@ -11,7 +11,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import connection, transaction
 
-from gobotany.core import models
+from gobotany.core import catalog, igdt, models
 from gobotany.plantoftheday.models import PlantOfTheDay
 from gobotany.search.models import SubgroupResultsPage
 
@@ -247,6 +247,19 @@ def rebuild_plant_of_the_day(include_plants='SIMPLEKEY'):   # or 'ALL'
                     potd.save()
 
 
+def rebuild_question_trees():
+    """Compile each pile's best-question rankings ahead of time."""
+    print('Compiling question trees:')
+    for pile in models.Pile.objects.all():
+        data_digest, weights, rankings = igdt.compile_question_tree(pile)
+        models.QuestionTree.objects.update_or_create(pile=pile, defaults={
+            'data_digest': data_digest,
+            'weights': weights,
+            'rankings': rankings,
+            })
+        print('    %s: %d bytes' % (pile.name, len(rankings)))
+
+
 def main():
     from .importer import start_logging
     start_logging()
@@ -260,6 +273,7 @@ def main():
         function = globals()[function_name]
         wrapped_function = transaction.atomic(function)
         wrapped_function(*sys.argv[2:])
+        catalog.bump()
     else:
         print("Error: rebuild target %r unknown" % thing, file=sys.stderr)
         exit(2)
@@ -1,18 +1,22 @@
 # coding=windows-1252
 
 import doctest
+import json
 import os
 import re
 import unittest
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from unittest import mock
 
+from django.core.cache import caches
 from django.db import connection
 from django.forms import ValidationError
 from django.test import TestCase
 
 import bulkup
-from gobotany.core import botany, igdt, importer, models
+from gobotany.core import (botany, catalog, distribution_vectors, encoding,
+    igdt, importer, matrix, models)
 
 # Set up a logging handler to avoid getting a "no handlers could be found
 # for logger" error during importer tests, but quiet down the messages.
@@ -336,6 +340,22 @@ class APITests(SampleData):
         self.try_query([self.fox], length=5)
         self.try_query([], length=6)
 
+    def test_query_several_characters(self):
+        self.try_query([self.cat, self.rabbit], color='gray', cuteness='cute')
+        self.try_query([self.cat, self.rabbit], color='gray', length=3.5,
+                       cuteness='cute')
+        self.try_query([], color='red', length=3)
+        self.try_query([self.cat], pile='carnivores', color='gray', length=4)
+        self.assertRaises(models.Character.DoesNotExist,
+                          self.try_query, [], color='chartreuse',
+                          bad_character='red')
+
+    def test_query_follows_character_value_edits(self):
+        self.try_query([self.fox], color='red')
+        models.TaxonCharacterValue(
+            taxon=self.rabbit, character_value=self.red).save()
+        self.try_query([self.fox, self.rabbit], color='red')
+
     def test_species_images(self):
         taxon = models.ContentType.objects.get(model='taxon')
         CI = models.ContentImage
@@ -409,6 +429,318 @@ class APITests(SampleData):
                 ])
 
 
+    def set_ease_of_observability(self):
+        for ease, character in enumerate(
+                (self.color, self.cuteness, self.length), 1):
+            character.ease_of_observability = ease
+            character.save()
+
+    def test_fast_rank_characters_matches_rank_characters(self):
+        self.set_ease_of_observability()
+        everyone = list(models.Taxon.objects.all())
+        for species_list in (everyone, [self.cat, self.rabbit],
+                             [self.fox, self.rabbit], [self.rabbit]):
+            expected = igdt.rank_characters(self.pets, species_list)
+            actual = igdt.fast_rank_characters(self.pets, species_list)
+            self.assertEqual([row[3] for row in expected],
+                             [row[3] for row in actual])
+            for expected_row, actual_row in zip(expected, actual):
+                for a, b in zip(expected_row[:3], actual_row[:3]):
+                    self.assertAlmostEqual(a, b)
+
+    def test_ranking_skips_characters_without_ease(self):
+        self.set_ease_of_observability()
+        self.length.ease_of_observability = None
+        self.length.save()
+        everyone = list(models.Taxon.objects.all())
+        for ranking in (igdt.rank_characters(self.pets, everyone),
+                        igdt.fast_rank_characters(self.pets, everyone)):
+            self.assertEqual({self.color, self.cuteness},
+                             {row[3] for row in ranking})
+
+    def test_cached_ranking_hit_makes_no_queries(self):
+        self.set_ease_of_observability()
+        species = [self.cat.id, self.rabbit.id]
+        first = igdt.cached_ranking(self.pets, species)
+        with self.assertNumQueries(0):
+            self.assertEqual(first, igdt.cached_ranking(self.pets, species))
+
+    def test_current_weights_follow_catalog_version(self):
+        # The rollback after this test can hand a later test the same
+        # catalog generation, so forget the weights read here.
+        self.addCleanup(igdt._weights.update, version=None)
+        weights = igdt.current_weights()
+        models.Parameter(name='coverage_weight', value=0.25).save()
+        self.assertEqual(weights, igdt.current_weights())
+        catalog.bump()
+        self.assertEqual(0.25, igdt.current_weights()[0])
+
+    def test_fast_rank_characters_tolerates_ties(self):
+        for character in (self.color, self.cuteness, self.length):
+            character.ease_of_observability = 1
+            character.save()
+        ranking = igdt.fast_rank_characters(self.pets, [self.rabbit])
+        scores = [row[:3] for row in ranking]
+        self.assertEqual(sorted(scores), scores)
+
+    def test_cached_ranking_remembers_species_sets(self):
+        self.set_ease_of_observability()
+        igdt.ranking_cache.clear()
+        hits = igdt.ranking_cache.hits
+        first = igdt.cached_ranking(self.pets, [self.cat.id, self.rabbit.id])
+        second = igdt.cached_ranking(
+            self.pets, [str(self.rabbit.id), str(self.cat.id)])
+        self.assertEqual(first, second)
+        self.assertEqual(hits + 1, igdt.ranking_cache.hits)
+        expected = [character.id for score, entropy, coverage, character
+                    in igdt.rank_characters(self.pets, [self.cat, self.rabbit])]
+        self.assertEqual(expected, first)
+
+    def test_compiled_question_tree_answers_rankings(self):
+        self.set_ease_of_observability()
+        data_digest, weights, rankings = igdt.compile_question_tree(self.pets)
+        models.QuestionTree(pile=self.pets, data_digest=data_digest,
+                            weights=weights, rankings=rankings).save()
+        compiled_hits = igdt.ranking_cache.compiled_hits
+        ranking = igdt.cached_ranking(self.pets, [self.rabbit, self.cat])
+        self.assertEqual(compiled_hits + 1, igdt.ranking_cache.compiled_hits)
+        expected = [character.id for score, entropy, coverage, character
+                    in igdt.rank_characters(self.pets, [self.cat, self.rabbit])]
+        self.assertEqual(expected, ranking)
+
+class EncodingTestCase(unittest.TestCase):
+
+    value = {'a': [1, 2.5, None, True], 'b': {1: 'caf\xe9', 'c': []},
+             'd': encoding.Fragment.of({'e': ['f', 'g']}), 'h': {}}
+
+    def test_dumps_matches_standard_library(self):
+        expected = dict(self.value, d={'e': ['f', 'g']})
+        self.assertEqual(json.loads(json.dumps(expected)),
+                         json.loads(encoding.dumps(self.value)))
+
+    def test_dumps_is_compact_utf8(self):
+        self.assertEqual('{"a":[1,"caf\xe9"],"b":{"1":null}}',
+                         encoding.dumps({'a': [1, 'caf\xe9'],
+                                         'b': {1: None}}))
+
+    @unittest.skipIf(encoding.orjson is None, 'orjson is not installed')
+    def test_dumps_matches_without_orjson(self):
+        native = encoding.dumps(self.value)
+        with mock.patch.object(encoding, 'orjson', None):
+            self.assertEqual(native, encoding.dumps(self.value))
+
+    def test_dumps_keeps_fragments_apart(self):
+        fragments = [encoding.Fragment.of(n) for n in range(12)]
+        self.assertEqual(list(range(12)),
+                         json.loads(encoding.dumps(fragments)))
+
+    def test_iter_json_matches_dumps(self):
+        for indent in (None, 1, False):
+            self.assertEqual(encoding.dumps(self.value, indent),
+                             ''.join(encoding.iter_json(self.value, indent)))
+
+    def test_iter_json_writes_generators_as_lists(self):
+        items = (n * n for n in range(4))
+        self.assertEqual(encoding.dumps({'items': [0, 1, 4, 9]}),
+                         ''.join(encoding.iter_json({'items': items})))
+
+
+class LengthIndexTestCase(unittest.TestCase):
+
+    Range = namedtuple('Range', 'id value_min value_max')
+    values = [Range(1, 2.0, 7.0), Range(2, 5.0, 9.0), Range(3, 12.0, 13.0),
+              Range(4, None, None)]
+    bits = {1: 0b001, 2: 0b010, 3: 0b100, 4: 0b1000}
+
+    def setUp(self):
+        self.index = matrix.LengthIndex(self.values, self.bits)
+
+    def test_matching_includes_endpoints(self):
+        self.assertEqual(0b001, self.index.matching(2.0))
+        self.assertEqual(0b011, self.index.matching(6.0))
+        self.assertEqual(0b010, self.index.matching(9.0))
+        self.assertEqual(0, self.index.matching(10.0))
+        self.assertEqual(0, self.index.matching(1.0))
+
+    def test_ranges_merge_overlapping_stretches(self):
+        self.assertEqual([(2.0, 9.0, 2), (12.0, 13.0, 1)],
+                         self.index.ranges(0b111))
+        self.assertEqual([(5.0, 9.0, 1)], self.index.ranges(0b010))
+
+    def test_entropy_matches_endpoint_sweep(self):
+        # Gaps 2-5, 5-7, 7-9, 9-12, 12-13 covered by 1, 2, 1, 0, 1 ranges.
+        self.assertAlmostEqual(2 * 2 * 1.0 / 11, self.index.entropy())
+        self.assertAlmostEqual(self.index.entropy(),
+                               igdt._length_entropy(self.values, None, None))
+
+
+class CatalogVersionTestCase(SampleData):
+
+    def setUp(self):
+        catalog.clear()
+        self.setup_sample_data()
+
+    def test_bump_changes_data_version(self):
+        version = catalog.bump()
+        self.assertEqual(version, catalog.data_version())
+        self.assertEqual(version + 1, catalog.bump())
+        self.assertEqual(version + 1, catalog.data_version())
+
+    def test_bump_reloads_matrices(self):
+        before = matrix.get_matrix(self.pets)
+        self.assertIs(before, matrix.get_matrix(self.pets))
+        catalog.bump()
+        self.assertIsNot(before, matrix.get_matrix(self.pets))
+
+    def test_scoped_bump_leaves_other_scopes(self):
+        everything = catalog.data_version()
+        distribution = catalog.data_version(catalog.DISTRIBUTION)
+        version = catalog.data_version(catalog.CATALOG)
+        self.assertEqual(version + 1, catalog.bump(catalog.CATALOG))
+        self.assertEqual(distribution,
+                         catalog.data_version(catalog.DISTRIBUTION))
+        self.assertEqual(everything + 1, catalog.data_version())
+
+    def test_unscoped_bump_changes_every_scope(self):
+        distribution = catalog.data_version(catalog.DISTRIBUTION)
+        catalog.bump()
+        self.assertEqual(distribution + 1,
+                         catalog.data_version(catalog.DISTRIBUTION))
+
+    def test_pile_bump_reloads_only_that_pile(self):
+        pets = matrix.get_matrix(self.pets)
+        carnivores = matrix.get_matrix(self.carnivores)
+        catalog.bump(catalog.pile_scope(self.pets.id))
+        self.assertIsNot(pets, matrix.get_matrix(self.pets))
+        self.assertIs(carnivores, matrix.get_matrix(self.carnivores))
+
+
+class DistributionVectorsTestCase(TestCase):
+
+    def setUp(self):
+        catalog.clear()
+        distribution_vectors.clear()
+        for scientific_name, state, county, present, native in [
+                ('Acer rubrum', 'ME', '', True, True),
+                ('Acer rubrum var. trilobum', 'ME', '', True, False),
+                ('Acer rubrum', 'ME', 'Piscataquis', False, False),
+                ('Acer saccharum', 'XX', '', True, True),
+                ]:
+            models.Distribution(scientific_name=scientific_name, state=state,
+                county=county, present=present, native=native).save()
+
+    def code(self, scientific_name, state, county=''):
+        i = distribution_vectors.PLACE_INDEX[state, county]
+        return distribution_vectors.vector(scientific_name)[i]
+
+    def test_vector_combines_species_and_varieties(self):
+        self.assertEqual(
+            distribution_vectors.NATIVE | distribution_vectors.NON_NATIVE,
+            self.code('Acer rubrum', 'ME'))
+        self.assertEqual(distribution_vectors.ABSENT,
+                         self.code('Acer rubrum', 'ME', 'Piscataquis'))
+        self.assertEqual(0, self.code('Acer rubrum', 'CT'))
+
+    def test_records(self):
+        Record = distribution_vectors.Record
+        self.assertEqual([Record('ME', '', True, False),
+                          Record('ME', '', True, True),
+                          Record('ME', 'Piscataquis', False, False)],
+                         distribution_vectors.records('Acer rubrum'))
+        self.assertEqual([], distribution_vectors.records('Acer nigrum'))
+
+    def test_no_vector_for_other_names_or_places(self):
+        self.assertIsNone(distribution_vectors.vector('Acer rubrum var. x'))
+        self.assertIsNone(distribution_vectors.vector('Acer saccharum'))
+
+    def test_hybrids_have_vectors_of_their_own(self):
+        models.Distribution(scientific_name='Acer x freemanii', state='CT',
+            county='', present=True, native=True).save()
+        self.assertEqual(distribution_vectors.NATIVE,
+                         self.code('Acer x freemanii', 'CT'))
+        self.assertEqual(0, self.code('Acer x freemanii', 'ME'))
+        self.assertIsNone(distribution_vectors.vector('Acer x'))
+
+    def test_store_ignores_other_bumps(self):
+        distribution_vectors.vector('Acer rubrum')
+        catalog.bump(catalog.CATALOG)
+        with self.assertNumQueries(0):
+            distribution_vectors.vector('Acer rubrum')
+
+    def test_saving_a_record_refreshes_its_vector(self):
+        self.assertEqual(0, self.code('Acer rubrum', 'CT'))
+        record = models.Distribution(scientific_name='Acer rubrum',
+            state='CT', county='', present=True, native=True)
+        record.save()
+        self.assertEqual(distribution_vectors.NATIVE,
+                         self.code('Acer rubrum', 'CT'))
+        record.delete()
+        self.assertEqual(0, self.code('Acer rubrum', 'CT'))
+
+    def test_renaming_a_record_refreshes_both_vectors(self):
+        record = models.Distribution.objects.get(
+            scientific_name='Acer rubrum var. trilobum')
+        self.assertEqual(distribution_vectors.NATIVE
+                         | distribution_vectors.NON_NATIVE,
+                         self.code('Acer rubrum', 'ME'))
+        record.scientific_name = 'Acer nigrum'
+        record.save()
+        self.assertEqual(distribution_vectors.NATIVE,
+                         self.code('Acer rubrum', 'ME'))
+        self.assertEqual(distribution_vectors.NON_NATIVE,
+                         self.code('Acer nigrum', 'ME'))
+
+    def shared_cache(self):
+        """Let the catalog use the test cache as if it were memcache."""
+        cache = caches['default']
+        cache.clear()
+        patcher = mock.patch.object(catalog, '_shared_cache',
+                                    return_value=cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def edit_elsewhere(self):
+        """Change records as another process would, without this
+        process's signal handlers: note a change to Acer rubrum, and
+        slip in a record for Acer nigrum that is never noted."""
+        models.Distribution.objects.filter(
+            scientific_name='Acer rubrum').update(native=False)
+        models.Distribution.objects.bulk_create([models.Distribution(
+            scientific_name='Acer nigrum', state='CT', county='',
+            present=True, native=True)])
+        catalog.note_change(catalog.DISTRIBUTION, 'Acer rubrum')
+
+    def test_bump_refreshes_only_noted_plants(self):
+        self.shared_cache()
+        self.code('Acer rubrum', 'ME')
+        self.edit_elsewhere()
+        catalog.bump(catalog.DISTRIBUTION)
+        self.assertEqual(distribution_vectors.NON_NATIVE,
+                         self.code('Acer rubrum', 'ME'))
+        self.assertEqual(0, self.code('Acer nigrum', 'CT'))
+
+    def test_incomplete_notes_rebuild_store(self):
+        self.shared_cache()
+        self.code('Acer rubrum', 'ME')
+        self.edit_elsewhere()
+        catalog.bump(catalog.DISTRIBUTION)
+        caches['default'].delete('catalog-changes:%s:%d:1' % (
+            catalog.DISTRIBUTION,
+            catalog.generations()[catalog.DISTRIBUTION]))
+        self.assertEqual(distribution_vectors.NATIVE,
+                         self.code('Acer nigrum', 'CT'))
+
+    def test_other_bumps_rebuild_store(self):
+        self.shared_cache()
+        self.code('Acer rubrum', 'ME')
+        self.edit_elsewhere()
+        catalog.bump()
+        self.assertEqual(distribution_vectors.NON_NATIVE,
+                         self.code('Acer rubrum', 'ME'))
+        self.assertEqual(distribution_vectors.NATIVE,
+                         self.code('Acer nigrum', 'CT'))
+
+
 class ImportTestCase(TestCase):
     def setUp(self):
         self.db = bulkup.Database(connection)
@@ -4,6 +4,7 @@ from django.forms import ChoiceField, ModelForm, Textarea, TextInput
 from django.http import HttpResponseRedirect
 
 from gobotany.admin import GoBotanyModelAdmin
+from gobotany.dkey import images
 from gobotany.dkey.models import Figure, Hybrid, IllustrativeSpecies, Lead, Page
 
 
@@ -32,6 +33,24 @@ class IllustrativeSpeciesAdmin(GoBotanyModelAdmin):
     ordering = ('group_number', 'family_name', 'species_name')
     search_fields = ('group_number', 'family_name', 'species_name')
 
+    # A group page's images show its illustrative species, so rebuild
+    # them whenever one of those changes.
+    def _refresh_group_pages(self, *group_numbers):
+        titles = ['Group %s' % number for number in group_numbers
+                  if number is not None]
+        for page in Page.objects.filter(title__in=titles):
+            images.refresh(page)
+
+    def save_model(self, request, obj, form, change):
+        super(IllustrativeSpeciesAdmin, self).save_model(
+            request, obj, form, change)
+        self._refresh_group_pages(form.initial.get('group_number'),
+                                  obj.group_number)
+
+    def delete_model(self, request, obj):
+        super(IllustrativeSpeciesAdmin, self).delete_model(request, obj)
+        self._refresh_group_pages(obj.group_number)
+
 
 """Make a longer column heading name for ID so the number doesn't wrap."""
 def lead_id_name(obj):
@@ -75,7 +94,8 @@ class PageAdmin(GoBotanyModelAdmin):
     list_display = ('title', 'rank', 'chapter')
     list_filter = ('rank',)
     ordering = ('title',)
-    readonly_fields = ('breadcrumb_cache',)
+    readonly_fields = ('breadcrumb_cache', 'image_cache',
+                       'image_cache_version')
     search_fields = ('title', 'chapter', 'rank')
 
     def get_form(self, request, obj=None, **kwargs):
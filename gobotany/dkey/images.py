@@ -0,0 +1,201 @@
+"""The images that should be displayed on a particular dkey page.
+
+Building a page's image lists takes several queries and a thumbnail URL
+for every image, so `sync()` builds the document for every page ahead
+of time with `refresh()` and stores it in `Page.image_cache`, which is
+what the /api/dkey-images/ endpoint serves.
+
+The document depends on taxa and images that can change without the
+dkey being synced again, so `refresh()` also stores the catalog version
+that the document was built from, and `current_document()` rebuilds it
+once the catalog has moved on.
+
+"""
+from operator import itemgetter
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+
+from gobotany.core import catalog, encoding
+from gobotany.core.models import ContentImage, Taxon
+from gobotany.dkey import models
+from gobotany.site.utils import secure_url
+
+extra_image_types = {
+    'Group 1': ['leaf'],
+    'Group 2': ['fruits', 'leaves'],
+    'Group 3': ['inflorescences', 'leaves'],
+    'Group 4': ['bark', 'leaves'],
+    'Group 5': ['bark', 'leaves'],
+    'Group 6': ['flowers', 'leaves'],
+    'Group 7': ['flowers', 'leaves'],
+    'Group 8': ['flowers', 'leaves'],
+    'Group 9': ['flowers', 'leaves'],
+    'Group 10': ['flowers', 'leaves'],
+    }
+
+KEY_TO_THE_FAMILIES = models.slug_to_title('key-to-the-families')
+
+def image_lists(page):
+    """Return the image types and image lists to display on `page`."""
+
+    if page.title == KEY_TO_THE_FAMILIES:
+        return {}
+
+    # Whether a dkey page displays groups of families, genera, or taxa,
+    # we need to pull exactly one species to stand as the representative
+    # for each taxon, and then grab all of the rank=1 content images for
+    # those species.
+
+    title = page.title
+
+    taxa = None
+    rank = None
+    taxa_names = []
+    for lead in page.leads.all():
+        if lead.taxa_cache:
+            rank, comma_list = lead.taxa_cache.split(':')
+            taxa_names.extend(comma_list.split(','))
+    if rank is None:
+        return {}
+
+    group_title = None
+
+    if page.rank == 'group':
+        group_title = page.title
+    else:
+        for ancestor in page.breadcrumb_cache.all():
+            if ancestor.rank == 'group':
+                group_title = ancestor.title
+
+    image_types_allowed = ['plant form']
+    image_types_allowed.extend(extra_image_types.get(group_title, ()))
+
+    # One parameter per name, rather than a tuple that only psycopg2
+    # knows how to expand, so the queries also run under SQLite.
+    placeholders = ', '.join(['%s'] * len(taxa_names))
+
+    if rank == 'family':
+
+        # See https://github.com/newfs/gobotany-app/issues/302
+        # and https://github.com/newfs/gobotany-app/issues/304
+
+        group_number = title.split()[-1] if page.rank == 'group' else ''
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT f.name, t.id,
+              (SELECT id FROM core_taxon WHERE family_id = f.id LIMIT 1)
+              FROM core_family f
+              LEFT JOIN dkey_illustrativespecies i
+                ON (i.group_number = %s AND f.name = i.family_name)
+              LEFT JOIN core_taxon t
+                ON (i.species_name = t.scientific_name)
+              WHERE f.name IN ({})""".format(placeholders),
+            [group_number] + taxa_names)
+
+        rows = cursor.fetchall()
+        family_map = {}
+        for family_name, illustrative_taxon_id, random_taxon_id in rows:
+            taxon_id = illustrative_taxon_id
+            if taxon_id is None:
+                taxon_id = random_taxon_id
+            family_map[taxon_id] = family_name
+
+        taxon_ids = list(family_map.keys())
+
+    elif rank == 'genus':
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT
+              (SELECT id FROM core_taxon WHERE genus_id = g.id LIMIT 1)
+              FROM core_genus g
+              WHERE g.name IN ({})""".format(placeholders), taxa_names)
+        taxon_ids = [ id for (id,) in cursor.fetchall() ]
+
+    elif rank == 'species':
+
+        taxa = Taxon.objects.filter(scientific_name__in=taxa_names)
+        taxon_ids = [ taxon.id for taxon in taxa ]
+
+    else:
+        return {}
+
+    if taxa is None:
+        taxa = Taxon.objects.filter(id__in=taxon_ids)
+
+    ctype = ContentType.objects.get_for_model(Taxon)
+    query = (ContentImage.objects
+             .filter(content_type=ctype, object_id__in=taxon_ids, rank=1)
+             .filter(image_type__name__in=image_types_allowed)
+             .select_related('image_type')
+             )
+
+    image_map = {
+        (image.object_id, image.image_type.name): image.thumb_small()
+        for image in query
+        }
+
+    image_types = sorted(set(key[1] for key in image_map))
+    image_lists = []
+
+    for taxon in taxa:
+
+        if rank == 'family':
+            name = family_map[taxon.id]
+            title = '{}<br><i>({})</i>'.format(name, taxon.scientific_name)
+        else:
+            if rank == 'genus':
+                name = taxon.genus_name()
+            else:
+                name = taxon.scientific_name
+            title = '<i>{}</i>'.format(taxon.scientific_name)
+
+        image_list = []
+        for image_type in image_types:
+            image = image_map.get((taxon.id, image_type))
+            if image is not None:
+                image_list.append({
+                    'image_type': image_type,
+                    'image_url':
+                        secure_url(image_map.get((taxon.id, image_type))),
+                    })
+
+        image_lists.append({
+            'name': name,
+            'scientific_name': taxon.scientific_name,
+            'title': title,
+            'image_list': image_list,
+            })
+
+    image_lists.sort(key=itemgetter('title'))
+
+    return {
+        'image_types': image_types,
+        'image_lists': image_lists,
+        }
+
+def refresh(page):
+    """Rebuild the image lists for `page` and store them in the page."""
+    version = catalog.read_version(catalog.CATALOG)
+    image_cache = encoding.dumps(image_lists(page))
+    models.Page.objects.filter(id=page.id).update(
+        image_cache=image_cache, image_cache_version=version)
+    page.image_cache = image_cache
+    page.image_cache_version = version
+
+def current_document(title):
+    """Return the image lists JSON for the page with `title`, rebuilding
+    it first if it is missing or older than the catalog; or None if
+    there is no such page."""
+    row = (models.Page.objects.filter(title=title)
+           .values_list('id', 'image_cache', 'image_cache_version').first())
+    if row is None:
+        return None
+    page_id, image_cache, version = row
+    if image_cache and version >= catalog.data_version(catalog.CATALOG):
+        return image_cache
+    page = models.Page.objects.get(id=page_id)
+    refresh(page)
+    return page.image_cache
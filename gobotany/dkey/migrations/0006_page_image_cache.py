@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dkey', '0005_auto_20190131_1401'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='image_cache',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dkey', '0006_page_image_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='image_cache_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
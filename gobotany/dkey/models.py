@@ -34,6 +34,8 @@ class Page(models.Model):
     rank = models.TextField(db_index=True)
     text = models.TextField(blank=True)
     breadcrumb_cache = models.ManyToManyField('Page', related_name='ignore+')
+    image_cache = models.TextField(blank=True)  # JSON built by sync()
+    image_cache_version = models.PositiveIntegerField(default=0)
 
     class Meta:
         verbose_name = 'dichotomous key page'
@@ -9,7 +9,7 @@ django.setup()
 from operator import attrgetter
 
 from django.db import connection, transaction
-from gobotany.dkey import models
+from gobotany.dkey import images, models
 
 def is_major_taxon(page):
     return page.rank in ('family', 'genus', 'species')
@@ -34,7 +34,7 @@ def cache_taxon(pagedict, leadindict, rank, taxon, page):
 
 @transaction.atomic
 def sync():
-    """Update the breadcrumbs and taxa caches."""
+    """Update the breadcrumbs, taxa caches, and image lists."""
 
     # Start fresh.
 
@@ -78,6 +78,12 @@ def sync():
             leadin.taxa_cache = '{}:{}'.format(tc[0], ','.join(sorted(tc[1])))
             leadin.save()  # save the new `taxa_cache` strings
 
+    # Build the image lists, now that the caches they need are ready.
+    print('Building the image lists...')
+
+    for page in pagelist:
+        images.refresh(page)
+
     print('Done.')
 
 
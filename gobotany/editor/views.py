@@ -17,7 +17,7 @@ from django.template import RequestContext
 from django.utils import timezone
 from shoehorn.engine import DifferenceEngine
 
-from gobotany.core import models
+from gobotany.core import catalog, models
 from gobotany.core.partner import which_partner
 
 from gobotany.dkey import models as dkey_models
@@ -286,6 +286,11 @@ def _save(request, new_values, character=None, taxon=None):
             old_value=json.dumps(old_value),
             ).save()
 
+    # Only the piles of the characters edited need their caches rebuilt.
+    scopes = set(catalog.pile_scope(character.pile_id)
+                 for character, taxon, value in character_taxon_value_tuples)
+    if scopes:
+        catalog.bump(*sorted(scopes))
     return redirect(dt.strftime(
         '/edit/cv/lit-sources/%Y.%m.%d.%H.%M.%S.%f/?return_to='
         + urllib.parse.quote(request.path)))
@@ -0,0 +1,62 @@
+"""Distribution maps rendered ahead of time.
+
+The `prerender_maps` management command draws each plant's maps into
+the default file storage (S3, in production, so that every dyno sees
+them) under the PREFIX below.  Each map is stored under the digest of
+the data it is drawn from (see the `digest()` method of
+`PlantDistributionMap`), which is also its ETag.  A stored map
+therefore never goes stale: once a plant's distribution records
+change, its digest changes too, and the map views draw the map live
+until the command is run again.
+
+"""
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from gobotany.mapping.map import (NewEnglandPlantDistributionMap,
+    NorthAmericanPlantDistributionMap, plant_name)
+
+MAP_CLASSES = (NewEnglandPlantDistributionMap,
+               NorthAmericanPlantDistributionMap)
+
+PREFIX = 'map-cache/'
+
+def path(digest):
+    """Return the storage name of the stored map with the digest
+    `digest`."""
+    return PREFIX + digest + '.svg'
+
+def read(digest):
+    """Return the stored map with the digest `digest`, or None."""
+    try:
+        with default_storage.open(path(digest), 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def write(digest, content):
+    """Store a map, replacing any earlier copy."""
+    name = path(digest)
+    if default_storage.exists(name):
+        default_storage.delete(name)  # or the storage picks a new name
+    default_storage.save(name, ContentFile(content))
+
+def render(scientific_name, force=False):
+    """Draw and store each map of the taxon `scientific_name`.
+
+    Unless `force` is true, maps whose digests are already stored are
+    not drawn again.  Return a list of (digest, was_drawn) pairs.
+
+    """
+    genus, epithet = scientific_name.split(' ', 1)
+    name = plant_name(genus.lower(), epithet)
+    results = []
+    for map_class in MAP_CLASSES:
+        digest = map_class.digest(name)
+        drawn = force or not default_storage.exists(path(digest))
+        if drawn:
+            distribution_map = map_class()
+            distribution_map.set_plant(name)
+            write(digest, distribution_map.shade().tostring())
+        results.append((digest, drawn))
+    return results
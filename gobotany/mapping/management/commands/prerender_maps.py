@@ -0,0 +1,64 @@
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from gobotany.core.models import Taxon
+from gobotany.mapping import cache
+
+class Command(BaseCommand):
+    """Draw the New England and North American distribution maps of
+    every taxon into the default file storage, where the map views will
+    find them.
+
+    Maps are stored under the digests of their data, so running the
+    command again only draws the maps of plants whose distribution
+    records have changed since the last run. Example:
+
+    dev/django prerender_maps --processes 4 --prune
+    """
+    help = 'Draws the distribution maps of every taxon ahead of time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', metavar='scientific_name',
+            help='Draw only the maps of these taxa.')
+        parser.add_argument('--processes', type=int, default=cpu_count(),
+            help='Number of maps to draw at once; defaults to one per CPU.')
+        parser.add_argument('--force', action='store_true',
+            help='Draw maps again even if they are already stored.')
+        parser.add_argument('--prune', action='store_true',
+            help='Delete stored maps that no taxon uses any more.')
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(Taxon.objects.order_by(
+            'scientific_name').values_list('scientific_name', flat=True))
+        render = partial(cache.render, force=options['force'])
+
+        # Each worker process must open its own database connection.
+        connections.close_all()
+
+        digests = set()
+        drawn = 0
+        pool = Pool(options['processes'])
+        try:
+            for results in pool.imap_unordered(render, names, chunksize=8):
+                for digest, was_drawn in results:
+                    digests.add(digest)
+                    drawn += was_drawn
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write('Drew %d maps; %d were already stored.' % (
+            drawn, len(digests) - drawn))
+
+        if options['prune'] and not options['names']:
+            pruned = 0
+            directories, filenames = default_storage.listdir(cache.PREFIX)
+            for filename in filenames:
+                digest, extension = filename.rsplit('.', 1)
+                if extension == 'svg' and digest not in digests:
+                    default_storage.delete(cache.PREFIX + filename)
+                    pruned += 1
+            self.stdout.write('Deleted %d maps no longer in use.' % pruned)
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import copy
+import hashlib
 import re
 
 from os.path import abspath, dirname
@@ -9,12 +11,81 @@ from django.core.exceptions import ObjectDoesNotExist
 
 from lxml import etree
 
-from gobotany.core import models
+from gobotany.core import distribution_vectors, models
 
 GRAPHICS_ROOT = abspath(dirname(__file__) + '/../static/graphics')
 NAMESPACES = {'svg': 'http://www.w3.org/2000/svg'}
+SVG = '{http://www.w3.org/2000/svg}'
 STATES = [k.upper() for k, v in list(settings.STATE_NAMES.items())]
 
+# Increase this whenever a change to this module changes the maps that
+# it draws, so that browsers stop using maps cached under old ETags.
+RENDERING_VERSION = 1
+
+class MapTemplate(object):
+    """A blank SVG map, parsed only once per process.
+
+    The parsed tree is never changed: each map gets its own copy to
+    shade, which lxml makes far faster than it can parse the file
+    again.  The template also remembers where, in document order, the
+    nodes that an XPath expression selects are found, so that a copy
+    can find the same nodes without evaluating the expression.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.version = hashlib.md5(f.read()).hexdigest()
+        self.tree = etree.parse(path)
+        self.elements = list(self.tree.getroot().iter(tag=etree.Element))
+        self.ids = {}   # element ID -> position in document order
+        for i, element in enumerate(self.elements):
+            element_id = element.get('id')
+            if element_id is not None:
+                self.ids.setdefault(element_id, i)
+        self._positions = {}  # XPath expression -> positions
+        self._indexes = {}    # (XPath expression, keys) -> index
+
+    def copy(self):
+        """Return a copy of the tree, and a list of its elements in
+        document order."""
+        tree = copy.deepcopy(self.tree)
+        return tree, list(tree.getroot().iter(tag=etree.Element))
+
+    def positions(self, xpath):
+        """Return the document-order positions of the nodes selected by
+        the XPath expression `xpath`."""
+        positions = self._positions.get(xpath)
+        if positions is None:
+            index = {element: i for i, element in enumerate(self.elements)}
+            positions = [index[node] for node in self.tree.xpath(
+                xpath, namespaces=NAMESPACES)]
+            self._positions[xpath] = positions
+        return positions
+
+    def index(self, xpath, keys):
+        """Return a dictionary from each key that the function `keys`
+        returns for a node selected by `xpath` to the document-order
+        positions of the nodes with that key."""
+        index = self._indexes.get((xpath, keys))
+        if index is None:
+            index = {}
+            for i in self.positions(xpath):
+                for key in keys(self.elements[i]):
+                    index.setdefault(key, []).append(i)
+            self._indexes[xpath, keys] = index
+        return index
+
+
+_templates = {}  # path to blank map -> MapTemplate
+
+def get_template(blank_map_path):
+    """Return the MapTemplate for a blank map, parsing it if need be."""
+    template = _templates.get(blank_map_path)
+    if template is None:
+        template = _templates[blank_map_path] = MapTemplate(blank_map_path)
+    return template
+
+
 class Path(object):
     """Class for operating on a SVG path node."""
     STYLE_ATTR = 'style'
@@ -64,17 +135,30 @@ class Legend(object):
     COLORS = dict(ITEMS)  # Color lookup for labels, ex.: COLORS['rare'].
                           # This does not preserve the order of items.
 
-    def __init__(self, svg_map, maximum_categories, maximum_items):
+    def __init__(self, svg_map, maximum_categories, maximum_items,
+                 get_element=None):
         self.svg_map = svg_map
         self.maximum_categories = maximum_categories
         self.maximum_items = maximum_items
+        self.get_element = get_element  # element lookup by ID, if any
+
+    def _find(self, tag, node_id):
+        """Return the first `tag` node just beneath the root whose ID is
+        `node_id`, or None.  The map's index of element IDs is consulted
+        first, and the tree is only searched if that fails."""
+        if self.get_element is not None:
+            node = self.get_element(node_id)
+            if (node is not None and node.tag == SVG + tag
+                    and node.getparent() is self.svg_map.getroot()):
+                return node
+        nodes = self.svg_map.xpath('svg:%s[@id="%s"]' % (tag, node_id),
+                                   namespaces=NAMESPACES)
+        return nodes[0] if nodes else None
 
     def _set_category_label(self, category_number, label):
         label_node_id = 'category%s' % str(category_number)
         try:
-            label_node = self.svg_map.xpath(
-                'svg:text[@id="%s"]' % label_node_id,
-                namespaces=NAMESPACES)[0]
+            label_node = self._find('text', label_node_id)
             if label_node is not None:
                 label_text_node = label_node.find(
                     '{http://www.w3.org/2000/svg}tspan')
@@ -86,9 +170,7 @@ class Legend(object):
         label = ''
         label_node_id = 'label%s' % str(slot_number)
         try:
-            label_node = self.svg_map.xpath(
-                'svg:text[@id="%s"]' % label_node_id,
-                namespaces=NAMESPACES)[0]
+            label_node = self._find('text', label_node_id)
             if label_node is not None:
                 label_text_node = label_node.find(
                     '{http://www.w3.org/2000/svg}tspan')
@@ -115,14 +197,12 @@ class Legend(object):
 
     def _set_item(self, slot_number, fill_color, stroke_color, item_label):
         box_node_id = 'box%s' % str(slot_number)
-        box_node = self.svg_map.xpath('svg:rect[@id="%s"]' % box_node_id,
-            namespaces=NAMESPACES)[0]
+        box_node = self._find('rect', box_node_id)
         box = Path(box_node)
         box.color(fill_color, stroke_color)
 
         label_node_id = 'label%s' % str(slot_number)
-        label_node = self.svg_map.xpath('svg:text[@id="%s"]' % label_node_id,
-            namespaces=NAMESPACES)[0]
+        label_node = self._find('text', label_node_id)
         self._set_item_label(label_node, item_label)
 
     def _num_native_labels_found(self, legend_labels_found):
@@ -187,9 +267,20 @@ class ChloroplethMap(object):
     """Base class for a chloropleth SVG map."""
 
     def __init__(self, blank_map_path, maximum_legend_items):
-        self.svg_map = etree.parse(blank_map_path)
+        self.template = get_template(blank_map_path)
+        self.svg_map, self.elements = self.template.copy()
         self.maximum_legend_items = maximum_legend_items
 
+    def get_element(self, element_id):
+        """Return the element with the ID `element_id`, or None."""
+        i = self.template.ids.get(element_id)
+        return None if i is None else self.elements[i]
+
+    def get_nodes(self, xpath):
+        """Return the nodes that `xpath` selects, without evaluating it."""
+        elements = self.elements
+        return [elements[i] for i in self.template.positions(xpath)]
+
     def _get_title_node(self):
         return self.svg_map.find('{http://www.w3.org/2000/svg}title')
 
@@ -205,10 +296,51 @@ class ChloroplethMap(object):
         return etree.tostring(self.svg_map.getroot())
 
 
+def _county_keys(node):
+    """Index a map area by its lowercased ID, like "ct_hartford"."""
+    return (node.get('id').lower(),)
+
+def _state_keys(node):
+    """Index a map area by each prefix of its lowercased ID that ends
+    with an underscore, so "ct_hartford" is found under "ct_"."""
+    node_id = node.get('id').lower()
+    return [node_id[:i + 1] for i, c in enumerate(node_id) if c == '_']
+
+def _province_keys(node):
+    """Index a map area by the uppercased part of its ID before the
+    first underscore, so "ON_1" is found under "ON"."""
+    return (node.get('id').split('_')[0].upper(),)
+
+def _fill_keys(node):
+    """Index a state's map area by the legend colors in its style."""
+    if node.get('id')[0:2] not in STATES:
+        return ()
+    style = Path(node).get_style()
+    return [color for color in set(Legend.COLORS.values())
+            if style.find('fill:%s' % color) > 0]
+
+
+def plant_name(genus, epithet):
+    """Return the scientific name of the plant whose map is requested."""
+
+    # BONAP gives one species a different name than FNA; as a temporary
+    # measure, we rename the species here.  A more permament solution
+    # (whether a data fix, or a table to drive renaming) will be
+    # discussed here:
+    #
+    # https://github.com/newfs/gobotany-app/issues/277
+
+    if (genus, epithet) == ('berberis', 'aquifolium'):
+        genus, epithet = 'mahonia', 'aquifolium'
+
+    return ' '.join([genus.title(), epithet.lower()])
+
+
 class PlantDistributionMap(ChloroplethMap):
     """Base class for a map that shows plant distribution data."""
 
     PATH_NODES_XPATH = 'svg:path'
+    BLANK_MAP_PATH = None  # set by each kind of map
 
     def __init__(self, blank_map_path):
         self.maximum_legend_categories = 2
@@ -217,7 +349,7 @@ class PlantDistributionMap(ChloroplethMap):
         super(PlantDistributionMap, self).__init__(blank_map_path,
             self.maximum_legend_items)
         self.legend = Legend(self.svg_map, self.maximum_legend_categories,
-            self.maximum_legend_items)
+            self.maximum_legend_items, self.get_element)
 
     def _get_label(self, is_present, is_native, level=None):
         """Return the appropriate label for distribution data."""
@@ -248,29 +380,61 @@ class PlantDistributionMap(ChloroplethMap):
         title_text = '%s: %s' % (scientific_name, title_text)
         self.set_title(title_text)
 
-    def _get_distribution_records(self, scientific_name):
+    @classmethod
+    def _get_distribution_records(cls, scientific_name):
         """Look up the plant and get its distribution records."""
         return models.Distribution.objects.all_records_for_plant(
             scientific_name)
 
-    def set_plant(self, scientific_name):
-        """Set the plant to be shown and gather its data."""
-        self.scientific_name = scientific_name
-        records = self._get_distribution_records(self.scientific_name)
+    @classmethod
+    def _plant_records(cls, scientific_name):
+        """Get the plant's records from the distribution store, asking
+        the database only if the store has no vector for the plant."""
+        records = distribution_vectors.records(scientific_name)
+        if records is None:
+            records = cls._get_distribution_records(scientific_name)
+        return records
+
+    @classmethod
+    def _find_distribution_records(cls, scientific_name):
+        """Get the plant's distribution records, or failing that, those
+        of the first of its synonyms that has any."""
+        records = cls._plant_records(scientific_name)
         if not records:
             # Distribution records might be listed under one of the
             # synonyms for this plant instead.
             try:
                 taxon = models.Taxon.objects.get(
-                    scientific_name=self.scientific_name)
+                    scientific_name=scientific_name)
                 if taxon.synonyms:
                     for synonym in taxon.synonyms.all():
                         name = synonym.scientific_name
-                        records = self._get_distribution_records(name)
+                        records = cls._plant_records(name)
                         if records:
                             break
             except ObjectDoesNotExist:
                 pass  # Didn't find the plant in the database
+        return records
+
+    @classmethod
+    def digest(cls, scientific_name):
+        """Return a digest of everything that the plant's map is drawn
+        from, without drawing it, or even copying the blank map: the
+        distribution records that are shaded, the blank map, and the
+        version of this code."""
+        records = cls._find_distribution_records(scientific_name)
+        values = [(record.state, record.county, record.present,
+                   record.native) for record in records]
+        h = hashlib.md5()
+        h.update(repr((RENDERING_VERSION, cls.__name__,
+                       get_template(cls.BLANK_MAP_PATH).version,
+                       scientific_name, values)).encode('utf-8'))
+        return h.hexdigest()
+
+    def set_plant(self, scientific_name):
+        """Set the plant to be shown and gather its data."""
+        self.scientific_name = scientific_name
+        records = self._find_distribution_records(self.scientific_name)
         self.distribution_records = records
 
         # Only add the plant name to the title if distribution data are
@@ -314,6 +478,20 @@ class PlantDistributionMap(ChloroplethMap):
 
         return should_shade
 
+    def _visible_colors(self, shaded):
+        """Return the legend colors that fill any state's map area, given
+        the positions of the nodes whose colors have been changed."""
+        fills = self.template.index(self.PATH_NODES_XPATH, _fill_keys)
+        unchanged = {color: len(positions)
+                     for color, positions in fills.items()}
+        colors = set()
+        for i in shaded:
+            for color in _fill_keys(self.template.elements[i]):
+                unchanged[color] -= 1
+            colors.update(_fill_keys(self.elements[i]))
+        colors.update(color for color, count in unchanged.items() if count)
+        return colors
+
     def _shade_areas(self):
         """Set the colors of the counties or states/provinces based
         on distribution data. Return a list of the legend labels to be
@@ -321,77 +499,65 @@ class PlantDistributionMap(ChloroplethMap):
         """
         legend_labels_found = []
         if self.distribution_records:
-            path_nodes = self.svg_map.xpath(self.PATH_NODES_XPATH,
-                namespaces=NAMESPACES)
-
-            # When shading a map area, iterate over the nodes rather
-            # than selecting a node via XPath. Iterating is around twice
-            # as fast as XPath, at least when breaking after finding a node
-            # as is done for the county-level records.
+            xpath = self.PATH_NODES_XPATH
+            counties = self.template.index(xpath, _county_keys)
+            states = self.template.index(xpath, _state_keys)
+            shaded = set()  # positions of the nodes whose colors changed
 
             # Take a pass through the nodes and shade any county-level
             # records.
             # Keep track of which states had any county-level records.
-            states_with_county_records = []
-            county_records = self.distribution_records.exclude(county='')
+            states_with_county_records = set()
+            county_records = [record for record in self.distribution_records
+                              if record.county]
             for record in county_records:
                 state_and_county = '%s_%s' % (record.state.lower(),
                                               record.county.replace(
                                                   ' ', '_').lower())
-                for node in path_nodes:
-                    node_id = node.get('id').lower()
-                    if node_id == state_and_county:
-                        label = self._get_label(record.present, record.native,
-                            level='county')
-                        if label not in legend_labels_found:
-                            legend_labels_found.append(label)
-                        box = Path(node)
-                        if self._should_shade(box, record.present,
-                                record.native, level='county'):
-                            box.color(Legend.COLORS[label])
-                            states_with_county_records.append(
-                                record.state.lower())
-                        break   # Move on to the next distribution record.
+                positions = counties.get(state_and_county)
+                if positions:
+                    i = positions[0]
+                    label = self._get_label(record.present, record.native,
+                        level='county')
+                    if label not in legend_labels_found:
+                        legend_labels_found.append(label)
+                    box = Path(self.elements[i])
+                    if self._should_shade(box, record.present,
+                            record.native, level='county'):
+                        box.color(Legend.COLORS[label])
+                        shaded.add(i)
+                        states_with_county_records.add(record.state.lower())
 
             # Take a pass through the nodes and shade any
             # state-/province-/territory-level records.
-            state_records = self.distribution_records.filter(county='')
+            state_records = [record for record in self.distribution_records
+                             if not record.county]
             for record in state_records:
-                state_id_piece = '%s_' % record.state.lower()
-                for node in path_nodes:
-                    node_id = node.get('id').lower()
-                    if node_id.startswith(state_id_piece):
-                        # If this state is not one where any county records
-                        # were mapped, proceed to map state records.
-                        state = record.state.lower()
-                        if state not in list(set(states_with_county_records)):
-                            label = self._get_label(record.present,
-                                record.native, level='state')
-                            if label not in legend_labels_found:
-                                legend_labels_found.append(label)
-                            box = Path(node)
-                            if self._should_shade(box, record.present,
-                                    record.native):
-                                box.color(Legend.COLORS[label])
-                            # Keep going rather than break, because for each
-                            # state-level record there will be multiple
-                            # counties to shade.
+                state = record.state.lower()
+                positions = states.get('%s_' % state)
+                # If this state is not one where any county records
+                # were mapped, proceed to map state records.
+                if not positions or state in states_with_county_records:
+                    continue
+                label = self._get_label(record.present, record.native,
+                    level='state')
+                if label not in legend_labels_found:
+                    legend_labels_found.append(label)
+                # For each state-level record there will be multiple
+                # counties to shade.
+                for i in positions:
+                    box = Path(self.elements[i])
+                    if self._should_shade(box, record.present,
+                            record.native):
+                        box.color(Legend.COLORS[label])
+                        shaded.add(i)
 
             # Check all legend labels found to verify they should still
             # be visible on the map. Drop any labels that no longer have
             # any shaded areas visible on the map due to overrides.
-            final_labels = []
-            for label in legend_labels_found:
-                color = Legend.COLORS[label]
-                for node in path_nodes:
-                    node_id = node.get('id')
-                    if node_id[0:2] in STATES:
-                        style = Path(node).get_style()
-                        if style.find('fill:%s' % color) > 0:
-                            # Found a node with this label's color, so
-                            # this label should still be included.
-                            final_labels.append(label)
-                            break
+            colors = self._visible_colors(shaded)
+            final_labels = [label for label in legend_labels_found
+                            if Legend.COLORS[label] in colors]
 
             legend_labels_found = self._order_labels(final_labels)
 
@@ -422,7 +588,7 @@ class PlantDiversityMap(ChloroplethMap):
         super(PlantDiversityMap, self).__init__(blank_map_path,
             self.maximum_legend_items)
         self.legend = Legend(self.svg_map, self.maximum_legend_categories,
-            self.maximum_legend_items)
+            self.maximum_legend_items, self.get_element)
         self.map_type = 'all'
 
     def set_title(self, value):
@@ -500,8 +666,7 @@ class PlantDiversityMap(ChloroplethMap):
 
     def _shade_county(self, county, state, taxa_count):
         color = self._get_color(taxa_count)
-        path_nodes = self.svg_map.xpath(self.PATH_NODES_XPATH,
-            namespaces=NAMESPACES)
+        path_nodes = self.get_nodes(self.PATH_NODES_XPATH)
         state_and_county = '%s_%s' % (state.lower(),
             county.replace(' ', '_').lower())
         # When shading a map area, iterate over the nodes rather
@@ -558,13 +723,15 @@ class NewEnglandPlantDistributionMap(PlantDistributionMap):
     data for a plant.
     """
 
+    # Note that this version of the New England counties map is
+    # under the static directory. It is not to be confused with
+    # versions in the "mapping" app's directory, which are used by
+    # code that scans existing maps.
+    BLANK_MAP_PATH = GRAPHICS_ROOT + '/new-england-counties-scoured.svg'
+
     def __init__(self):
-        # Note that this version of the New England counties map is
-        # under the static directory. It is not to be confused with
-        # versions in the "mapping" app's directory, which are used by
-        # code that scans existing maps.
-        blank_map_path  = GRAPHICS_ROOT + '/new-england-counties-scoured.svg'
-        super(NewEnglandPlantDistributionMap, self).__init__(blank_map_path)
+        super(NewEnglandPlantDistributionMap, self).__init__(
+            self.BLANK_MAP_PATH)
 
 
 class NewEnglandPlantDiversityMap(PlantDiversityMap):
@@ -582,10 +749,11 @@ class UnitedStatesPlantDistributionMap(PlantDistributionMap):
     """
 
     PATH_NODES_XPATH = 'svg:g/svg:path'
+    BLANK_MAP_PATH = GRAPHICS_ROOT + '/us-counties-scoured.svg'
 
     def __init__(self):
-        blank_map_path  = GRAPHICS_ROOT + '/us-counties-scoured.svg'
-        super(UnitedStatesPlantDistributionMap, self).__init__(blank_map_path)
+        super(UnitedStatesPlantDistributionMap, self).__init__(
+            self.BLANK_MAP_PATH)
 
 
 class NorthAmericanPlantDistributionMap(PlantDistributionMap):
@@ -598,11 +766,11 @@ class NorthAmericanPlantDistributionMap(PlantDistributionMap):
     """
 
     PATH_NODES_XPATH = 'svg:g/svg:path'
+    BLANK_MAP_PATH = GRAPHICS_ROOT + '/north-america-scoured.svg'
 
     def __init__(self):
-        blank_map_path = GRAPHICS_ROOT + '/north-america-scoured.svg'
         super(NorthAmericanPlantDistributionMap, self).__init__(
-            blank_map_path)
+            self.BLANK_MAP_PATH)
 
     def _shade_areas(self):
         """Set the colors of the states, provinces, or territories.
@@ -611,41 +779,40 @@ class NorthAmericanPlantDistributionMap(PlantDistributionMap):
         """
         legend_labels_found = []
         if self.distribution_records:
-            path_nodes = self.svg_map.xpath(self.PATH_NODES_XPATH,
-                namespaces=NAMESPACES)
+            provinces = self.template.index(self.PATH_NODES_XPATH,
+                                            _province_keys)
 
             # Take a pass through the nodes and shade any
             # state-/province-/territory-level records.
-            state_records = self.distribution_records.filter(county='')
+            state_records = [record for record in self.distribution_records
+                             if not record.county]
             for record in state_records:
-                for node in path_nodes:
-                    id_province = node.get('id').split('_')[0].upper()
-                    if id_province == record.state.upper():
-                        label = self._get_label(record.present, record.native)
-                        if label not in legend_labels_found:
-                            legend_labels_found.append(label)
-                        box = Path(node)
-                        if self._should_shade(box, record.present,
-                                record.native):
-                            box.color(Legend.COLORS[label])
-                        # Keep going rather than break, because
-                        # there are often multiple paths to shade.
+                positions = provinces.get(record.state.upper(), ())
+                if positions:
+                    label = self._get_label(record.present, record.native)
+                    if label not in legend_labels_found:
+                        legend_labels_found.append(label)
+                # There are often multiple paths to shade.
+                for i in positions:
+                    box = Path(self.elements[i])
+                    if self._should_shade(box, record.present,
+                            record.native):
+                        box.color(Legend.COLORS[label])
 
             # Take a pass through the nodes and override state shading 
             # if necessary based on county-level records.
-            county_records = self.distribution_records.exclude(county='')
+            county_records = [record for record in self.distribution_records
+                              if record.county]
             for record in county_records:
-                for node in path_nodes:
-                    id_province = node.get('id').split('_')[0].upper()
-                    if id_province == record.state.upper():
-                        label = self._get_label(record.present, record.native)
-                        if label not in legend_labels_found:
-                            legend_labels_found.append(label)
-                        box = Path(node)
-                        if self._should_shade(box, record.present,
-                                record.native):
-                            box.color(Legend.COLORS[label])
-                        break   # Move on to the next distribution record.
+                positions = provinces.get(record.state.upper())
+                if positions:
+                    label = self._get_label(record.present, record.native)
+                    if label not in legend_labels_found:
+                        legend_labels_found.append(label)
+                    box = Path(self.elements[positions[0]])
+                    if self._should_shade(box, record.present,
+                            record.native):
+                        box.color(Legend.COLORS[label])
 
             legend_labels_found = self._order_labels(legend_labels_found)
 
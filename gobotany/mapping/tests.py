@@ -1,6 +1,11 @@
-from django.test import TestCase
+import shutil
+import tempfile
 
+from django.test import TestCase, override_settings
+
+from gobotany.core import distribution_vectors
 from gobotany.core.models import Distribution, Family, Genus, Synonym, Taxon
+from gobotany.mapping import cache
 from gobotany.mapping.map import (NAMESPACES, Path, Legend,
                                   NewEnglandPlantDistributionMap,
                                   NorthAmericanPlantDistributionMap,
@@ -121,9 +126,33 @@ class ChloroplethMapTestCase(TestCase):
     def test_tostring(self):
         self.assertEqual(b'<svg xmlns', self.chloropleth_map.tostring()[0:10])
 
+    def test_maps_share_parsed_template(self):
+        other_map = NewEnglandPlantDistributionMap()
+        self.assertIs(self.chloropleth_map.template, other_map.template)
+        self.assertIsNot(self.chloropleth_map.svg_map, other_map.svg_map)
+
+    def test_changes_do_not_reach_template(self):
+        blank = NewEnglandPlantDistributionMap().tostring()
+        self.chloropleth_map.set_title('Test')
+        self.chloropleth_map.get_nodes(
+            self.chloropleth_map.PATH_NODES_XPATH)[0].set('style', 'fill:red')
+        self.assertEqual(blank, NewEnglandPlantDistributionMap().tostring())
+
+    def test_get_element(self):
+        element = self.chloropleth_map.get_element('box1')
+        self.assertEqual('{http://www.w3.org/2000/svg}rect', element.tag)
+        self.assertIsNone(self.chloropleth_map.get_element('no-such-id'))
+
+    def test_get_nodes_matches_xpath(self):
+        xpath = self.chloropleth_map.PATH_NODES_XPATH
+        self.assertEqual(
+            self.chloropleth_map.svg_map.xpath(xpath, namespaces=NAMESPACES),
+            self.chloropleth_map.get_nodes(xpath))
+
 
 def create_distribution_records():
     """Create dummy distribution records for New England and beyond."""
+    distribution_vectors.clear()
     taxa = {'Dendrolycopodium dendroideum': 'Lycopodiaceae',
             'Vaccinium vitis-idaea': 'Ericaceae'}
     for scientific_name, family_name in list(taxa.items()):
@@ -423,6 +452,37 @@ class PlantDistributionMapTestCase(TestCase):
         legend_shows_native = ('native, st.' or 'native, co.' in labels)
         self.assertTrue(legend_shows_native)
 
+    def test_digest_is_stable(self):
+        SCIENTIFIC_NAME = 'Dendrolycopodium dendroideum'
+        self.assertEqual(self.distribution_map.digest(SCIENTIFIC_NAME),
+            NewEnglandPlantDistributionMap().digest(SCIENTIFIC_NAME))
+
+    def test_digest_changes_with_distribution_records(self):
+        SCIENTIFIC_NAME = 'Dendrolycopodium dendroideum'
+        digest = self.distribution_map.digest(SCIENTIFIC_NAME)
+        record = Distribution.objects.get(scientific_name=SCIENTIFIC_NAME,
+            state='ME', county='Piscataquis')
+        record.native = False
+        record.save()
+        self.assertNotEqual(digest,
+                            self.distribution_map.digest(SCIENTIFIC_NAME))
+
+    def test_digest_follows_synonym_records(self):
+        SCIENTIFIC_NAME = 'Vaccinium vitis-idaea'
+        digest = self.distribution_map.digest(SCIENTIFIC_NAME)
+        for record in Distribution.objects.filter(
+                scientific_name='Vaccinium vitis-idaea ssp. minus',
+                state='ME'):
+            record.present = False
+            record.save()
+        self.assertNotEqual(digest,
+                            self.distribution_map.digest(SCIENTIFIC_NAME))
+
+    def test_digest_differs_between_maps(self):
+        SCIENTIFIC_NAME = 'Dendrolycopodium dendroideum'
+        self.assertNotEqual(self.distribution_map.digest(SCIENTIFIC_NAME),
+            NorthAmericanPlantDistributionMap().digest(SCIENTIFIC_NAME))
+
 
 class NewEnglandPlantDistributionMapTestCase(TestCase):
     def setUp(self):
@@ -633,3 +693,49 @@ class NorthAmericanPlantDistributionMapTestCase(TestCase):
             shaded_paths)
         self._verify_expected_shaded_areas(EXPECTED_SHADED_AREAS,
             shaded_paths)
+
+
+class MapCacheTestCase(TestCase):
+    SCIENTIFIC_NAME = 'Dendrolycopodium dendroideum'
+
+    def setUp(self):
+        create_distribution_records()
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.directory)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.directory)
+
+    def test_render_stores_each_map_under_its_digest(self):
+        results = cache.render(self.SCIENTIFIC_NAME)
+        self.assertEqual(len(cache.MAP_CLASSES), len(results))
+        for map_class, (digest, drawn) in zip(cache.MAP_CLASSES, results):
+            self.assertTrue(drawn)
+            distribution_map = map_class()
+            self.assertEqual(digest,
+                             distribution_map.digest(self.SCIENTIFIC_NAME))
+            distribution_map.set_plant(self.SCIENTIFIC_NAME)
+            self.assertEqual(distribution_map.shade().tostring(),
+                             cache.read(digest))
+
+    def test_render_skips_maps_already_stored(self):
+        cache.render(self.SCIENTIFIC_NAME)
+        results = cache.render(self.SCIENTIFIC_NAME)
+        self.assertEqual([False, False], [drawn for d, drawn in results])
+        results = cache.render(self.SCIENTIFIC_NAME, force=True)
+        self.assertEqual([True, True], [drawn for d, drawn in results])
+
+    def test_render_draws_maps_again_after_records_change(self):
+        before = cache.render(self.SCIENTIFIC_NAME)
+        for record in Distribution.objects.filter(
+                scientific_name=self.SCIENTIFIC_NAME, state='ME'):
+            record.native = False
+            record.save()
+        after = cache.render(self.SCIENTIFIC_NAME)
+        self.assertEqual([True, True], [drawn for d, drawn in after])
+        self.assertNotEqual(before, after)
+
+    def test_read_returns_none_when_not_stored(self):
+        self.assertIsNone(cache.read('0' * 32))
@@ -1,6 +1,8 @@
 from django.conf import settings
 from django import http
 from django.core.urlresolvers import resolve
+from django.middleware import gzip
+from django.utils.cache import patch_vary_headers
 
 # Middleware class courtesy of http://djangosnippets.org/snippets/601/
 class SmartAppendSlashMiddleware(object):
@@ -46,4 +48,39 @@ def _resolves(url):
         resolve(url)
         return True
     except http.Http404:
-        return False
\ No newline at end of file
+        return False
+
+def encoding_qualities(request):
+    """Return the {coding: q} that the request's Accept-Encoding lists.
+
+    A coding that is not listed has the quality of "*", if that is
+    listed, and is otherwise unacceptable; a quality of 0 also means
+    that the client refuses the coding.
+    """
+    qualities = {}
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, parameters = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for parameter in parameters.split(';'):
+            name, _, value = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding] = q
+    wildcard = qualities.pop('*', 0.0)
+    return lambda coding: qualities.get(coding, wildcard)
+
+class GZipMiddleware(gzip.GZipMiddleware):
+    """Django's GZipMiddleware, except that it believes "gzip;q=0"."""
+
+    def process_response(self, request, response):
+        if encoding_qualities(request)('gzip') <= 0:
+            patch_vary_headers(response, ('Accept-Encoding',))
+            return response
+        return super(GZipMiddleware, self).process_response(
+            request, response)
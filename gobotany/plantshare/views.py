@@ -1,5 +1,4 @@
 import csv
-import json
 import math
 
 from datetime import datetime, timedelta
@@ -21,6 +20,7 @@ from django.utils.timezone import utc
 
 from account.models import EmailConfirmation
 
+from gobotany.core import encoding
 from gobotany.plantshare.forms import (ChangeEmailForm, ChecklistEntryForm,
     ChecklistForm, QuestionForm, ScreenedImageForm, SightingForm,
     UserProfileForm)
@@ -1136,7 +1136,7 @@ def screen_images(request):
 def ajax_profile_edit(request):
     """ Ajax form submission of profile form """
     if not request.user.is_authenticated():
-        return HttpResponse(json.dumps({
+        return HttpResponse(encoding.dumps({
             'error': True,
             'info': 'User is not authenticated.'
         }), content_type='application/json')
@@ -1152,20 +1152,20 @@ def ajax_profile_edit(request):
             profile.save()
             profile_form.save_m2m()
         else:
-            return HttpResponse(json.dumps({
+            return HttpResponse(encoding.dumps({
                 'error': True,
                 'info': 'Form Validation error:\n{0}'.format(
                     profile_form.errors.as_text())
             }), content_type='application/json')
 
-    return HttpResponse(json.dumps({'success': True}),
+    return HttpResponse(encoding.dumps({'success': True}),
                                          content_type='application/json')
 
 
 def ajax_image_upload(request):
     """ Ajax form submission of image upload form """
     if not request.user.is_authenticated():
-        return HttpResponse(json.dumps({
+        return HttpResponse(encoding.dumps({
             'error': True,
             'info': 'Authentication error'
         }), content_type='application/json')
@@ -1222,14 +1222,14 @@ def ajax_image_upload(request):
                 'longitude': longitude
             })
 
-    return HttpResponse(json.dumps(response),
+    return HttpResponse(encoding.dumps(response),
                         content_type='application/json')
 
 
 def ajax_image_reject(request, image_id):
     """ Reject an image that was previously uploaded. """
     if not request.user.is_authenticated():
-        return HttpResponse(json.dumps({
+        return HttpResponse(encoding.dumps({
             'error': True,
             'info': 'Authentication error'
         }), content_type='application/json')
@@ -1238,7 +1238,7 @@ def ajax_image_reject(request, image_id):
 
     # Only staff or the user who originally uploaded the image may reject it.
     if not (request.user.is_staff or request.user == image.uploaded_by):
-        return HttpResponse(json.dumps({
+        return HttpResponse(encoding.dumps({
             'error': True,
             'info': 'Authentication error'
         }), content_type='application/json')
@@ -1253,7 +1253,7 @@ def ajax_image_reject(request, image_id):
         'success': True
     }
 
-    return HttpResponse(json.dumps(response), content_type='application/json')
+    return HttpResponse(encoding.dumps(response), content_type='application/json')
 
 
 def ajax_sightings(request):
@@ -1319,7 +1319,7 @@ def ajax_sightings(request):
         'sightings': sightings_json
     }
 
-    return HttpResponse(json.dumps(output),
+    return HttpResponse(encoding.dumps(output),
                         content_type='application/json; charset=utf-8')
 
 
@@ -1387,7 +1387,7 @@ def ajax_people_suggestions(request):
             else:
                 ordered_suggestions.append(suggestion)
 
-    return HttpResponse(json.dumps(ordered_suggestions),
+    return HttpResponse(encoding.dumps(ordered_suggestions),
                         content_type='application/json; charset=utf-8')
 
 
@@ -1409,5 +1409,5 @@ def ajax_restrictions(request):
     location = request.GET.get('location')
     if plant_name:
         restrictions_info = restrictions(plant_name, location)
-    return HttpResponse(json.dumps(restrictions_info),
+    return HttpResponse(encoding.dumps(restrictions_info),
                         content_type='application/json; charset=utf-8')
@@ -188,7 +188,7 @@ MIDDLEWARE_CLASSES = (
          if IN_PRODUCTION else ()) + (
 
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.middleware.gzip.GZipMiddleware',
+    'gobotany.middleware.GZipMiddleware',
 
     ) + (('debug_toolbar.middleware.DebugToolbarMiddleware',)
          if USE_DEBUG_TOOLBAR else ()) + (
@@ -207,6 +207,7 @@ ROOT_URLCONF = 'gobotany.urls'
 INTERNAL_IPS = ('127.0.0.1',)
 MEDIA_ROOT = os.path.join(THIS_DIRECTORY, 'media')
 MEDIA_URL = '/media/'
+
 SESSION_COOKIE_AGE = 2 * 24 * 60 * 60  # two days
 
 SOUTH_MIGRATION_MODULES = {
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import json
 import re
 import string
 
@@ -15,7 +14,7 @@ from django.shortcuts import redirect, render
 from django.template import RequestContext
 from django.views.decorators.vary import vary_on_headers
 
-from gobotany.core import botany
+from gobotany.core import botany, distribution_vectors, encoding
 from gobotany.core.models import (
     CommonName, ContentImage, CopyrightHolder, Distribution,
     Family, Genus, GlossaryTerm, Highlight, HomePageImage, PartnerSite,
@@ -263,7 +262,7 @@ def search_suggestions_view(request):
                 for suggestion in  more_suggestions])))[:remaining_slots]
             suggestions.extend(more_suggestions)
 
-    return HttpResponse(json.dumps(suggestions),
+    return HttpResponse(encoding.dumps(suggestions),
         content_type='application/json; charset=utf-8')
 
 # Plant name suggestions API call
@@ -298,7 +297,7 @@ def plant_name_suggestions_view(request):
             more_suggestions = list(more_suggestions)[:remaining_slots]
             suggestions.extend(more_suggestions)
 
-    return HttpResponse(json.dumps(suggestions),
+    return HttpResponse(encoding.dumps(suggestions),
         content_type='application/json; charset=utf-8')
 
 
@@ -432,19 +431,28 @@ def species_list_view(request):
         if taxon_id in plantmap:
             plantmap[taxon_id]['common_names'].append(common_name)
 
-    # Populate states from Distribution data.
-    taxon_ids = list(plantmap.keys())
-    t = Taxon.objects.filter(id__in=taxon_ids).values_list(
-        'id', 'scientific_name')
-    sci_names = list(set([name for id, name in t]))
+    # Populate states from the distribution store, falling back to the
+    # Distribution data for any plants that the store cannot answer for.
     states = [state.upper() for state in list(settings.STATE_NAMES.keys())]
-    d = Distribution.objects.filter(present=True).filter(
-        county__exact='').filter(state__in=states).filter(
-        species_name__in=sci_names).values_list('species_name', 'state')
-    ids_by_name = {name: id for id, name in t}
-    for scientific_name, state in d:
-        taxon_id = ids_by_name[scientific_name]
-        plantmap[taxon_id]['states'].add(state)
+    ids_by_name = {}
+    for plantdict in plants_list:
+        scientific_name = plantdict['scientific_name']
+        records = distribution_vectors.records(scientific_name)
+        if records is None:
+            ids_by_name[scientific_name] = plantdict['id']
+            continue
+        plantdict['states'].update(
+            record.state for record in records
+            if record.present and not record.county
+            and record.state in states)
+    if ids_by_name:
+        d = Distribution.objects.filter(present=True).filter(
+            county__exact='').filter(state__in=states).filter(
+            species_name__in=list(ids_by_name)).values_list(
+            'species_name', 'state')
+        for scientific_name, state in d:
+            taxon_id = ids_by_name[scientific_name]
+            plantmap[taxon_id]['states'].add(state)
 
     q = Pile.species.through.objects.values_list(
         'taxon_id', 'pile__friendly_title', 'pile__pilegroup__friendly_title',
@@ -27,6 +27,11 @@ define([
      */
 
     module.glossaryblob = _.memoize(function() {
+        // The versioned URL may be cached forever; a page that is older
+        // than the catalog gets redirected to the current version.
+        if (typeof GLOSSARY_VERSION !== 'undefined') {
+            return module.get('glossaryblob/' + GLOSSARY_VERSION + '/');
+        }
         return module.get('glossaryblob/');
     });
 
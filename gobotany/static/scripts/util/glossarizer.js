@@ -7,62 +7,85 @@ define([
 
     var exports = {};
 
-    /* Escape a string for literal use in a regular expression. */
-
-    exports.escape = function(str) {
-        // http://stackoverflow.com/questions/3446170/
-        return str.replace(/[-\[\]\/\{\}\(\)\*\+\?\.\\\^\$\|]/g, '\\$&');
-    };
-
     /* Special terms we want to avoid escaping. */
 
     var avoid_terms = ['Fern.'];
 
+    /* Whether a character counts as part of a word, as for "\b". */
+
+    var is_word = function(c) {
+        return c !== undefined && /\w/.test(c);
+    };
+
     /* The glossarizer takes a glossary blob as delivered by the API,
-       parses and prepares a regular expression, and then can mark up
-       glossary terms inside of text so that they turn into tooltipped
-       terms. */
+       whose "trie" holds every glossary term as a tree of characters,
+       and then can mark up glossary terms inside of text so that they
+       turn into tooltipped terms. */
 
     exports.Glossarizer = function(glossaryblob) {
         this.glossaryblob = glossaryblob;
         this.n = 0;
+        this.trie = glossaryblob.trie;
 
-        var terms = [];
-
-        /* Build a list of escaped regular expressions for each term. */
+        /* Avoided terms go into the trie too, so that they win over any
+           shorter term they start with, but are marked with a 0. */
 
+        var trie = this.trie;
         _.each(avoid_terms, function(term) {
-            terms.push(exports.escape(term));
+            var node = trie;
+            term = term[0].toLowerCase() + term.slice(1);
+            for (var i = 0; i < term.length; i++) {
+                node = node[term[i]] || (node[term[i]] = {});
+            }
+            node[''] = 0;
         });
+    };
 
-        _.each(glossaryblob.definitions, function(definition, term) {
-            var eterm = exports.escape(term);
-
-            /* Lower-case terms can also start with an upper-case letter. */
-
-            if (/^[a-z]/.test(eterm)) {
-                var e0 = '[' + eterm[0] + eterm[0].toUpperCase() + ']';
-                var rest = eterm.slice(1);
-                eterm = e0 + rest;
+    /* Return the text as HTML, with each glossary term in a span.
+
+       Each term must start at a word boundary, and if it ends with a
+       letter, it must end at one too.  A term may begin with an upper-
+       case letter even though the trie holds it in lower case.  Where
+       several terms could match, the longest one is chosen. */
+
+    exports.Glossarizer.prototype.scan = function(text) {
+        var trie = this.trie;
+        var html = '';
+        var start = 0;  // where the text not yet copied to html begins
+        var i = 0;
+
+        while (i < text.length) {
+            var end = -1;
+            var mark = 0;
+
+            if (is_word(text[i]) !== is_word(text[i - 1])) {
+                var node = trie[text[i]] || trie[text[i].toLowerCase()];
+                var j = i + 1;
+                while (node) {
+                    if (node[''] !== undefined &&
+                        !(is_word(text[j - 1]) && is_word(text[j]))) {
+                        end = j;
+                        mark = node[''];
+                    }
+                    node = node[text[j]];
+                    j++;
+                }
             }
 
-            /* Terms that end with a letter should end at a word boundary. */
-
-            if (/\w$/.test(eterm)) {
-                eterm = eterm + '\\b';
+            if (end === -1) {
+                i++;
+                continue;
             }
-
-            terms.push(eterm);
-        });
-
-        /* For incredible speed, we pre-build a regular expression of
-           all glossary terms.  This has the advantage of always selecting
-           the longest possible glossary term if several words together
-           could be a glossary term! */
-
-        var re = '\\b(' + terms.join('|') + ')';
-        this.regexp = new RegExp(re, 'g');
-    },
+            if (mark) {
+                html += _.escape(text.slice(start, i)) +
+                    '<span class="gloss">' +
+                    _.escape(text.slice(i, end)) + '</span>';
+                start = end;
+            }
+            i = end;
+        }
+        return html + _.escape(text.slice(start));
+    };
 
     /* Call "markup" on a node - hopefully one with no elements beneath
        it, but just text - to have its text scanned for glossary terms.
@@ -76,19 +99,10 @@ define([
         var self = this;
         var TEXT_NODE = 3;
 
-        var replacer = function(match, term) {
-            if (_.contains(avoid_terms, term))
-                return match;
-            else
-                return '<span class="gloss">' + match + '</span>';
-        };
-
         $(node).contents().each(function() {
             if (this.nodeType !== TEXT_NODE)
                 return;
-            $(this).replaceWith(
-                _.escape(this.textContent).replace(self.regexp, replacer)
-            );
+            $(this).replaceWith(self.scan(this.textContent));
         });
 
         var defs = this.glossaryblob.definitions;